@@ -1,7 +1,12 @@
 from PhotoZ import plotting
 from PhotoZ import functions
 from PhotoZ import predictions
-import math
+from PhotoZ import fit_cache
+from PhotoZ import other_classes
+from PhotoZ import config_data
+from PhotoZ import centering
+from PhotoZ import implied_redshift
+import numpy as np
 from PhotoZ import global_paths
 
 
@@ -13,6 +18,31 @@ class Cluster(object):
     # Keeping the predictions for the red sequence with the cluster object made things a lot easier. And since the
     # predictions are the same for all cluster, this is a class variable rather than an instance variable.
     predictions_dict = predictions.make_prediction_dictionary(0.01)
+    # Fitting works with the position of each redshift on this axis, rather than the string keys of predictions_dict.
+    redshift_axis = other_classes.RedshiftAxis(predictions_dict)
+    # The same predictions, but for any redshift in between too.
+    prediction_model = other_classes.ContinuousPredictions.from_predictions(predictions_dict)
+    # the red sequence lines of the predictions as arrays along the redshift axis, made for each color when needed.
+    _model_lines = dict()
+
+    # The cuts fit_z uses. Each set of cuts is (bluer color, redder color, brighter mag, fainter mag), relative to
+    # the model red sequence. They are kept here so the fit cache can tell when they change.
+    location_cut_radius = 1.5  # arcminutes
+    # The location cut is centered on the peak of the density of red galaxies, found in a histogram with bins this
+    # big that is smoothed by this much. See centering.py.
+    center_bin_size = 0.2  # arcminutes
+    center_smoothing = 0.5  # arcminutes
+    initial_cuts = (-0.1, 0.1, -1.2, 0.5)
+    # Whether the initial redshift comes from the histogram of the redshifts the sources' colors imply, rather than
+    # counting the sources near the red sequence at every redshift. See implied_redshift.py.
+    fast_initial_redshift = False
+    # color cuts that will be used on the increasingly smaller iterations to refine the fit.
+    bluer_color_cuts = [-0.25, -0.225, -0.20]
+    redder_color_cuts = [0.4, 0.3, 0.2]
+    brighter_mag_cut = -1.4
+    dimmer_mag_cut = 0.6
+    # The final RS cut, which is slightly larger than the cut used to identify the RS
+    final_cuts = (-0.3, 0.6, -1.4, 1.0)
 
     def __init__(self, name, sources_list, spec_z=None):
         # TODO: document
@@ -47,13 +77,104 @@ class Cluster(object):
         self.rs_z = dict()
         self.upper_photo_z_error = dict()
         self.lower_photo_z_error = dict()
+        # (ra, dec) the location cut is centered on. If it's None, the middle of the sources is used, which works for
+        # clusters that have their own catalogs, since they are centered on the cluster.
+        self.center = None
+
+        # arrays of magnitudes and colors for all the sources, made when they are first needed. See get_colors.
+        self._arrays = dict()
+        self._arrays_made_from = None
 
     def __repr__(self):  # how the object appears when printed
         return self.name
 
-    def calculate_color(self):
-        for source in self.sources_list:
-            source.calculate_color()
+    def calculate_color(self, colors=None):
+        """Calculate colors for all the sources at once.
+
+        This is optional, since get_colors calculates any color the first time it is asked for, but it does the work
+        up front.
+
+        :param colors: list of colors to calculate, like "sloan_r-sloan_z". Defaults to the ones that get fit.
+        :return: None
+        """
+        if colors is None:
+            colors = config_data.fitted_colors
+        for color in colors:
+            self.get_colors(color)
+
+    def get_mags(self, band):
+        """Get the magnitudes of all the sources in one band, in the same order as sources_list.
+
+        :param band: band, like "sloan_z"
+        :return: MeasurementArray of magnitudes. Sources without data in this band have NaN.
+        """
+        key = "mag:" + band
+        arrays = self._get_arrays()
+        if key not in arrays:
+            arrays[key] = other_classes.MeasurementArray.from_data([source.mags.get(band)
+                                                                    for source in self.sources_list])
+        return arrays[key]
+
+    def get_colors(self, color):
+        """Get one color of all the sources, in the same order as sources_list.
+
+        Only the colors that are asked for are ever calculated, and they are calculated for all the sources at once.
+        The results are kept until sources or band data are added, so asking again is free.
+
+        Colors that came straight from a catalog (and are stored on the source) are used as they are. Otherwise, the
+        color is the difference of the magnitudes, with the errors added in quadrature.
+
+        :param color: color of the form "band1-band2"
+        :return: MeasurementArray of colors. Sources that don't have this color have NaN.
+        """
+        key = "color:" + color
+        arrays = self._get_arrays()
+        if key not in arrays:
+            bluer_band, redder_band = color.split("-")
+            colors = self.get_mags(bluer_band) - self.get_mags(redder_band)
+
+            # use the colors from the catalogs, where there are any
+            for i, source in enumerate(self.sources_list):
+                if color in source.colors:
+                    colors.values[i] = source.colors[color].value
+                    colors.errors[i] = source.colors[color].error
+            arrays[key] = colors
+        return arrays[key]
+
+    def _get_arrays(self):
+        """Get the dictionary of arrays made by get_mags and get_colors, throwing them out first if the sources have
+        changed since they were made.
+        """
+        made_from = self._arrays_made_from
+        if (made_from is None or made_from[0] is not self.sources_list or made_from[1] != len(self.sources_list) or
+                made_from[2] != other_classes.Source.band_data_version):
+            self._arrays = dict()
+            self._arrays_made_from = (self.sources_list, len(self.sources_list), other_classes.Source.band_data_version)
+        return self._arrays
+
+    def _source_mask(self, sources):
+        """Make a boolean array that is True for the sources in sources_list that are in the given list."""
+        if sources is self.sources_list:
+            return np.ones(len(self.sources_list), dtype=bool)
+        in_list = set(id(source) for source in sources)
+        return np.array([id(source) in in_list for source in self.sources_list], dtype=bool)
+
+    def use_source_arrays(self, mags):
+        """Use magnitude arrays that already exist, rather than having get_mags make them from the sources.
+
+        This is for arrays that are views of shared memory (see source_arena.py), so they aren't copied. They are
+        thrown out like any others if the sources change.
+
+        :param mags: dictionary with bands as keys and MeasurementArrays as values. They must be in the same order
+                     as sources_list.
+        :return: None
+        """
+        arrays = self._get_arrays()
+        for band, measurements in mags.items():
+            if len(measurements) != len(self.sources_list):
+                other_classes.EndProgramError("The magnitude arrays need one entry per source.",
+                                              (band, len(measurements), len(self.sources_list)))
+            arrays["mag:" + band] = measurements
 
 
 
@@ -65,7 +186,7 @@ class Cluster(object):
     #######################################
 
 
-    def fit_z(self, color, plot_figures=False):
+    def fit_z(self, color, plot_figures=False, use_cache=True):
         """Find the redshift of the cluster by matching its red sequence to the models.
         Basically works as the main function for this process. Other functions are called to do the dirty work.
 
@@ -73,31 +194,36 @@ class Cluster(object):
         "band1-band2" (like "r-z")
         :param plot_figures: To plot figures, pass in a list that the figures will be appended to.
                              If no plotting is desired, leave the parameter blank (i.e. pass nothing in).
+        :param use_cache: Whether to look for this fit in the fit cache first. The same sources, cuts, and models
+                          always give the same answer, so if it is there the fitting (and plotting) is skipped. The
+                          plots from when it was first fit are still there.
         :return: None, but the instance variables for photometric redshift and photo z error are set inside.
         """
+        if use_cache:
+            cache_key = fit_cache.make_key(self, color)
+            if fit_cache.load(self, color, cache_key):
+                print self, color, self.rs_z.get(color), "(from the fit cache)"
+                return
 
         # initialize list to append figures to
         figures_list = []
         # Find a good starting redshift to base the rest of the work on, and set RS membership
 
-        if "z" not in self.name:
-            if self.name == "MOO0037+3306" or self.name == "MOO0105+1323":
-                pass
-                # self._find_xy_cut(750)  # TODO: write better cut function
-            else:
-                print self.name
-                self._find_location_cut(1.5)  # To do no plotting
+        if self._has_location_cut():
+            print self.name
+            self._find_location_cut(self.location_cut_radius, color)  # To do no plotting
         if plot_figures:
             # Plot initial color mag with predictions
             figures_list.append(plotting.plot_color_mag(self, color, band=color.split("-")[1], predictions=True,
                                                         distinguish_red_sequence=False))
             pass
 
-        # do an initial redshift fitting, to get a starting point
+        # do an initial redshift fitting, to get a starting point. All the redshifts in fitting are indices on
+        # redshift_axis, until the end.
         initial_z = self._find_initial_redshift(color, plot_bar=False, figs_list=figures_list)
 
         # set red sequence cut based on the initial redshift
-        self._set_as_rs_member(self.sources_list, initial_z, color, -0.1, 0.1, -1.2, 0.5)
+        self._set_as_rs_member(self.sources_list, initial_z, color, *self.initial_cuts)
 
 
         if plot_figures:
@@ -109,12 +235,12 @@ class Cluster(object):
 
 
         # set color cuts that will be used on the increasingly smaller iterations to refine the fit.
-        bluer_color_cut = [-0.25, -0.225, -0.20]
+        bluer_color_cut = self.bluer_color_cuts
         # if self.name.startswith("MOO1636"):
         #     bluer_color_cut = [-0.2, -0.2, -0.2]  # Override to avoid "foregrounds." Not sure if actually foregrounds
-        redder_color_cut = [0.4, 0.3, 0.2]
-        brighter_mag_cut = -1.4
-        dimmer_mag_cut = 0.6
+        redder_color_cut = self.redder_color_cuts
+        brighter_mag_cut = self.brighter_mag_cut
+        dimmer_mag_cut = self.dimmer_mag_cut
 
 
 
@@ -136,6 +262,9 @@ class Cluster(object):
             sample = [source for source in self.sources_list if source.RS_member]
 
             if len(sample) < 3:  # TODO: remove this once calibration is fixed
+                if use_cache:
+                    # not having enough sources is an answer too
+                    fit_cache.store(self, color, cache_key)
                 return
 
             # Plot most recent redshift estimate
@@ -146,9 +275,11 @@ class Cluster(object):
 
                 pass
 
-            chi_redshift_list = self._fit_redshift_to_sample(sample, color, color.split("-")[1])
+            chi_values = self._fit_redshift_to_sample(sample, color, color.split("-")[1])
 
-            best_z, z_lower_error, z_upper_error = self._get_stats_from_chi(chi_redshift_list)
+            # the best redshift can be between grid points, but the cuts are done at the closest one
+            best_redshift, z_lower_error, z_upper_error, chi_curve = self._get_stats_from_chi(chi_values)
+            best_z = self.redshift_axis.nearest(best_redshift)
 
 
 
@@ -156,14 +287,12 @@ class Cluster(object):
 
 
         # Set cluster attributes, now that the process is complete
-        self.rs_z[color] = best_z
+        self.rs_z[color] = str(round(best_redshift, 3))
         self.upper_photo_z_error[color] = z_upper_error
         self.lower_photo_z_error[color] = z_lower_error
 
         # Make final RS cut, which will be slightly larger than the cut used to identify the RS
-        self._set_as_rs_member(self.sources_list, self.rs_z[
-            color], color, -0.3, 0.6, -1.4,
-                                1.0)
+        self._set_as_rs_member(self.sources_list, best_z, color, *self.final_cuts)
         # self._set_as_rs_member([source for source in self.sources_list if source.in_location], self.rs_z, color, -0.3, 0.6,
         #                        -1.2, 1.0)
         # Override for lower redshift struture, since there is a higher structure that gets in the way
@@ -188,6 +317,9 @@ class Cluster(object):
 
         print self, color, self.rs_z[color]
 
+        if use_cache:
+            fit_cache.store(self, color, cache_key)
+
 
 
 
@@ -202,97 +334,212 @@ class Cluster(object):
 
         :param plot_bar: Whether or not to make a bar graph showing the number of galaxies near each redshift.
         :param figs_list: the list the figures will be appended to, if they are plotted
-        :return: best fitting redshift.
+        :return: index of the best fitting redshift on redshift_axis.
 
         """
         # TODO: I don't know if I really need to do this. I could just do fitting without this starting poitn
-        # Initialize empty lists, will append as we go
-        galaxies_list = []
-        z_list = []
-
-        # Iterate through each redshift we have predictions for
-        for z in sorted(self.predictions_dict.iterkeys()):  # need to be sorted, since we will be including neighbors
-            rs_members = 0
-            self._set_as_rs_member(self.sources_list, z, color, -0.1, 0.1, -1.2, 0.5)  # 3rd spot could be -2.0
-            for source in self.sources_list:
-                # print source.RS_member, source.in_location
-                if source.RS_member and source.in_location:
-                    rs_members += 1
-
-            # Append the results to lists
-            galaxies_list.append(rs_members)
-            z_list.append(z)
+        # Count the galaxies near the RS at each redshift we have predictions for. The redshift axis is in order,
+        # which is needed since we will be including neighbors.
+        in_location = np.array([source.in_location for source in self.sources_list], dtype=bool)
+        if self.fast_initial_redshift:
+            colors = self.get_colors(color)
+            galaxies_list = implied_redshift.count_near_red_sequence(color, self._get_model_lines(color),
+                                                                     self.get_mags(color.split("-")[1]).values,
+                                                                     colors.values, colors.errors, in_location,
+                                                                     self.initial_cuts)[:, 0].tolist()
+        else:
+            galaxies_list = [int(np.sum(self._rs_member_mask(in_location, z, color, *self.initial_cuts)))
+                             for z in range(len(self.redshift_axis))]
 
         # The best redshift will be the one with the most RS galaxies. Since the data is noisy, adding the 3 neighbors
         # on each side will make for more stable results
         highest_sum = 0
-        best_z = 0
-        for k in range(3, len(z_list)-3):  # Can't start at 0, since we need 3 neighbors on each side
-            temp_sum = (galaxies_list[k-3] + galaxies_list[k-2] + galaxies_list[k-1] + galaxies_list[k] +
-                        galaxies_list[k+1] + galaxies_list[k+2] + galaxies_list[k+3])
+        best_z = None
+        for k in range(3, len(galaxies_list)-3):  # Can't start at 0, since we need 3 neighbors on each side
+            temp_sum = sum(galaxies_list[k-3:k+4])
             if temp_sum > highest_sum:
                 highest_sum = temp_sum
-                best_z = z_list[k]
+                best_z = k
 
-        if plot_bar:
-            figs_list.append(plotting.plot_initial_redshift_finding(self, z_list, galaxies_list, best_z))
+        if best_z is None:
+            best_z = self.redshift_axis.index("0.5")  # TODO: get rid of this once I correct calibration
 
-        if best_z == 0:
-            best_z = "0.5"  # TODO: get rid of this once I correct calibration
+        if plot_bar:
+            figs_list.append(plotting.plot_initial_redshift_finding(self, self.redshift_axis.keys, galaxies_list,
+                                                                    self.redshift_axis[best_z]))
 
         return best_z
 
     def _fit_redshift_to_sample(self, galaxies, color, band):
-        # TODO: Document
-        # set placeholders
-        chi_squared_redshift_pairs = []
-        for z in sorted(self.predictions_dict.iterkeys()):  # redshifts in order, so we can look at chi distribution
-            temp_chi_squared = predictions.simple_chi_square(galaxies, color, band, self.predictions_dict[
-                z].get_lambda(color))
-            chi_squared_redshift_pairs.append((z, temp_chi_squared))
-
-        return chi_squared_redshift_pairs
-
-    def _get_stats_from_chi(self, chi_redshift_pairs, figs=None):
-        # TODO: Document
-
-        best_chi = 999999999999
-        best_z = 999
-        for pair in chi_redshift_pairs:
-            if pair[1] < best_chi:
-                best_z = pair[0]
-                best_chi = pair[1]
-
-        # now find error limits
-        left_limit = 1.6
-        right_limit = 0.4
-        for pair in chi_redshift_pairs:
-            if pair[1] < best_chi + 1.0:  # Within one sigma
-                if float(pair[0]) < float(best_z):  # Will be left limit
-                    if float(pair[0]) < left_limit:
-                        left_limit = float(pair[0])
-                else:  # Will be right limit
-                    if float(pair[0]) > right_limit:
-                        right_limit = float(pair[0])
-
-        # If the limits aren't replaced, set the limits to be nearly at the point.
-        if left_limit == 1.6:
-            left_limit = float(best_z) - 0.005
-        if right_limit == 0.4:
-            right_limit = float(best_z) + 0.005
+        """Find the chi-squared of the galaxies against the red sequence at every redshift.
+
+        :param galaxies: list of sources to fit
+        :param color: color being fit
+        :param band: the redder band of the color
+        :return: array of reduced chi-squared values, one for each redshift on redshift_axis.
+        """
+        # get the data for the galaxies in the sample once, and compare it to all the redshifts at once
+        in_sample = self._source_mask(galaxies)
+        mags = self.get_mags(band).values[in_sample]
+        colors = self.get_colors(color)[in_sample]
+        return predictions.chi_square_grid(mags, colors.values, colors.errors, *self._get_model_lines(color))
+
+    def _get_stats_from_chi(self, chi_values, figs=None, redshift_axis=None):
+        """Find the best redshift, and its errors, from the chi-squared values at each redshift.
+
+        The redshift isn't limited to the grid. A parabola is fit through the lowest point and its two neighbors, and
+        the best redshift is its minimum. The errors go out to where the chi-squared is one more than that minimum.
+        On each side, the furthest grid point within one sigma is found, and the exact place the chi-squared crosses
+        minimum + 1 past it is solved for (see _find_chi_crossing). If the curve never crosses before the edge of the
+        grid, the error goes to the edge.
+
+        :param chi_values: array of chi-squared values at each redshift on redshift_axis.
+        :param figs: list to put a plot of the chi-squared values in. Nothing is plotted if it isn't a list.
+        :param redshift_axis: RedshiftAxis the chi-squared values are on, if it's not the cluster's.
+        :return: best redshift (as a float), lower error, upper error, and the whole chi-squared curve, which is an
+                 array of shape (2, number of redshifts) holding the redshifts and their chi-squared values.
+        """
+        if redshift_axis is None:
+            redshift_axis = self.redshift_axis
+        redshifts = redshift_axis.redshifts
+        # NaNs are never the best fit
+        chi_values = np.where(np.isnan(chi_values), np.inf, chi_values)
+        best_index = int(np.argmin(chi_values))
+
+        best_z, best_chi = redshifts[best_index], chi_values[best_index]
+        if 0 < best_index < len(redshifts) - 1 and np.all(np.isfinite(chi_values[best_index - 1:best_index + 2])):
+            # fit around the best point, so the numbers stay small
+            offsets = redshifts[best_index - 1:best_index + 2] - redshifts[best_index]
+            a, b, c = np.polyfit(offsets, chi_values[best_index - 1:best_index + 2], 2)
+            if a > 0:
+                best_z = redshifts[best_index] - b / (2 * a)
+                best_chi = c - b**2 / (4 * a)
+
+        threshold = best_chi + 1.0
+        within_one_sigma = np.where(chi_values < threshold)[0]
+        # there's always at least the best point, since the minimum of the parabola is never above it
+        left_limit = self._find_chi_crossing(redshifts, chi_values, threshold, within_one_sigma[0], -1)
+        right_limit = self._find_chi_crossing(redshifts, chi_values, threshold, within_one_sigma[-1], 1)
 
         if type(figs) is list:
-            figs.append(plotting.plot_chi_data(self, chi_redshift_pairs, left_limit, best_z, right_limit))
-        lower_error = float(best_z) - float(left_limit)
-        upper_error = float(right_limit) - float(best_z)
-        return best_z, lower_error, upper_error
+            figs.append(plotting.plot_chi_data(self, zip(redshift_axis.keys, chi_values.tolist()), left_limit,
+                                               best_z, right_limit))
+        return float(best_z), float(best_z - left_limit), float(right_limit - best_z), np.vstack([redshifts,
+                                                                                                 chi_values])
+
+    @staticmethod
+    def _find_chi_crossing(redshifts, chi_values, threshold, last_within, direction):
+        """Find where the chi-squared curve goes above the threshold, going out from the best fit in one direction.
+
+        A parabola is put through the last grid point below the threshold, the first one above it, and the one on the
+        other side of the last one below, and the crossing is where it reaches the threshold. When the last point
+        below is the lowest point, this is the same parabola that gives the best redshift. If there aren't enough
+        points for that, it is interpolated in a straight line instead.
+
+        :param redshifts: array of the redshifts the chi-squared values are at.
+        :param chi_values: array of chi-squared values at each of those redshifts.
+        :param threshold: the chi-squared value to find the crossing of.
+        :param last_within: index of the furthest grid point in this direction that is below the threshold.
+        :param direction: -1 to go towards lower redshifts, 1 for higher
+        :return: redshift of the crossing
+        """
+        outside = last_within + direction
+        if outside < 0 or outside >= len(redshifts) or not np.isfinite(chi_values[outside]):
+            return redshifts[last_within]  # goes off the edge of the grid
+        # work relative to the last point inside, so the crossing is between 0 and the distance to the next point
+        distance = redshifts[outside] - redshifts[last_within]
+
+        inner = last_within - direction
+        if 0 <= inner < len(redshifts) and np.isfinite(chi_values[inner]):
+            points = [inner, last_within, outside]
+            a, b, c = np.polyfit(redshifts[points] - redshifts[last_within], chi_values[points] - threshold, 2)
+            for root in np.roots([a, b, c]):
+                if np.isreal(root) and 0 <= root.real / distance <= 1:
+                    return redshifts[last_within] + root.real
+
+        inside_chi, outside_chi = chi_values[last_within], chi_values[outside]
+        return redshifts[last_within] + (threshold - inside_chi) / (outside_chi - inside_chi) * distance
+
+    def fit_models(self, color, cube=None, sample=None):
+        """Fit the red sequence to every model in a prediction cube at once, to see how much the models matter.
+
+        The sample is fit against all the models at all the redshifts in one go, so this takes about as long as one
+        round of fitting in fit_z. The sample isn't reselected for each model.
+
+        :param color: color to fit, like "sloan_r-sloan_z"
+        :param cube: PredictionCube with the models to compare. Defaults to all the ones in config_data, with the
+                     same spacing as the predictions the cluster uses.
+        :param sample: list of sources to fit. Defaults to the sample fit_z fit in its last round (see fit_sample), so
+                       run fit_z first.
+        :return: dictionary with keys=model tuples, values=(best redshift, lower error, upper error). Empty if there
+                 aren't enough sources to fit.
+        """
+        if cube is None:
+            cube = predictions.make_prediction_cube(self.redshift_axis.spacing)
+        if sample is None:
+            sample = self.fit_sample(color)
+        if len(sample) < 3:
+            return dict()
+
+        in_sample = self._source_mask(sample)
+        mags = self.get_mags(color.split("-")[1]).values[in_sample]
+        colors = self.get_colors(color)[in_sample]
+        # dimensions of [models, redshifts]
+        chi_values = predictions.chi_square_grid(mags, colors.values, colors.errors, *cube.get_line_parameters(color))
+
+        results = dict()
+        for model, model_chi_values in zip(cube.models, chi_values):
+            results[model] = self._get_stats_from_chi(model_chi_values, redshift_axis=cube.redshift_axis)[:3]
+        return results
+
+    def fit_sample(self, color):
+        """Get the sources fit_z fit in its last round, which is what its redshift comes from.
+
+        These aren't the RS members fit_z leaves behind, since those are from the wider final cut, which is done on
+        every source rather than only the ones in the location cut. The last round's cuts are done again around the
+        redshift fit_z found.
+
+        :param color: color that was fit, like "sloan_r-sloan_z"
+        :return: list of sources. Empty if the color hasn't been fit.
+        """
+        if color not in self.rs_z:
+            return []
+        best_z = self.redshift_axis.nearest(float(self.rs_z[color]))
+        in_location = np.array([source.in_location for source in self.sources_list], dtype=bool)
+        in_sample = self._rs_member_mask(in_location, best_z, color, self.bluer_color_cuts[-1],
+                                         self.redder_color_cuts[-1], self.brighter_mag_cut, self.dimmer_mag_cut)
+        return [source for source, is_in in zip(self.sources_list, in_sample.tolist()) if is_in]
+
+    @classmethod
+    def use_shared_predictions(cls, shared):
+        """Fit with a prediction grid shared between processes, rather than this process's own copy of the lines.
+
+        :param shared: SharedPredictions, from shared_predictions.attach. It has to be made from the same
+                       predictions as predictions_dict, which is still used for plotting and the fit cache.
+        :return: None
+        """
+        cls.redshift_axis = shared.redshift_axis
+        cls._model_lines = {color: shared.get_line_parameters(color) for color in shared.colors
+                            if all(band in shared.filters for band in color.split("-"))}
+
+    @classmethod
+    def _get_model_lines(cls, color):
+        """Get the red sequence lines of the predictions at every redshift, as arrays along redshift_axis.
+
+        :param color: color, like "sloan_r-sloan_z"
+        :return: arrays of the color zeropoints, slopes, and pivot magnitudes. See Predictions.get_line_parameters.
+        """
+        if color not in cls._model_lines:
+            parameters = [cls.predictions_dict[key].get_line_parameters(color) for key in cls.redshift_axis.keys]
+            cls._model_lines[color] = tuple(np.array(column, dtype=np.float64) for column in zip(*parameters))
+        return cls._model_lines[color]
 
     def _set_as_rs_member(self, sources, redshift, color, bluer_color_residual_cut, redder_color_residual_cut,
                           bright_mag_cut=-999.9,  faint_mag_cut=999.9):
         """Set certain sources as red sequence members if they meet magnitude and color cuts.
 
         :param sources: list of sources to be tested for RS membership
-        :param redshift: Redshift of the red sequence.
+        :param redshift: index of the redshift of the red sequence on redshift_axis.
         :param bluer_color_residual_cut: How many magnitudes brighter than the characteristic magnitude of the RS
                sources can still be considered RS members.
         :param redder_color_residual_cut: How many magnitudes fainter than the characteristic magnitude sources will
@@ -302,92 +549,140 @@ class Cluster(object):
         :return: none, but sets instance attributes of sources
         """
 
-        # First set all sources as not RS members
-        for source in self.sources_list:
-            source.RS_member = False
-
-        band = color.split("-")[1]
-
+        # set the residuals on the sources, then get which are members
         self._set_residuals(redshift, color)
-        for source in sources:
+        passes = self._rs_member_mask(self._source_mask(sources), redshift, color, bluer_color_residual_cut,
+                                      redder_color_residual_cut, bright_mag_cut, faint_mag_cut)
 
-            if (band in source.mags and color in source.colors and source.colors[color].error <= 0.2 and
-                self.predictions_dict[redshift].mags_dict[band] + bright_mag_cut < source.mags[band] <
-                self.predictions_dict[redshift].mags_dict[band] + faint_mag_cut and
-                bluer_color_residual_cut < source.color_residual < redder_color_residual_cut ):
+        for source, is_member in zip(self.sources_list, passes.tolist()):
+            source.RS_member = is_member
 
+    def _rs_member_mask(self, in_sample, redshift, color, bluer_color_residual_cut, redder_color_residual_cut,
+                        bright_mag_cut=-999.9, faint_mag_cut=999.9):
+        """Find which sources pass the red sequence cuts, without changing anything. See _set_as_rs_member.
 
-                source.RS_member = True
+        :param in_sample: boolean array of which sources in sources_list can be members.
+        :return: boolean array of which sources in sources_list pass the cuts.
+        """
+        zeropoints, slopes, pivot_mags = self._get_model_lines(color)
+        mags = self.get_mags(color.split("-")[1])
+        colors = self.get_colors(color)
+        # the predicted magnitude in the redder band is where the line pivots
+        predicted_mag = pivot_mags[redshift]
+        residuals = self._get_residuals(redshift, color)
+
+        # Do the cuts on all the sources at once. Sources without the band or color have NaN there, which fails
+        # every comparison, so they are never members.
+        with np.errstate(invalid="ignore"):
+            return (in_sample & (colors.errors <= 0.2) &
+                    (mags > predicted_mag + bright_mag_cut) & (mags < predicted_mag + faint_mag_cut) &
+                    (bluer_color_residual_cut < residuals) & (residuals < redder_color_residual_cut))
 
     def _set_residuals(self, redshift, color):
         """
         Set each galaxy's color_residual instance attribute to the difference between the predicted RS color and the
         galaxy's color.
 
-        :return: none, but instance attributes are changed in galaxy objects.
+        :param redshift: index of the redshift on redshift_axis
+        :return: array of the residuals, in the same order as sources_list. Instance attributes are also changed in
+                 galaxy objects.
         """
+        residuals = self._get_residuals(redshift, color)
+        for source, residual in zip(self.sources_list, residuals.tolist()):
+            source.color_residual = residual
+        return residuals
 
-        band = color.split("-")[1]
+    def _get_residuals(self, redshift, color):
+        """Get the difference between each galaxy's color and the predicted RS color, without setting anything.
 
-        best_z_line = self.predictions_dict[redshift].get_lambda(color)
-        for source in self.sources_list:
-            if band in source.mags and color in source.colors:
-                source.color_residual = source.colors[color].value - best_z_line(source.mags[band].value)
+        :param redshift: index of the redshift on redshift_axis
+        :param color: color, like "sloan_r-sloan_z"
+        :return: array of the residuals, in the same order as sources_list.
+        """
+        zeropoints, slopes, pivot_mags = self._get_model_lines(color)
+        mags = self.get_mags(color.split("-")[1]).values
+        # same as Predictions.get_lambda
+        residuals = self.get_colors(color).values - (zeropoints[redshift] + slopes[redshift] *
+                                                     (mags - pivot_mags[redshift]))
+        # sources without the data to have a residual get a huge one
+        residuals[np.isnan(residuals)] = 999
+        return residuals
+
+    def _has_location_cut(self):
+        """Whether fit_z does the location cut on this cluster. The rest keep the in_location their sources have."""
+        # MOO0037+3306 and MOO0105+1323 could use self._find_xy_cut(750)  # TODO: write better cut function
+        return "z" not in self.name and self.name not in ["MOO0037+3306", "MOO0105+1323"]
+
+    def _find_location_cut(self, radius, color=None):
+        """Set which sources are within some radius of the center of the cluster, as their in_location attribute.
+
+        :param radius: radius of the cut, in arcminutes
+        :param color: color of the red sequence, like "sloan_r-sloan_z". If it's given, the center is found with the
+                      sources that could be on the red sequence weighted more. See _find_center.
+        :return: (ra, dec) the cut was centered on
+        """
+        center, in_location = self.find_apertures([radius], color)
+        for source, is_in in zip(self.sources_list, in_location[0].tolist()):
+            source.in_location = is_in
+        return center
 
-            else:
-                source.color_residual = 999
+    def find_apertures(self, radii, color=None):
+        """Find which sources are within several radii of the center of the cluster, all at once. Nothing is set.
 
-    def _find_location_cut(self, radius):
+        This is for trying out different sizes of location cut, without having to fit with each one.
 
-        # radius is in arcminutes
+        :param radii: list of radii, in arcminutes
+        :param color: color of the red sequence, to find the center with. See _find_center.
+        :return: (ra, dec) of the center, and a boolean array with dimensions of [radii, sources in sources_list]
+                 of which sources are within each radius. The distances are true angular separations.
+        """
+        center = self.center if self.center is not None else self._find_center(color)
+        ras = np.array([source.ra for source in self.sources_list])
+        decs = np.array([source.dec for source in self.sources_list])
+        return center, centering.in_apertures(ras, decs, center, radii)
 
-        # median_ra = np.median([source.ra for source in self.sources_list])
-        median_ra = (max([source.ra for source in self.sources_list]) + min([source.ra for source in
-                                                                             self.sources_list]))/2
-        # median_decs = np.median([source.dec for source in self.sources_list])
-        median_decs = (max([source.dec for source in self.sources_list]) + min([source.dec for source in
-                                                                             self.sources_list]))/2
+    def _find_center(self, color=None):
+        """Find the center of the cluster, as the peak of the surface density of its sources.
 
-        # Override for one cluster
-        # if self.name.startswith("MOO1636"):
-        #     median_decs += 0.008  # best so far is 0.008
-        # #     median_ra += 0.005  # best so far is 0.005
-        # print median_ra, median_decs
-
-        for source in self.sources_list:
-            dist = math.sqrt((source.ra - median_ra)**2 + (source.dec - median_decs)**2)
-            # if self.name.startswith("MOO2214"):
-            #     # For more distant MOO2214, use 0.0 < 1.0
-            #     # for less distant MOO2214, use 0.0 < 2.0
-            #     if dist < 1.0/60.0:
-            #         source.in_location = True
-            #     else:
-            #         source.in_location = False
-            # if self.name.startswith("MOO1636"):
-            #     # best for MOO1636: 0 < 1.3
-            #     if dist < 1.3/60.0:
-            #         source.in_location = True
-            #     else:
-            #         source.in_location = False
-            if dist < radius/60.0:
-                source.in_location = True
-            else:
-                source.in_location = False
+        If a color is given, only sources that could be on the red sequence at some redshift (see
+        _provisional_rs_mask) are counted, so the field doesn't pull the center around. If none could be, all the
+        sources are used.
 
+        :param color: color of the red sequence, like "sloan_r-sloan_z"
+        :return: (ra, dec) of the center, in degrees
+        """
+        weights = self._provisional_rs_mask(color) if color is not None else None
+        return centering.find_sky_density_peak([source.ra for source in self.sources_list],
+                                               [source.dec for source in self.sources_list], weights,
+                                               self.center_bin_size, self.center_smoothing)
 
-    def _find_xy_cut(self, radius):
-        middle_x = (max([source.ra for source in self.sources_list]) + min([source.ra for source in
-                                                                             self.sources_list]))/2
-        middle_y = (max([source.dec for source in self.sources_list]) + min([source.dec for source in
-                                                                             self.sources_list]))/2
+    def _provisional_rs_mask(self, color):
+        """Find which sources pass the initial red sequence cuts at any of the redshifts, before there is a redshift.
 
-        for source in self.sources_list:
-            dist = math.sqrt((source.ra - middle_x)**2 + (source.dec - middle_y)**2)
+        :param color: color of the red sequence
+        :return: boolean array, in the same order as sources_list
+        """
+        everything = np.ones(len(self.sources_list), dtype=bool)
+        return np.any([self._rs_member_mask(everything, z, color, *self.initial_cuts)
+                       for z in range(len(self.redshift_axis))], axis=0)
 
-            if dist < radius:
-                source.in_location = True
-            else:
-                source.in_location = False
+    def _find_xy_cut(self, radius):
+        """Like _find_location_cut, for sources whose positions are pixel coordinates rather than RA and dec, so the
+        distances are flat. It's centered on the peak of the density of the sources.
+
+        :param radius: radius of the cut, in pixels
+        :return: x, y the cut was centered on
+        """
+        xs = np.array([source.ra for source in self.sources_list])
+        ys = np.array([source.dec for source in self.sources_list])
+        # the same size compared to the cut as the ones used on the sky
+        scale = float(radius) / self.location_cut_radius
+        middle_x, middle_y = centering.find_density_peak(xs, ys, bin_size=self.center_bin_size * scale,
+                                                         smoothing=self.center_smoothing * scale)
+        inside = np.hypot(xs - middle_x, ys - middle_y) < radius
+        for source, is_in in zip(self.sources_list, inside.tolist()):
+            source.in_location = is_in
+        return middle_x, middle_y
 
     def _write_rs_catalog(self):
         # TODO: document
@@ -1,16 +1,18 @@
 import os
 import subprocess
 import matplotlib.pyplot as plt
-from astropy.io import fits
 from PhotoZ import functions
+from PhotoZ import fits_index
+from PhotoZ import seeing
 from PhotoZ import global_paths
 from PhotoZ import SExtractor_functions
 from PhotoZ import sdss_calibration
 from PhotoZ import other_classes
 from PhotoZ import catalog
+from PhotoZ import detection
 
 
-def sextractor_main(image_paths):
+def sextractor_main(image_paths, backend="sextractor", processes=1):
     """Perform the process to run SExtractor on a list of images.
 
     Matches r and z images, then calls the SExtractor function to run it with z as the detection image, and both r and z
@@ -18,6 +20,13 @@ def sextractor_main(image_paths):
 
     :param image_paths: list of strings that are the paths of all the images that will be run through SExtractor
     :type image_paths: list
+    :param backend: what does the source detection and photometry. "sextractor" runs the external SExtractor
+                    binary. "numpy" uses the in-process engine in detection.py, which doesn't need SExtractor to be
+                    installed, and doesn't write anything to disk except the final catalogs.
+    :type backend: str
+    :param processes: how many processes the tiles of each image are spread over, for the things that work on the
+                      pixels here (measuring the seeing, and detection with the numpy backend).
+    :type processes: int
     :return: None. Does make catalogs that are placed in the location the user specified in the global_paths file.
     """
     # First, need to group the images based on what cluster they are of
@@ -43,7 +52,7 @@ def sextractor_main(image_paths):
             for measurement_image in [z_image, r_image]:
                 # Always use z as the detection image, since it is the reddest band in optical
                 # TODO: DOCUMENTED TO HERE
-                figure = _create_catalogs(z_image, measurement_image)
+                figure = _create_catalogs(z_image, measurement_image, backend, processes)
                 # That function does the dirty work of running SExtractor and calibrating to SDSS. It returns a
                 # figure object of the plot comparing the final SDSS calibration. If it couldn't work, it will return
                 # False.
@@ -65,13 +74,15 @@ def sextractor_main(image_paths):
     plt.close("all")
 
 
-def _create_catalogs(detection_image, measurement_image):
+def _create_catalogs(detection_image, measurement_image, backend="sextractor", processes=1):
     """Run the whole process of creating calibrated catalogs. Runs SExtractor, and then calibrates the catalog to SDSS.
 
     Does calibration by adjusting the zeropoint parameter in SExtractor.
 
     :param detection_image: path to the image that detection will be done in (generally z)
     :param measurement_image: path to the image that will be used as measurement. Can be any band.
+    :param backend: "sextractor" or "numpy". See sextractor_main.
+    :param processes: how many processes the image tiles are spread over. See sextractor_main.
     :return: figure showing the results of the SDSS calibration. Will be SDSS mags vs mag difference. Will return
     False if calibration failed for whatever reason (normally not enough sources matching between the image and the
     SDSS catalog.
@@ -88,19 +99,17 @@ def _create_catalogs(detection_image, measurement_image):
     zero_point = SExtractor_functions.find_zeropoint(config_file)
 
     # find the FWHM
-    fwhm = get_fwhm(measurement_image)
+    fwhm = get_fwhm(measurement_image, processes)
 
-    # TODO: get the FWHM (probably from SExtractor) if the FWHM isn't in the image header.
 
 
-    # Determine the name of the catalog. Will be of the form Filename_band.cat
-    sex_catalog_name = functions.make_cluster_name(measurement_image.split("/")[-1]) + "_" +\
-                       functions.get_band_from_filename(measurement_image) + ".cat"
-    # add the directory the catalog should be stored in.
-    sex_catalog_path = global_paths.catalogs_save_directory + sex_catalog_name
+    # Determine where the catalog goes.
+    sex_catalog_path = get_catalog_path(measurement_image)
+    sex_catalog_name = sex_catalog_path.split("/")[-1]
 
     # Run SExtractor once before the calibration loop, to get a baseline before calibration
-    _run_sextractor(detection_image, measurement_image, config_file, str(zero_point), fwhm, sex_catalog_path)
+    _run_source_detection(backend, detection_image, measurement_image, config_file, str(zero_point), fwhm,
+                          sex_catalog_path, processes)
 
     # TODO: somewhere down the road, do aperture corrections. These are neccesary for calibrating
     #  optical to IR mags.
@@ -154,7 +163,8 @@ def _create_catalogs(detection_image, measurement_image):
 
 
     # rerun SExtractor with this new calibrated zeropoint
-    _run_sextractor(detection_image, measurement_image, config_file, str(zero_point), fwhm, sex_catalog_path)
+    _run_source_detection(backend, detection_image, measurement_image, config_file, str(zero_point), fwhm,
+                          sex_catalog_path, processes)
     # This should result in a calibrated catalog.
 
     # We want user input on whether the calibration is good or not. Showing a plot will be the best way
@@ -231,6 +241,34 @@ def _create_catalogs(detection_image, measurement_image):
 
 # TODO: do I need to make separate r-z function, or can I make a general SExtractor function?
 
+def get_catalog_path(measurement_image):
+    """Find where the catalog made from an image is saved.
+
+    :param measurement_image: path to the measurement image
+    :return: path of the catalog. Will be of the form catalogs_save_directory/ClusterName_band.cat
+    """
+    return global_paths.catalogs_save_directory + functions.make_cluster_name(measurement_image.split("/")[-1]) + \
+        "_" + functions.get_band_from_filename(measurement_image) + ".cat"
+
+
+def _run_source_detection(backend, detection_image, measurement_image, sex_file, zeropoint, fwhm, catalog_path,
+                          processes=1):
+    """Make a catalog with whichever backend was asked for. The rest of the arguments are the same as
+    _run_sextractor, and both backends write the same catalog format to catalog_path.
+
+    :param backend: "sextractor" for the external binary, or "numpy" for the in-process engine in detection.py
+    :param processes: how many processes the numpy backend spreads the image tiles over. SExtractor ignores this.
+    """
+    if backend == "sextractor":
+        _run_sextractor(detection_image, measurement_image, sex_file, zeropoint, fwhm, catalog_path)
+    elif backend == "numpy":
+        detection.run_detection(detection_image, measurement_image, sex_file, zeropoint, fwhm, catalog_path,
+                                processes=processes)
+    else:
+        other_classes.EndProgramError("The source detection backend needs to be either 'sextractor' or 'numpy'.",
+                                      backend)
+
+
 def _run_sextractor(detection_image, measurement_image, sex_file, zeropoint, fwhm, catalog_path):
     """Run SExtractor from the command line on the given images.
 
@@ -254,7 +292,7 @@ def _run_sextractor(detection_image, measurement_image, sex_file, zeropoint, fwh
     os.chdir(global_paths.sextractor_params_directory)
 
     # TODO: Try to call "which sex" to determine where SExtractor is.
-    sex = "/usr/local/scisoft///bin/sex"
+    sex = global_paths.sextractor_executable
 
     # Make sure we have r or z or both. Both images have to be r or z bands.
     if not ((functions.get_band_from_filename(detection_image) == "r" or
@@ -279,49 +317,40 @@ def _group_images(image_paths):
     """Group images based on the cluster they are of.
 
     This is done by looking at the numbers in the filename of the image, which correspond to the coordinates of the
-    image. Images with the same coordinate info should be grouped together.
+    image. Images with the same coordinate info should be grouped together. Those numbers are stored in the FITS
+    index when the image is first indexed, so this doesn't need to open any images.
 
-    Specifically, this works by finding the string of coordinate digits, then making a dictionary with the
-    coordinates as keys, and a list of images as values. As we go through the images, we can determine their
+    Specifically, this works by getting the string of coordinate digits from the index, then making a dictionary with
+    the coordinates as keys, and a list of images as values. As we go through the images, we can determine their
     coordinates, then put them in the proper list. At the end, one large list of lists is made from the values in the
     dictionary.
 
     :param image_paths: list of the locations of the images (using their full path).
     :return: list of lists, with image paths being grouped based on the cluster they contain
     """
+    index = fits_index.get_index()
     groups_dict = dict()
     for path in image_paths:
-        filename = path.split("/")[-1]  # This takes the last thing, which will be the filename
-        coordinates = _get_numbers_from_filename(filename)  # Calling then coordinates is generous, it is just an 8
+        coordinates = index.lookup(path)["cluster"]  # Calling then coordinates is generous, it is just an 8
         # digit string of digits that would make coordinates if parsed properly.
         if not coordinates in groups_dict:  # If the cluster isn't already in the dict, make it be
             groups_dict[coordinates] = [path]
         else:  # If it's already there, add the current image to the list of images.
             groups_dict[coordinates].append(path)
+    # save anything new we had to read
+    index.save()
 
     groups_list = groups_dict.values()  # keys are the "coordinates", which we don't care about
 
     return groups_list
 
 
-def _get_numbers_from_filename(filename):
-    """Parse the filename, and return the 8 digits that correspond to the coordinates of the image in the file.
-
-    :param filename: filename to be parsed. Do not pass the full path, just the filename.
-    :return: string of digits representing the coordinates from the filename.
-    """
-    coordinate_digits = ""
-    for letter in filename:
-        if len(coordinate_digits) < 8:  # Only the first 8 digits in the filename correspond to coordinates.
-            if letter.isdigit():
-                coordinate_digits += letter
-    return coordinate_digits
-
-
 def _find_r_and_z_images(images):
     # DOCUMENTED
     """Take a list of images paths of images of one cluster, and figures out which is r, and which is z.
 
+    The band comes from the FITS index, so no images are opened here.
+
     :type images: list of strings showing the file paths for the images.
     :return: path for r image, path for z image.
     """
@@ -329,8 +358,9 @@ def _find_r_and_z_images(images):
 
     r_image, z_image = "", ""  # To make PyCharm happy (says I might return something that hasn't been assigned.
 
+    index = fits_index.get_index()
     for image_path in images:
-        band = functions.get_band_from_filename(image_path.split("/")[-1])  # the filename is after the last /
+        band = index.lookup(image_path)["band"]
         if band == "r":
             r_image = image_path
         elif band == "z":
@@ -339,16 +369,32 @@ def _find_r_and_z_images(images):
             print("An image was passed in in a band that I don't know how to handle now:" + image_path)
     return r_image, z_image
 
-def get_fwhm(image_path):
-    #TODO: document
-    fits_file = fits.open(image_path)
-    try:
-        fwhm = str(fits_file[0].header["FWHMPSF"])
-    except KeyError:
-        print image_path.split("/")[-1] + " does not have a FWHM in the .fits header. FWHM set at ~0.7 arcseconds."
-        # Get the FWHM from somewhere else
-        # Don't know where to get it from at the moment, so I'll pick something that would be bad seeing. I'll also
+def get_fwhm(image_path, processes=1):
+    """Get the FWHM of an image, in arcseconds.
+
+    Uses the FWHMPSF keyword in the header if it is there. The header is read through the FITS index, so this only
+    opens the image if it hasn't been indexed yet (or has changed), and even then only the header is read. If the
+    keyword isn't there, the FWHM is measured from the stars in the image, and that measurement is saved in the
+    index so it only has to be done once.
+
+    :param image_path: path to the .fits image
+    :param processes: how many processes the image tiles are spread over if the FWHM has to be measured.
+    :return: string with the FWHM, since that's what gets passed to SExtractor on the command line.
+    """
+    index = fits_index.get_index()
+    entry = index.lookup(image_path)
+    fwhm = entry["fwhm"]
+    if fwhm is None:
+        if "measured_fwhm" not in entry:
+            entry["measured_fwhm"] = seeing.estimate_fwhm(image_path, processes=processes)
+            index.mark_changed()
+        fwhm = entry["measured_fwhm"]
+    index.save()
+
+    if fwhm is None:
+        print image_path.split("/")[-1] + " does not have a FWHM in the .fits header, and it couldn't be measured " \
+                                          "from the image. FWHM set at ~0.7 arcseconds."
+        # Don't know where to get it from at this point, so I'll pick something that would be bad seeing. I'll also
         # make it something that can be identified easily, so I can identify it later to potentially replace it.
-        fwhm = "0.7110011001100110011001100"
-    fits_file.close()
-    return fwhm
\ No newline at end of file
+        return "0.7110011001100110011001100"
+    return str(fwhm)
@@ -4,10 +4,29 @@ def find_zeropoint(file_path):
     :param file_path: place where the .sex file is.
     :return: zeropoint specified in the file.
     """
+    zeropoint = find_config_value(file_path, "MAG_ZEROPOINT")
+    if zeropoint is not None:
+        return float(zeropoint)
+
+
+def find_config_value(file_path, parameter, default=None):
+    """Finds the value of any parameter in the .sex config file.
+
+    :param file_path: place where the .sex file is.
+    :param parameter: name of the parameter, like "MAG_ZEROPOINT" or "PHOT_APERTURES"
+    :param default: what to return if the parameter isn't in the file.
+    :return: string holding the value specified in the file. If there are multiple values (like apertures separated
+             by commas), the whole thing is returned, and it's up to the caller to split it.
+    """
     sex_file = open(file_path, "r")
     lines = sex_file.readlines()
     sex_file.close()
     for l in lines:
-        if l.split():  # is not an empty list, so not a blank line either
-            if l.split()[0] == "MAG_ZEROPOINT":
-                return float(l.split()[1])
\ No newline at end of file
+        # everything after a # is a comment
+        words = l.split("#")[0].split(None, 1)
+        if words and words[0] == parameter:  # is not an empty list, so not a blank line either
+            # the value is the rest of the line, so lists like "10, 20" come back whole
+            if len(words) > 1:
+                return words[1].strip()
+            return default
+    return default
@@ -0,0 +1,322 @@
+"""Fitting the redshifts of many clusters at once.
+
+fit_z only does a handful of numpy operations on each cluster, which is quick for one cluster, but with thousands of
+small clusters most of the time goes to the Python around those operations. fit_clusters does the same fitting as
+fit_z, for a whole batch of clusters at once. The sources of all the clusters in a batch are put one after another in
+the same arrays (a ragged array), along with the index each cluster starts at. Each step of fit_z (the location cut,
+the initial redshift, the red sequence cuts, the chi-squared, and the best redshift and its errors) is then done for
+every cluster in the batch together, and the sums over each cluster's sources are done with np.add.reduceat on
+those starting indices.
+
+The results are set on the clusters just like fit_z sets them. The chi-squared values are added up in a different
+order than fit_z does, so they can be different in the last few digits. Nothing is plotted.
+"""
+import numpy as np
+from PhotoZ import Cluster
+from PhotoZ import fit_cache
+from PhotoZ import centering
+from PhotoZ import implied_redshift
+
+# Most sources put into one batch. A few arrays of (number of redshifts) x (sources in the batch) are made, so this
+# keeps them to tens of MB.
+batch_sources = 20000
+
+
+def fit_clusters(cluster_list, color, use_cache=True, max_sources=None):
+    """Find the redshift of many clusters, like running fit_z on each of them.
+
+    :param cluster_list: list of Cluster objects
+    :param color: color to fit, like "sloan_r-sloan_z"
+    :param use_cache: Whether to look for each fit in the fit cache first, and save the new ones there. See fit_z.
+    :param max_sources: most sources to fit at once. Clusters are never split, so a batch can have more if one
+                        cluster does. Defaults to batch_sources.
+    :return: None, but rs_z and the errors are set on each cluster, and the RS membership on its sources.
+    """
+    if max_sources is None:
+        max_sources = batch_sources
+
+    to_fit = []
+    for cluster in cluster_list:
+        key = None
+        if use_cache:
+            key = fit_cache.make_key(cluster, color)
+            if fit_cache.load(cluster, color, key):
+                print cluster, color, cluster.rs_z.get(color), "(from the fit cache)"
+                continue
+        # there's nothing to fit in a cluster without sources
+        if len(cluster.sources_list) > 0:
+            to_fit.append((cluster, key))
+
+    for batch in _make_batches(to_fit, max_sources):
+        _fit_batch([cluster for cluster, key in batch], color)
+        for cluster, key in batch:
+            if key is not None:
+                fit_cache.store(cluster, color, key)
+
+
+def pick_initial_redshifts(counts):
+    """Pick the initial redshift from the number of galaxies near the red sequence at each redshift, like
+    Cluster._find_initial_redshift does.
+
+    :param counts: array of the counts, with dimensions of [redshifts, clusters]. There must be at least 7 redshifts.
+    :return: array of the index of the initial redshift of each cluster, or -1 where all the counts are 0.
+    """
+    # the number at each redshift, with the 3 neighbors on each side
+    cumulative_counts = np.concatenate([np.zeros((1, counts.shape[1]), dtype=int), np.cumsum(counts, axis=0)])
+    neighbor_sums = cumulative_counts[7:] - cumulative_counts[:-7]
+    # argmax gives the first of any ties, like the loop in _find_initial_redshift
+    return np.where(neighbor_sums.max(axis=0) > 0, np.argmax(neighbor_sums, axis=0) + 3, -1)
+
+
+def stats_from_chi(redshifts, chi_values):
+    """Cluster._get_stats_from_chi for many chi-squared curves at once.
+
+    Where the parabola through the crossing has both of its roots between the two grid points, the one closest to
+    the best fit is used.
+
+    :param redshifts: array of the redshifts the chi-squared values are at.
+    :param chi_values: array of chi-squared values, with dimensions of [curves, redshifts]
+    :return: arrays of the best redshift, the lower error, and the upper error of each curve.
+    """
+    chi_values = np.where(np.isnan(chi_values), np.inf, chi_values)
+    rows = np.arange(len(chi_values))
+    n_redshifts = len(redshifts)
+    best_index = np.argmin(chi_values, axis=1)
+    best_z, best_chi = redshifts[best_index], chi_values[rows, best_index]
+
+    # the parabola through the lowest point and its neighbors, where it has both neighbors
+    before, after = np.maximum(best_index - 1, 0), np.minimum(best_index + 1, n_redshifts - 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a, b, c = _parabola(redshifts[before] - best_z, chi_values[rows, before],
+                            redshifts[after] - best_z, chi_values[rows, after], best_chi)
+        use_parabola = ((best_index > 0) & (best_index < n_redshifts - 1) & np.isfinite(best_chi) &
+                        np.isfinite(chi_values[rows, before]) & np.isfinite(chi_values[rows, after]) & (a > 0))
+        best_z = np.where(use_parabola, best_z - b / (2 * a), best_z)
+        best_chi = np.where(use_parabola, c - b**2 / (4 * a), best_chi)
+
+    threshold = best_chi + 1.0
+    within_one_sigma = chi_values < threshold[:, np.newaxis]
+    first_within = np.argmax(within_one_sigma, axis=1)
+    last_within = n_redshifts - 1 - np.argmax(within_one_sigma[:, ::-1], axis=1)
+    left_limit = _find_chi_crossings(redshifts, chi_values, threshold, first_within, -1)
+    right_limit = _find_chi_crossings(redshifts, chi_values, threshold, last_within, 1)
+    return best_z, best_z - left_limit, right_limit - best_z
+
+
+def _make_batches(to_fit, max_sources):
+    """Split a list of (cluster, cache key) into lists that have at most max_sources sources, unless one cluster
+    has more than that on its own.
+    """
+    batches = [[]]
+    n_sources = 0
+    for cluster, key in to_fit:
+        if batches[-1] and n_sources + len(cluster.sources_list) > max_sources:
+            batches.append([])
+            n_sources = 0
+        batches[-1].append((cluster, key))
+        n_sources += len(cluster.sources_list)
+    return [batch for batch in batches if batch]
+
+
+def _fit_batch(clusters, color):
+    """Does all of fit_z for a list of clusters at once. None of them can be empty."""
+    band = color.split("-")[1]
+    redshift_axis = Cluster.Cluster.redshift_axis
+    lines = Cluster.Cluster._get_model_lines(color)
+
+    # The ragged array: every cluster's sources, one cluster after the other. starts is where each cluster begins,
+    # and segment is which cluster each source is in.
+    sizes = np.array([len(cluster.sources_list) for cluster in clusters])
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    segment = np.repeat(np.arange(len(clusters)), sizes)
+    sources = [source for cluster in clusters for source in cluster.sources_list]
+    mags = np.concatenate([cluster.get_mags(band).values for cluster in clusters])
+    colors = [cluster.get_colors(color) for cluster in clusters]
+    color_values = np.concatenate([measurements.values for measurements in colors])
+    color_errors = np.concatenate([measurements.errors for measurements in colors])
+    data = (mags, color_values, color_errors)
+
+    # which sources could be on the red sequence at any redshift, which the centers are found with
+    could_be_members = _red_sequence_cut([line[:, np.newaxis] for line in lines], data,
+                                         np.ones(len(sources), dtype=bool), Cluster.Cluster.initial_cuts)[1]
+    in_location = _find_location_cuts(clusters, sources, starts, sizes, could_be_members.any(axis=0))
+    best_z = _find_initial_redshifts(color, lines, data, in_location, starts, segment)
+    best_z[best_z < 0] = redshift_axis.index("0.5")
+
+    # What fit_z leaves on the sources, which for each cluster is from the last cut it did.
+    final_residuals = np.empty(len(sources))
+    final_members = np.zeros(len(sources), dtype=bool)
+    best_redshift, lower_errors, upper_errors = [np.zeros(len(clusters)) for _ in range(3)]
+    fitting = np.ones(len(clusters), dtype=bool)
+    for bluer_cut, redder_cut in zip(Cluster.Cluster.bluer_color_cuts, Cluster.Cluster.redder_color_cuts):
+        residuals, members = _red_sequence_cut([line[best_z[segment]] for line in lines], data, in_location,
+                                               (bluer_cut, redder_cut, Cluster.Cluster.brighter_mag_cut,
+                                                Cluster.Cluster.dimmer_mag_cut))
+        n_members = np.add.reduceat(members, starts, dtype=int)
+
+        # fit_z stops on clusters that don't have enough sources, and doesn't give them a redshift
+        stopping = fitting & (n_members < 3)
+        stopping_sources = stopping[segment]
+        final_residuals[stopping_sources] = residuals[stopping_sources]
+        final_members[stopping_sources] = members[stopping_sources]
+        fitting &= ~stopping
+        if not fitting.any():
+            break
+
+        sample = members & fitting[segment]
+        sample_sizes = n_members[fitting]
+        chi_values = _chi_square(lines, [column[sample] for column in data],
+                                 np.concatenate([[0], np.cumsum(sample_sizes)[:-1]]), sample_sizes)
+        best_redshift[fitting], lower_errors[fitting], upper_errors[fitting] = \
+            stats_from_chi(redshift_axis.redshifts, chi_values)
+        # the best redshift can be between grid points, but the cuts are done at the closest one
+        best_z[fitting] = [redshift_axis.nearest(redshift) for redshift in best_redshift[fitting]]
+
+    # the final RS cut, which is done on all the sources, not just the ones in the location cut
+    fitted_sources = fitting[segment]
+    residuals, members = _red_sequence_cut([line[best_z[segment]] for line in lines], data,
+                                           np.ones(len(sources), dtype=bool), Cluster.Cluster.final_cuts)
+    final_residuals[fitted_sources] = residuals[fitted_sources]
+    final_members[fitted_sources] = members[fitted_sources]
+
+    for source, residual, is_member in zip(sources, final_residuals.tolist(), final_members.tolist()):
+        source.color_residual = residual
+        source.RS_member = is_member
+    for i, cluster in enumerate(clusters):
+        if fitting[i]:
+            cluster.rs_z[color] = str(round(float(best_redshift[i]), 3))
+            cluster.upper_photo_z_error[color] = float(upper_errors[i])
+            cluster.lower_photo_z_error[color] = float(lower_errors[i])
+            print cluster, color, cluster.rs_z[color]
+
+
+def _find_location_cuts(clusters, sources, starts, sizes, weights):
+    """Cluster._find_location_cut on every cluster at once, leaving out the same clusters fit_z does.
+
+    :param weights: boolean array of which sources could be on the red sequence, like Cluster._provisional_rs_mask.
+                    The centers are found with these.
+    :return: boolean array of which sources are in the location cut. This is also set on the sources.
+    """
+    ras = np.array([source.ra for source in sources])
+    decs = np.array([source.dec for source in sources])
+    in_location = np.array([source.in_location for source in sources], dtype=bool)
+
+    # Each center needs its own histogram, but the distances are all done at once.
+    centers = []
+    for cluster, start, size in zip(clusters, starts, sizes):
+        if cluster.center is not None:
+            centers.append(cluster.center)
+        else:
+            centers.append(centering.find_sky_density_peak(ras[start:start + size], decs[start:start + size],
+                                                           weights[start:start + size], cluster.center_bin_size,
+                                                           cluster.center_smoothing))
+    center_ras, center_decs = [np.repeat(column, sizes) for column in zip(*centers)]
+    radii = np.repeat([cluster.location_cut_radius for cluster in clusters], sizes)
+    inside = centering.angular_separation(ras, decs, center_ras, center_decs) < radii
+
+    cut = np.repeat([cluster._has_location_cut() for cluster in clusters], sizes)
+    in_location[cut] = inside[cut]
+    for source, in_cut, is_in in zip(sources, cut.tolist(), in_location.tolist()):
+        if in_cut:
+            source.in_location = is_in
+    return in_location
+
+
+def _find_initial_redshifts(color, lines, data, in_location, starts, segment):
+    """Cluster._find_initial_redshift on every cluster at once.
+
+    :return: array of the index of the initial redshift of each cluster, or -1 where there aren't any galaxies near
+             the red sequence at any redshift (or there are too few redshifts to count the neighbors).
+    """
+    if len(lines[0]) < 7:
+        return -np.ones(len(starts), dtype=int)
+    if Cluster.Cluster.fast_initial_redshift:
+        return pick_initial_redshifts(implied_redshift.count_near_red_sequence(color, lines, data[0], data[1],
+                                                                               data[2], in_location,
+                                                                               Cluster.Cluster.initial_cuts,
+                                                                               segment, len(starts)))
+    # every redshift at once, so these have dimensions of [redshifts, sources]
+    near_line = _red_sequence_cut([line[:, np.newaxis] for line in lines], data, in_location,
+                                  Cluster.Cluster.initial_cuts)[1]
+    return pick_initial_redshifts(np.add.reduceat(near_line, starts, axis=1, dtype=int))
+
+
+def _red_sequence_cut(lines, data, in_sample, cuts):
+    """Cluster._set_residuals and Cluster._rs_member_mask for every source at once, without setting anything.
+
+    :param lines: color zeropoints, slopes, and pivot magnitudes of the model line each source is compared to. They
+                  are broadcast against the sources, so they can be one per source, or have an extra first dimension
+                  for comparing to every redshift.
+    :param in_sample: boolean array of which sources can be members
+    :param cuts: bluer color, redder color, brighter mag, and fainter mag cuts, like in fit_z
+    :return: arrays of the color residuals and which sources pass the cuts
+    """
+    zeropoints, slopes, pivot_mags = lines
+    mags, colors, color_errors = data
+    bluer_cut, redder_cut, bright_cut, faint_cut = cuts
+
+    residuals = colors - (zeropoints + slopes * (mags - pivot_mags))
+    residuals[np.isnan(residuals)] = 999
+    with np.errstate(invalid="ignore"):
+        members = (in_sample & (color_errors <= 0.2) &
+                   (mags > pivot_mags + bright_cut) & (mags < pivot_mags + faint_cut) &
+                   (bluer_cut < residuals) & (residuals < redder_cut))
+    return residuals, members
+
+
+def _chi_square(lines, sample, starts, sizes):
+    """predictions.chi_square_grid for the samples of many clusters at once.
+
+    :param sample: magnitudes, colors, and color errors of the sources in every cluster's sample, one cluster after
+                   the other.
+    :param starts: where each cluster's sample starts. None of them can be empty.
+    :param sizes: how many sources are in each cluster's sample
+    :return: array of reduced chi-squared values, with dimensions of [clusters, redshifts].
+    """
+    zeropoints, slopes, pivot_mags = [line[:, np.newaxis] for line in lines]
+    mags, colors, color_errors = sample
+    model_colors = zeropoints + slopes * (mags - pivot_mags)
+    chi_sq = np.add.reduceat(((model_colors - colors) / color_errors)**2, starts, axis=1)
+    return (chi_sq / (sizes - 1 - 1)).T
+
+
+def _find_chi_crossings(redshifts, chi_values, threshold, last_within, direction):
+    """Cluster._find_chi_crossing for many chi-squared curves at once. See there for the parameters, which are
+    arrays with one entry per curve here.
+    """
+    rows = np.arange(len(chi_values))
+    n_redshifts = len(redshifts)
+    outside = np.clip(last_within + direction, 0, n_redshifts - 1)
+    inner = np.clip(last_within - direction, 0, n_redshifts - 1)
+    has_outside = (last_within + direction == outside) & np.isfinite(chi_values[rows, outside])
+    has_inner = (last_within - direction == inner) & np.isfinite(chi_values[rows, inner])
+
+    # work relative to the last point inside, so the crossing is between 0 and the distance to the next point
+    start = redshifts[last_within]
+    distance = redshifts[outside] - start
+    inside_chi, outside_chi = chi_values[rows, last_within], chi_values[rows, outside]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a, b, c = _parabola(redshifts[inner] - start, chi_values[rows, inner] - threshold,
+                            distance, outside_chi - threshold, inside_chi - threshold)
+        # the roots of the parabola, in a way that also works when it's almost a straight line
+        q = -0.5 * (b + np.copysign(np.sqrt(b**2 - 4 * a * c), b))
+        roots = np.array([q / a, c / q])
+        in_between = (roots / distance >= 0) & (roots / distance <= 1)
+        roots = np.where(in_between, roots, np.inf)
+        root = roots[np.argmin(np.abs(roots), axis=0), rows]
+        linear = (threshold - inside_chi) / (outside_chi - inside_chi) * distance
+
+    crossing = np.where(has_inner & np.isfinite(root), root, linear)
+    # where it goes off the edge of the grid, the error goes to the edge
+    return start + np.where(has_outside, crossing, 0.0)
+
+
+def _parabola(x_1, y_1, x_2, y_2, y_0):
+    """The coefficients a, b, c of the parabola a*x**2 + b*x + c through (0, y_0), (x_1, y_1), and (x_2, y_2).
+
+    Works on arrays, for many parabolas at once.
+    """
+    slope_1 = (y_1 - y_0) / x_1
+    slope_2 = (y_2 - y_0) / x_2
+    a = (slope_1 - slope_2) / (x_1 - x_2)
+    return a, slope_1 - a * x_1, y_0
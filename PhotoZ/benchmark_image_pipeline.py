@@ -0,0 +1,309 @@
+"""Benchmark for the part of the pipeline that starts from images (START_WITH = 0 in main_from_images).
+
+Makes synthetic r and z images of fake clusters, with stars and galaxies injected at known positions and
+magnitudes, then runs SExtractor.sextractor_main on them and times each stage. Neither SExtractor nor SDSS is
+needed:
+    - A stub SExtractor executable is written that makes correctly formatted catalogs from the known sources,
+      so the "sextractor" backend can be timed without scisoft. The "numpy" backend runs the real detection.
+    - The SDSS query is replaced by a local reference catalog made from the injected stars.
+
+Run it from the command line, like:
+    python -m PhotoZ.benchmark_image_pipeline --clusters 4 --sources 2000 --backend numpy --processes 2
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import re
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+from PhotoZ import global_paths
+from PhotoZ import fits_index
+from PhotoZ import SExtractor
+from PhotoZ import sdss_calibration
+from PhotoZ import catalog
+from PhotoZ import functions
+
+# The zeropoint in the fake .sex file, and the one the images are made with. The stub SExtractor makes its
+# magnitudes wrong by a known amount, so the calibration has something to do.
+config_zeropoint = 30.0
+pixel_scale = 0.08  # arcseconds per pixel, about what Gemini has
+
+# The .sex file used for both backends.
+sex_file_text = """MAG_ZEROPOINT    {:.1f}
+DETECT_THRESH    1.5
+DETECT_MINAREA   5
+PHOT_APERTURES   10
+BACK_SIZE        64
+SATUR_LEVEL      50000.0
+GAIN             0.0
+""".format(config_zeropoint)
+
+# This is the whole stub SExtractor. It gets called with the same arguments as the real one:
+#     sex detection.fits measurement.fits -c file.sex -CATALOG_NAME cat -MAG_ZEROPOINT zp -SEEING_FWHM fwhm
+# and writes a catalog in the same format, using the truth file that sits next to each image.
+stub_sextractor_text = '''#!{python}
+import sys
+arguments = sys.argv[1:]
+detection_image, measurement_image = arguments[0], arguments[1]
+options = dict(zip(arguments[2::2], arguments[3::2]))
+zeropoint = float(options["-MAG_ZEROPOINT"])
+config_zeropoint = [float(line.split()[1]) for line in open(options["-c"]) if line.startswith("MAG_ZEROPOINT")][0]
+
+truth_file = open(measurement_image.replace(".fits", ".truth"))
+offset = float(truth_file.readline().split()[-1])
+rows = [line.split() for line in truth_file if not line.startswith("#")]
+truth_file.close()
+
+catalog = open(options["-CATALOG_NAME"], "w")
+for number, name in enumerate(["NUMBER", "ALPHA_J2000", "DELTA_J2000", "MAG_APER", "MAGERR_APER", "FWHM_IMAGE",
+                               "FLAGS", "CLASS_STAR"]):
+    catalog.write("#{{:4d}} {{}}\\n".format(number + 1, name))
+for number, (ra, dec, mag, is_star) in enumerate(rows):
+    measured_mag = float(mag) + (zeropoint - config_zeropoint) + offset
+    catalog.write("{{:10d}} {{:15.7f}} {{:15.7f}} {{:10.4f}} {{:10.4f}} {{:10.3f}} {{:4d}} {{:6.3f}}\\n".format(
+        number + 1, float(ra), float(dec), measured_mag, 0.01 + 0.002 * max(float(mag) - 18.0, 0.0),
+        3.0 if is_star == "1" else 6.0, 0, 0.98 if is_star == "1" else 0.03))
+catalog.close()
+'''
+
+
+class LocalReferenceSource(object):
+    """Stands in for the SDSS query in sdss_calibration. Returns the injected stars in the area asked for, as
+    the same comma separated text SDSS sends back.
+    """
+
+    def __init__(self):
+        self.stars = []  # list of (ra, dec, r, z)
+
+    def add_stars(self, ras, decs, r_mags, z_mags):
+        self.stars.extend(zip(ras, decs, r_mags, z_mags))
+
+    def __call__(self, command):
+        # pull the coordinate limits out of the SQL command
+        limits = [float(x) for x in re.findall(r"between (\S+) and (\S+)", command)[0] +
+                  re.findall(r"between (\S+) and (\S+)", command)[1]]
+        min_ra, max_ra, min_dec, max_dec = limits
+        lines = ["#Table1", "ra,dec,u,g,r,i,z"]
+        for ra, dec, r, z in self.stars:
+            if min_ra < ra < max_ra and min_dec < dec < max_dec and 17.0 < min(r, z) < 20.5:
+                lines.append("{:.7f},{:.7f},0,0,{:.4f},0,{:.4f}".format(ra, dec, r, z))
+        if len(lines) == 2:
+            return "No objects have been found"
+        return "\n".join(lines)
+
+
+class StageTimer(object):
+    """Times functions by temporarily replacing them on their module with a wrapper that records how long each
+    call takes. Since the pipeline looks functions up on their modules when it calls them, the wrappers get used
+    without changing any of the pipeline code.
+    """
+
+    def __init__(self):
+        self.totals = dict()
+        self.calls = dict()
+        self._originals = []
+
+    def wrap(self, module, function_name, stage_name=None):
+        if stage_name is None:
+            stage_name = module.__name__.split(".")[-1] + "." + function_name
+        original = getattr(module, function_name)
+        self._originals.append((module, function_name, original))
+        self.totals[stage_name] = 0.0
+        self.calls[stage_name] = 0
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.totals[stage_name] += time.time() - start
+                self.calls[stage_name] += 1
+        setattr(module, function_name, timed)
+
+    def restore(self):
+        for module, function_name, original in reversed(self._originals):
+            setattr(module, function_name, original)
+        self._originals = []
+
+    def report(self):
+        lines = ["{:45s} {:>7s} {:>10s} {:>10s}".format("stage", "calls", "total [s]", "mean [s]")]
+        for stage in sorted(self.totals, key=lambda s: -self.totals[s]):
+            calls = self.calls[stage]
+            mean = self.totals[stage] / calls if calls else 0.0
+            lines.append("{:45s} {:7d} {:10.3f} {:10.4f}".format(stage, calls, self.totals[stage], mean))
+        return "\n".join(lines)
+
+
+def make_synthetic_cluster(directory, index, n_sources, image_size, reference_source, fwhm=0.7, seed=0):
+    """Make the r and z images for one fake cluster, with their truth files.
+
+    A third of the sources are stars, spread in magnitude so some of them are good calibration stars. The rest are
+    galaxies, which are bigger and a little elongated, with red r-z colors for the cluster members.
+
+    :param directory: where the images go
+    :param index: number of the cluster. Sets its name and position on the sky.
+    :param n_sources: how many sources to inject
+    :param image_size: width of the (square) images, in pixels
+    :param reference_source: LocalReferenceSource the stars are added to
+    :param fwhm: seeing, in arcseconds
+    :param seed: seed for the random numbers
+    :return: name of the cluster
+    """
+    random_state = np.random.RandomState(seed + index)
+    name = "MOO{:04d}+{:04d}".format(index, 1000 + index)
+    ra_center, dec_center = 10.0 + index, 5.0 + 0.1 * index
+
+    header = fits.Header()
+    header["CTYPE1"], header["CTYPE2"] = "RA---TAN", "DEC--TAN"
+    header["CRVAL1"], header["CRVAL2"] = ra_center, dec_center
+    header["CRPIX1"], header["CRPIX2"] = image_size / 2.0, image_size / 2.0
+    header["CD1_1"], header["CD2_2"] = -pixel_scale / 3600.0, pixel_scale / 3600.0
+    header["CD1_2"], header["CD2_1"] = 0.0, 0.0
+    header["SATURATE"] = 50000.0
+    header["EXPTIME"] = 300.0
+    header["FWHMPSF"] = fwhm
+    image_wcs = wcs.WCS(header)
+
+    n_stars = n_sources // 3
+    ys = random_state.uniform(10, image_size - 10, n_sources)
+    xs = random_state.uniform(10, image_size - 10, n_sources)
+    is_star = np.arange(n_sources) < n_stars
+    z_mags = np.where(is_star, random_state.uniform(16.5, 23.0, n_sources), random_state.uniform(19.0, 24.0,
+                                                                                                  n_sources))
+    r_mags = z_mags + np.where(is_star, random_state.uniform(0.0, 1.5, n_sources),
+                               random_state.uniform(0.5, 2.8, n_sources))
+    sizes = np.where(is_star, fwhm / pixel_scale / 2.3548, random_state.uniform(4.0, 8.0, n_sources))
+    axis_ratios = np.where(is_star, 1.0, random_state.uniform(0.5, 1.0, n_sources))
+    ras, decs = image_wcs.all_pix2world(xs, ys, 0)
+
+    for band, mags in [("r", r_mags), ("z", z_mags)]:
+        image = random_state.normal(100.0, 5.0, (image_size, image_size)).astype(np.float32)
+        fluxes = 10**(-0.4 * (mags - config_zeropoint))
+        half = 15
+        stamp_y, stamp_x = np.mgrid[-half:half + 1, -half:half + 1]
+        for i in range(n_sources):
+            center_y, center_x = int(ys[i]), int(xs[i])
+            dy = stamp_y - (ys[i] - center_y)
+            dx = stamp_x - (xs[i] - center_x)
+            profile = np.exp(-(dx**2 + (dy / axis_ratios[i])**2) / (2 * sizes[i]**2))
+            profile *= fluxes[i] / profile.sum()
+            # clip the stamp to the image
+            y0, y1 = max(center_y - half, 0), min(center_y + half + 1, image_size)
+            x0, x1 = max(center_x - half, 0), min(center_x + half + 1, image_size)
+            image[y0:y1, x0:x1] += profile[y0 - center_y + half:y1 - center_y + half,
+                                           x0 - center_x + half:x1 - center_x + half]
+        image_path = os.path.join(directory, name + "_" + band + ".fits")
+        fits.PrimaryHDU(image, header=header).writeto(image_path, overwrite=True)
+
+        # The truth file, for the stub SExtractor. The first line has the zeropoint error it should add.
+        truth = open(image_path.replace(".fits", ".truth"), "w")
+        truth.write("# zeropoint_offset {:.3f}\n".format(random_state.uniform(-0.4, 0.4)))
+        for i in range(n_sources):
+            truth.write("{:.7f} {:.7f} {:.4f} {:d}\n".format(ras[i], decs[i], mags[i], int(is_star[i])))
+        truth.close()
+
+    reference_source.add_stars(ras[is_star], decs[is_star], r_mags[is_star], z_mags[is_star])
+    return name
+
+
+def run_benchmark(n_clusters, n_sources, image_size=2048, backend="numpy", processes=1, work_directory=None):
+    """Make the synthetic data, run sextractor_main on it, and time every stage.
+
+    All the paths in global_paths that the image stage uses are pointed at a temporary directory while this runs,
+    and put back afterwards.
+
+    :param n_clusters: how many fake clusters to make
+    :param n_sources: how many sources in each cluster's images
+    :param image_size: width of the images, in pixels
+    :param backend: "sextractor" (uses the stub) or "numpy"
+    :param processes: how many processes the image tiles are spread over
+    :param work_directory: where to put everything. If not given, a temporary directory is made and deleted after.
+    :return: StageTimer holding the results
+    """
+    delete_after = work_directory is None
+    if work_directory is None:
+        work_directory = tempfile.mkdtemp(prefix="photoz_benchmark_")
+    images_directory = os.path.join(work_directory, "images") + "/"
+    for directory in [images_directory, os.path.join(work_directory, "catalogs"),
+                      os.path.join(work_directory, "sdss"), os.path.join(work_directory, "sextractor")]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    sex_file = os.path.join(work_directory, "sextractor", "benchmark.sex")
+    open(sex_file, "w").write(sex_file_text)
+    stub_path = os.path.join(work_directory, "sextractor", "sex")
+    open(stub_path, "w").write(stub_sextractor_text.format(python=sys.executable))
+    os.chmod(stub_path, 0o755)
+
+    print "Making images for {} clusters with {} sources each".format(n_clusters, n_sources)
+    reference_source = LocalReferenceSource()
+    start = time.time()
+    for i in range(n_clusters):
+        make_synthetic_cluster(images_directory, i, n_sources, image_size, reference_source)
+    print "Made images in {:.2f} seconds\n".format(time.time() - start)
+
+    saved_paths = {name: getattr(global_paths, name) for name in
+                   ["images_directory", "sextractor_params_directory", "gemini_config_file",
+                    "catalogs_save_directory", "calibration_catalogs_directory", "calibration_plots",
+                    "sextractor_executable", "fits_index"]}
+    saved_reference_source = sdss_calibration.reference_source
+    saved_index = fits_index._index
+    timer = StageTimer()
+    original_directory = os.getcwd()
+    try:
+        global_paths.images_directory = [images_directory]
+        global_paths.sextractor_params_directory = os.path.join(work_directory, "sextractor") + "/"
+        global_paths.gemini_config_file = sex_file
+        global_paths.catalogs_save_directory = os.path.join(work_directory, "catalogs") + "/"
+        global_paths.calibration_catalogs_directory = os.path.join(work_directory, "sdss") + "/"
+        global_paths.calibration_plots = os.path.join(work_directory, "calibration.pdf")
+        global_paths.sextractor_executable = stub_path
+        global_paths.fits_index = os.path.join(work_directory, "fits_index.json")
+        fits_index._index = None
+        sdss_calibration.reference_source = reference_source
+
+        for module, function_name in [(SExtractor, "sextractor_main"), (SExtractor, "_group_images"),
+                                      (SExtractor, "_find_r_and_z_images"), (SExtractor, "_create_catalogs"),
+                                      (SExtractor, "get_fwhm"), (SExtractor, "_run_source_detection"),
+                                      (catalog, "read_catalog"), (sdss_calibration, "make_sdss_catalog"),
+                                      (sdss_calibration, "sdss_calibration"), (sdss_calibration, "find_match"),
+                                      (functions, "save_as_one_pdf")]:
+            timer.wrap(module, function_name)
+
+        start = time.time()
+        image_list = fits_index.get_index().scan(global_paths.images_directory)
+        timer.totals["fits_index.scan"] = time.time() - start
+        timer.calls["fits_index.scan"] = 1
+
+        SExtractor.sextractor_main(image_list, backend, processes)
+    finally:
+        timer.restore()
+        sdss_calibration.reference_source = saved_reference_source
+        fits_index._index = saved_index
+        for name, value in saved_paths.items():
+            setattr(global_paths, name, value)
+        os.chdir(original_directory)  # _run_sextractor changes directories
+        if delete_after:
+            shutil.rmtree(work_directory)
+
+    return timer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the image stage of the pipeline on synthetic data.")
+    parser.add_argument("--clusters", type=int, default=2, help="number of fake clusters")
+    parser.add_argument("--sources", type=int, default=1000, help="number of sources in each cluster")
+    parser.add_argument("--size", type=int, default=2048, help="width of the images, in pixels")
+    parser.add_argument("--backend", default="numpy", choices=["numpy", "sextractor"],
+                        help="numpy runs the real detection, sextractor runs the stub SExtractor executable")
+    parser.add_argument("--processes", type=int, default=1, help="processes the image tiles are spread over")
+    parser.add_argument("--keep", default=None, help="directory to do everything in and keep afterwards")
+    arguments = parser.parse_args()
+
+    results = run_benchmark(arguments.clusters, arguments.sources, arguments.size, arguments.backend,
+                            arguments.processes, arguments.keep)
+    print results.report()
@@ -0,0 +1,203 @@
+"""Benchmark of how much memory the sources of a cluster take up.
+
+Makes a fake cluster's worth of sources the way read_in_catalogs does (r and z magnitudes, added one band at a
+time, with a magnitude residual on some of them like sdss_calibration leaves behind), and reports the bytes per
+source for:
+    - legacy: the layout Source had before it used slots: an attribute dictionary on every source and every data
+      object, and a dictionary for each of mags, colors, and mag_residuals. It is rebuilt here, since it isn't in
+      other_classes anymore.
+    - slots: the current Source, with slots and BandData.
+    - arrays: the MeasurementArrays Cluster.get_mags makes, for comparison with keeping no per-source objects at all.
+
+Each layout is measured two ways. "objects" adds up sys.getsizeof of everything the sources hold, not counting
+things shared between sources (like band names). "resident" is how much the resident memory of a fresh process
+goes up when the sources are made, which also includes what the memory allocator wastes.
+
+Run it from the command line, like:
+    python -m PhotoZ.benchmark_memory --sources 50000
+"""
+import sys
+import gc
+import argparse
+import resource
+import multiprocessing
+from array import array
+import numpy as np
+from PhotoZ import other_classes
+
+
+class _LegacyData(object):
+    """data, the way it was before slots."""
+    def __init__(self, value, error):
+        self.value = value
+        self.error = error
+
+
+class _LegacySource(object):
+    """Source, the way it was before slots. Only the parts that take up memory are here."""
+    def __init__(self, ra, dec, mag_bands, mags, mag_errors, r_id=None, z_id=None):
+        self.ra = float(ra)
+        self.dec = float(dec)
+        self.mags = dict()
+        self.mag_residuals = dict()
+        self.colors = dict()
+        self.r_id = r_id
+        self.z_id = z_id
+        self.in_location = True
+        for i in range(len(mag_bands)):
+            self.mags[mag_bands[i]] = _LegacyData(mags[i], mag_errors[i])
+        self.RS_member = False
+
+    def add_band_data(self, mag_band, mag, mag_error):
+        self.mags[mag_band] = _LegacyData(mag, mag_error)
+
+    def find_mag_residual(self, band, comparison_mag):
+        self.mag_residuals[band] = _LegacyData(comparison_mag - self.mags[band].value, self.mags[band].error)
+
+
+layouts = {"legacy": _LegacySource, "slots": other_classes.Source}
+
+
+def make_sources(source_class, n_sources, seed=0):
+    """Make sources like read_in_catalogs does for a cluster with SExtractor catalogs in r and z.
+
+    :param source_class: Source, or _LegacySource
+    :param n_sources: how many to make
+    :param seed: seed for the random numbers, so every layout gets the same sources
+    :return: list of sources
+    """
+    random = np.random.RandomState(seed)
+    ras = random.uniform(150.0, 150.1, n_sources).tolist()
+    decs = random.uniform(2.0, 2.1, n_sources).tolist()
+    z_mags = random.uniform(18.0, 25.0, n_sources).tolist()
+    colors = random.normal(1.5, 0.3, n_sources).tolist()
+
+    sources = []
+    for i in range(n_sources):
+        source = source_class(ras[i], decs[i], ["sloan_r"], [z_mags[i] + colors[i]], [0.02], r_id=i + 1)
+        source.z_id = i + 1
+        source.add_band_data("sloan_z", z_mags[i], 0.03)
+        # about one in ten are matched to SDSS stars during calibration
+        if i % 10 == 0:
+            source.find_mag_residual("sloan_r", z_mags[i] + colors[i] + 0.1)
+        sources.append(source)
+    return sources
+
+
+def make_arrays(n_sources, seed=0):
+    """Make the same data as make_sources, but as the MeasurementArrays a cluster keeps for its magnitudes."""
+    sources = make_sources(other_classes.Source, n_sources, seed)
+    bands = ["sloan_r", "sloan_z"]
+    return [other_classes.MeasurementArray.from_data([source.mags.get(band) for source in sources])
+            for band in bands]
+
+
+def deep_size(thing, seen):
+    """Add up the size of an object and everything it holds that hasn't been counted already.
+
+    :param thing: object to measure
+    :param seen: set of the ids of objects already counted. Shared between calls so shared objects count once.
+    :return: size in bytes
+    """
+    if id(thing) in seen or isinstance(thing, type):
+        return 0
+    seen.add(id(thing))
+    size = sys.getsizeof(thing)
+
+    if isinstance(thing, np.ndarray):
+        if thing.base is not None:
+            size += deep_size(thing.base, seen)
+        return size
+    if isinstance(thing, (str, unicode, int, long, float, bool, array)) or thing is None:
+        return size
+    if isinstance(thing, dict):
+        return size + sum(deep_size(key, seen) + deep_size(value, seen) for key, value in thing.items())
+    if isinstance(thing, (list, tuple, set)):
+        return size + sum(deep_size(item, seen) for item in thing)
+
+    if hasattr(thing, "__dict__"):
+        size += deep_size(thing.__dict__, seen)
+    for klass in type(thing).__mro__:
+        for name in klass.__dict__.get("__slots__", ()):
+            if hasattr(thing, name):
+                size += deep_size(getattr(thing, name), seen)
+    return size
+
+
+def _make_layout(layout, n_sources):
+    if layout == "arrays":
+        return make_arrays(n_sources)
+    return make_sources(layouts[layout], n_sources)
+
+
+def measure_objects(layout, n_sources):
+    """Bytes per source held by the objects of a layout.
+
+    Band names and the other strings the sources share are counted once for everything, not per source.
+    """
+    things = _make_layout(layout, n_sources)
+    # count the list holding everything separately, since the layouts don't all have one list of sources
+    seen = {id(things)}
+    return sum(deep_size(thing, seen) for thing in things) / float(n_sources)
+
+
+def _resident_growth(arguments):
+    """Run in a fresh process: how many bytes the resident memory goes up by when the sources are made."""
+    layout, n_sources = arguments
+    gc.collect()
+    # ru_maxrss is the peak, in kilobytes on Linux. Nothing else is using memory here, so the growth of the peak is
+    # the memory the sources take.
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    things = _make_layout(layout, n_sources)
+    gc.collect()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del things
+    return (after - before) * 1024.0
+
+
+def measure_resident(layout, n_sources):
+    """Bytes per source the resident memory goes up by when making them in a fresh process.
+
+    This includes anything made temporarily while making the sources, so it's an upper limit.
+    """
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    growth = pool.map(_resident_growth, [(layout, n_sources)])[0]
+    pool.close()
+    pool.join()
+    return growth / n_sources
+
+
+def run_benchmark(n_sources, resident=True):
+    """Measure every layout.
+
+    :param n_sources: how many sources to make
+    :param resident: whether to also measure the resident memory, which needs a new process for each layout.
+    :return: list of (layout, bytes per source from the objects, bytes per source from resident memory). The last
+             one is None if it wasn't measured.
+    """
+    results = []
+    for layout in ["legacy", "slots", "arrays"]:
+        objects = measure_objects(layout, n_sources)
+        results.append((layout, objects, measure_resident(layout, n_sources) if resident else None))
+    return results
+
+
+def report(results):
+    """Make a table of the results of run_benchmark."""
+    legacy = results[0][1]
+    lines = ["{:10s} {:>16s} {:>18s} {:>14s}".format("layout", "objects [B/src]", "resident [B/src]",
+                                                     "vs legacy")]
+    for layout, objects, resident in results:
+        resident = "{:18.0f}".format(resident) if resident is not None else "{:>18s}".format("-")
+        lines.append("{:10s} {:16.0f} {} {:13.1f}x".format(layout, objects, resident, legacy / objects))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the memory used per source by each way of storing them.")
+    parser.add_argument("--sources", type=int, default=50000, help="number of sources in the fake cluster")
+    parser.add_argument("--no-resident", action="store_true",
+                        help="only add up the objects, without measuring resident memory in new processes")
+    arguments = parser.parse_args()
+
+    print report(run_benchmark(arguments.sources, not arguments.no_resident))
@@ -0,0 +1,116 @@
+"""Finding the center of a cluster, and which sources are in an aperture around it.
+
+The center is the peak of the surface density of sources, which can be weighted (like by how likely each one is to
+be on the red sequence) so the cluster's red galaxies stand out against the field. The sources are put in a fine 2D
+histogram, it is smoothed with a Gaussian, and the highest bin is the rough peak. The center is then the weighted
+mean position of the sources within the smoothing length of that bin, so it isn't tied to the grid.
+
+On the sky, the positions are projected onto the plane tangent to the middle of the sources first, so the
+distances are right at any declination, and which sources are in an aperture comes from their true angular
+separation from the center.
+"""
+import numpy as np
+from scipy import ndimage
+
+
+def find_density_peak(xs, ys, weights=None, bin_size=0.2, smoothing=0.5):
+    """Find the highest point of the smoothed density of sources in a plane.
+
+    :param xs: array of the x positions of the sources
+    :param ys: array of the y positions, in the same units
+    :param weights: array of the weight of each source. Defaults to all the same. If they are all 0, all the sources
+                    are weighted the same instead.
+    :param bin_size: width of the bins of the histogram.
+    :param smoothing: sigma of the Gaussian the histogram is smoothed by, in the same units as the positions.
+    :return: x, y of the peak
+    """
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    if weights is None or not np.any(weights):
+        weights = np.ones(len(xs))
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # one bin past the sources on every side, so the peak can't be cut off by the edge
+    x_edges = np.arange(xs.min() - bin_size, xs.max() + 2 * bin_size, bin_size)
+    y_edges = np.arange(ys.min() - bin_size, ys.max() + 2 * bin_size, bin_size)
+    histogram = np.histogram2d(xs, ys, bins=[x_edges, y_edges], weights=weights)[0]
+    smoothed = ndimage.gaussian_filter(histogram, smoothing / bin_size, mode="constant")
+    x_bin, y_bin = np.unravel_index(np.argmax(smoothed), smoothed.shape)
+    peak_x, peak_y = x_edges[x_bin] + bin_size / 2.0, y_edges[y_bin] + bin_size / 2.0
+
+    near = ((xs - peak_x)**2 + (ys - peak_y)**2 < smoothing**2) & (weights > 0)
+    if np.any(near):
+        peak_x = np.average(xs[near], weights=weights[near])
+        peak_y = np.average(ys[near], weights=weights[near])
+    return peak_x, peak_y
+
+
+def find_sky_density_peak(ras, decs, weights=None, bin_size=0.2, smoothing=0.5):
+    """find_density_peak, for positions on the sky.
+
+    :param ras: array of the RA of the sources, in degrees
+    :param decs: array of the dec of the sources, in degrees
+    :param weights: array of the weight of each source. See find_density_peak.
+    :param bin_size: width of the bins of the histogram, in arcminutes.
+    :param smoothing: sigma of the smoothing, in arcminutes.
+    :return: RA, dec of the peak, in degrees
+    """
+    ras, decs = np.asarray(ras, dtype=np.float64), np.asarray(decs, dtype=np.float64)
+    # project around the middle of the sources. RAs are made relative to it first, in case they wrap around 360.
+    middle_dec = (decs.max() + decs.min()) / 2.0
+    relative_ras = (ras - ras[0] + 180.0) % 360.0 - 180.0
+    middle_ra = ras[0] + (relative_ras.max() + relative_ras.min()) / 2.0
+    xs, ys = _project(ras, decs, middle_ra, middle_dec)
+
+    peak_x, peak_y = find_density_peak(xs, ys, weights, bin_size, smoothing)
+    peak_ra, peak_dec = _deproject(peak_x, peak_y, middle_ra, middle_dec)
+    return float(peak_ra % 360.0), float(peak_dec)
+
+
+def angular_separation(ras, decs, ra, dec):
+    """Angle between each source and one point on the sky, with the haversine formula.
+
+    :param ras: array of the RA of the sources, in degrees
+    :param decs: array of the dec of the sources, in degrees
+    :param ra: RA of the point, in degrees
+    :param dec: dec of the point, in degrees
+    :return: array of the separations, in arcminutes
+    """
+    ras, decs, ra, dec = [np.radians(x) for x in [ras, decs, ra, dec]]
+    haversine = np.sin((decs - dec) / 2)**2 + np.cos(decs) * np.cos(dec) * np.sin((ras - ra) / 2)**2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.minimum(haversine, 1.0)))) * 60.0
+
+
+def in_apertures(ras, decs, center, radii):
+    """Find which sources are inside apertures of several sizes around a center, all at once.
+
+    :param ras: array of the RA of the sources, in degrees
+    :param decs: array of the dec of the sources, in degrees
+    :param center: RA, dec of the center, in degrees
+    :param radii: list of the radii of the apertures, in arcminutes
+    :return: boolean array with dimensions of [radii, sources]
+    """
+    separations = angular_separation(ras, decs, center[0], center[1])
+    return separations < np.asarray(radii, dtype=np.float64)[:, np.newaxis]
+
+
+def _project(ras, decs, center_ra, center_dec):
+    """Gnomonic projection onto the plane tangent to the sky at the center. Gives x, y in arcminutes."""
+    ras, decs, center_ra, center_dec = [np.radians(x) for x in [ras, decs, center_ra, center_dec]]
+    cos_c = np.sin(center_dec) * np.sin(decs) + np.cos(center_dec) * np.cos(decs) * np.cos(ras - center_ra)
+    xs = np.cos(decs) * np.sin(ras - center_ra) / cos_c
+    ys = (np.cos(center_dec) * np.sin(decs) - np.sin(center_dec) * np.cos(decs) * np.cos(ras - center_ra)) / cos_c
+    return np.degrees(xs) * 60.0, np.degrees(ys) * 60.0
+
+
+def _deproject(x, y, center_ra, center_dec):
+    """The opposite of _project."""
+    x, y = np.radians(x / 60.0), np.radians(y / 60.0)
+    center_ra, center_dec = np.radians(center_ra), np.radians(center_dec)
+    rho = np.hypot(x, y)
+    if rho == 0:
+        return np.degrees(center_ra), np.degrees(center_dec)
+    c = np.arctan(rho)
+    dec = np.arcsin(np.cos(c) * np.sin(center_dec) + y * np.sin(c) * np.cos(center_dec) / rho)
+    ra = center_ra + np.arctan2(x * np.sin(c), rho * np.cos(center_dec) * np.cos(c) -
+                                y * np.sin(center_dec) * np.sin(c))
+    return np.degrees(ra), np.degrees(dec)
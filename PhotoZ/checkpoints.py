@@ -0,0 +1,421 @@
+"""Saving and loading the cluster list between the stages of the pipeline.
+
+A checkpoint is a directory. Each cluster's sources are stored as columns (one array per attribute) in their own
+uncompressed .npz file, and a small index.json holds everything at the cluster level: name, spec z, bands, and the
+fitted redshifts. This means:
+    - Loading just the results (START_WITH = 3) only reads the index, not any of the sources.
+    - One cluster can be loaded without touching the others.
+    - Inside a cluster's file, numpy only reads the columns that are asked for.
+
+The columns in each .npz file are:
+    "ra", "dec", "r_id", "z_id", "in_location", "RS_member", "color_residual"
+    "mag:<band>:value", "mag:<band>:error"
+    "color:<color>:value", "color:<color>:error"
+    "mag_residual:<band>:value", "mag_residual:<band>:error"
+Sources that don't have a value for some band or color have NaN there. Same for IDs that are None.
+
+While the fitting runs, each fit is also saved as soon as it finishes, as a small shard in the "shards"
+subdirectory of the checkpoint. If the program crashes, the next run can skip the fits that were already done, and
+apply_fit_shards puts a cluster's fits back together (see pipeline.py). Each shard is written to a
+temporary file that only its own process uses, and then renamed into place. Renaming is atomic, so shards are safe to
+write from several processes at once, and a shard is either all there or not there at all.
+"""
+import os
+import json
+import cPickle
+import numpy as np
+from PhotoZ import Cluster
+from PhotoZ import other_classes
+from PhotoZ import config_data
+
+index_filename = "index.json"
+shards_directory_name = "shards"
+# Bump this if the layout of the files changes, so old checkpoints aren't read wrong.
+checkpoint_version = 1
+
+# The attributes of Source objects that hold dictionaries of data objects, and the prefix of their columns.
+_data_dictionaries = [("mags", "mag"), ("colors", "color"), ("mag_residuals", "mag_residual")]
+
+
+def save_clusters(cluster_list, directory):
+    """Save all the clusters to a checkpoint directory. Anything already there is replaced.
+
+    :param cluster_list: list of Cluster objects
+    :param directory: directory the checkpoint is stored in. Made if it doesn't exist.
+    :return: None
+    """
+    entries = [save_cluster(cluster, directory) for cluster in cluster_list]
+
+    # get rid of files from clusters that aren't in this list anymore
+    saved_files = set(entry["file"] for entry in entries)
+    for filename in os.listdir(directory):
+        if filename.endswith(".npz") and filename not in saved_files:
+            os.remove(os.path.join(directory, filename))
+
+    write_index(directory, entries)
+
+
+def save_cluster(cluster, directory):
+    """Save one cluster's sources, without touching the index or any other cluster.
+
+    :param cluster: Cluster object
+    :param directory: checkpoint directory
+    :return: the cluster's entry for the index. Pass all of them to write_index once the clusters are saved.
+    """
+    _make_directory(directory)
+    save_cluster_sources(cluster, directory)
+    return _cluster_metadata(cluster)
+
+
+def save_cluster_sources(cluster, directory):
+    """Write one cluster's sources to its .npz file in the checkpoint directory.
+
+    :param cluster: Cluster object
+    :param directory: checkpoint directory
+    :return: None
+    """
+    _atomic_savez(os.path.join(directory, cluster_filename(cluster.name)), make_source_columns(cluster))
+
+
+def make_source_columns(cluster):
+    """Turn a cluster's sources into columns.
+
+    :param cluster: Cluster object
+    :return: dictionary with column names (see the top of this file) as keys, and numpy arrays as values.
+    """
+    sources = cluster.sources_list
+    columns = dict()
+    columns["ra"] = np.array([source.ra for source in sources], dtype=np.float64)
+    columns["dec"] = np.array([source.dec for source in sources], dtype=np.float64)
+    columns["r_id"] = _to_float_column([source.r_id for source in sources])
+    columns["z_id"] = _to_float_column([source.z_id for source in sources])
+    columns["in_location"] = np.array([source.in_location for source in sources], dtype=bool)
+    columns["RS_member"] = np.array([source.RS_member for source in sources], dtype=bool)
+    columns["color_residual"] = _to_float_column([getattr(source, "color_residual", None) for source in sources])
+
+    for attribute, prefix in _data_dictionaries:
+        keys = set()
+        for source in sources:
+            keys.update(getattr(source, attribute))
+        for key in keys:
+            values = [getattr(source, attribute).get(key) for source in sources]
+            columns[prefix + ":" + key + ":value"] = _to_float_column([d.value if d else None for d in values])
+            columns[prefix + ":" + key + ":error"] = _to_float_column([d.error if d else None for d in values])
+    return columns
+
+
+def load_results(directory):
+    """Load the clusters with only their cluster level information (redshifts, errors, spec z, bands). None of the
+    sources are read, so this is fast no matter how big the checkpoint is. This is all that the corrections and
+    writing the results need.
+
+    :param directory: checkpoint directory
+    :return: list of Cluster objects, with empty sources lists.
+    """
+    return [_cluster_from_metadata(entry, []) for entry in read_index(directory)]
+
+
+def load_clusters(directory, names=None, columns=None):
+    """Load clusters, including their sources.
+
+    :param directory: checkpoint directory
+    :param names: list of cluster names to load. If None, all of them are loaded.
+    :param columns: list of which columns to read from the files (see the top of this file). The sources will only
+                    have those attributes filled in. If None, everything is read.
+    :return: list of Cluster objects
+    """
+    return [load_cluster_from_entry(directory, entry, columns) for entry in read_index(directory)
+            if names is None or entry["name"] in names]
+
+
+def load_cluster_from_entry(directory, entry, columns=None):
+    """Load a cluster using the entry save_cluster returned for it, so the index doesn't need to be written yet.
+
+    :param directory: checkpoint directory
+    :param entry: the cluster's entry for the index
+    :param columns: which columns to read. See load_clusters.
+    :return: Cluster object
+    """
+    return _cluster_from_metadata(entry, load_sources(os.path.join(directory, entry["file"]), columns))
+
+
+def load_cluster(directory, name):
+    """Load one cluster by name, without reading any of the others.
+
+    :param directory: checkpoint directory
+    :param name: name of the cluster
+    :return: Cluster object
+    """
+    clusters = load_clusters(directory, names=[name])
+    if len(clusters) == 0:
+        other_classes.EndProgramError("That cluster is not in the checkpoint.", name)
+    return clusters[0]
+
+
+def load_columns(directory, name, columns):
+    """Read some columns of one cluster's sources as arrays, without making Source objects at all.
+
+    :param directory: checkpoint directory
+    :param name: name of the cluster
+    :param columns: list of column names (see the top of this file)
+    :return: dictionary with column names as keys, and numpy arrays as values.
+    """
+    npz_file = np.load(os.path.join(directory, cluster_filename(name)))
+    try:
+        return {column: npz_file[column] for column in columns}
+    finally:
+        npz_file.close()
+
+
+def load_sources(path, columns=None):
+    """Turn one cluster's .npz file back into a list of Source objects.
+
+    :param path: path to the .npz file
+    :param columns: which columns to read. None reads all of them.
+    :return: list of Source objects
+    """
+    npz_file = np.load(path)
+    if columns is None:
+        columns = npz_file.files
+    table = {column: npz_file[column] for column in columns if column in npz_file.files}
+    npz_file.close()
+    return sources_from_columns(table)
+
+
+def sources_from_columns(table):
+    """Make Source objects out of columns like make_source_columns makes.
+
+    :param table: dictionary with column names as keys, and numpy arrays as values. Any columns can be left out.
+    :return: list of Source objects
+    """
+    # tolist turns everything back into regular Python floats and bools, like they were before saving.
+    table = {column: np.asarray(values).tolist() for column, values in table.items()}
+    n_sources = len(table[next(iter(table))]) if table else 0
+    ras = table.get("ra", [0.0] * n_sources)
+    decs = table.get("dec", [0.0] * n_sources)
+    sources = [other_classes.Source(ras[i], decs[i], [], [], []) for i in range(n_sources)]
+
+    for column, values in table.items():
+        if column in ["ra", "dec"]:
+            continue
+        elif column in ["r_id", "z_id"]:
+            for source, value in zip(sources, values):
+                setattr(source, column, _id_from_float(value))
+        elif column == "color_residual":
+            for source, value in zip(sources, values):
+                if not np.isnan(value):
+                    source.color_residual = value
+        elif column in ["in_location", "RS_member"]:
+            for source, value in zip(sources, values):
+                setattr(source, column, value)
+        elif column.endswith(":value"):
+            prefix, key = column.split(":")[0:2]
+            attribute = [a for a, p in _data_dictionaries if p == prefix][0]
+            errors = table.get(prefix + ":" + key + ":error", [0.0] * n_sources)
+            for source, value, error in zip(sources, values, errors):
+                if not np.isnan(value):
+                    getattr(source, attribute)[key] = other_classes.data(value, error)
+    return sources
+
+
+def read_index(directory):
+    """Read the list of cluster entries from a checkpoint's index.
+
+    :param directory: checkpoint directory
+    :return: list of dictionaries, one per cluster.
+    """
+    index_path = os.path.join(directory, index_filename)
+    if not os.path.isfile(index_path):
+        other_classes.EndProgramError("There is no checkpoint in this directory.", directory)
+    index_file = open(index_path, "r")
+    index = json.load(index_file)
+    index_file.close()
+    if index["version"] != checkpoint_version:
+        other_classes.EndProgramError("This checkpoint was made by a different version of the code. Rerun the "
+                                      "earlier stages to remake it.", directory)
+    return index["clusters"]
+
+
+def convert_pickle(pickle_path, directory):
+    """Turn one of the old pickled cluster lists into a checkpoint directory, so it doesn't have to be remade.
+
+    :param pickle_path: path to the pickled list of clusters
+    :param directory: checkpoint directory to save them in
+    :return: None
+    """
+    pickle_file = open(pickle_path, "rb")
+    cluster_list = cPickle.load(pickle_file)
+    pickle_file.close()
+    save_clusters(cluster_list, directory)
+
+
+def save_fit_shard(cluster, color, directory):
+    """Save the result of fitting one color of one cluster, right after the fit is done.
+
+    Along with the redshift and its errors, this holds the things fit_z changes on the sources (RS membership,
+    location cut, and color residuals), so a cluster that is skipped on a later run ends up the same as if it had
+    been fit again.
+
+    :param cluster: Cluster object that was just fit
+    :param color: color that was fit
+    :param directory: checkpoint directory the finished clusters will be saved in
+    :return: None
+    """
+    shards_directory = os.path.join(directory, shards_directory_name)
+    _make_directory(shards_directory)
+
+    _atomic_savez(os.path.join(shards_directory, _shard_filename(cluster.name, color)),
+                  make_fit_result(cluster, color))
+
+
+def make_fit_result(cluster, color):
+    """Get the result of fitting one color of one cluster as a few small arrays, like in a shard.
+
+    :param cluster: Cluster object that was just fit
+    :param color: color that was fit
+    :return: dictionary of numpy arrays. Put it back into a cluster with apply_fit_result.
+    """
+    # fit_z doesn't set a redshift if there weren't enough sources. That still counts as done, so save an empty one.
+    sources = cluster.sources_list
+    return {"name": np.array(cluster.name),
+            "color": np.array(color),
+            "rs_z": np.array(cluster.rs_z.get(color, "")),
+            "upper_photo_z_error": np.array(cluster.upper_photo_z_error.get(color, np.nan)),
+            "lower_photo_z_error": np.array(cluster.lower_photo_z_error.get(color, np.nan)),
+            "in_location": np.array([source.in_location for source in sources], dtype=bool),
+            "RS_member": np.array([source.RS_member for source in sources], dtype=bool),
+            "color_residual": _to_float_column([getattr(source, "color_residual", None) for source in sources])}
+
+
+def apply_fit_shards(cluster, directory, colors):
+    """Put the results from one cluster's shards into it. The shards are left where they are.
+
+    :param cluster: Cluster object
+    :param directory: checkpoint directory the shards are in
+    :param colors: which colors to use the shards of. Any others are ignored.
+    :return: None
+    """
+    shard_paths = [os.path.join(directory, shards_directory_name, _shard_filename(cluster.name, color))
+                   for color in colors]
+    for shard in _read_shards([path for path in shard_paths if os.path.isfile(path)]):
+        apply_fit_result(cluster, shard)
+
+
+def shard_exists(directory, name, color):
+    """Whether there is a saved fit of this color for this cluster."""
+    return os.path.isfile(os.path.join(directory, shards_directory_name, _shard_filename(name, color)))
+
+
+def _read_shards(shard_paths):
+    """Read shards into dictionaries, sorted in the order of the fitted colors."""
+    shards = []
+    for path in shard_paths:
+        shard = np.load(path)
+        shards.append({key: shard[key] for key in shard.files})
+        shard.close()
+
+    color_order = {color: i for i, color in enumerate(config_data.fitted_colors)}
+    shards.sort(key=lambda shard: color_order.get(str(shard["color"]), len(color_order)))
+    return shards
+
+
+def apply_fit_result(cluster, shard):
+    """Set the results stored in a shard (or from make_fit_result) on its cluster."""
+    color = str(shard["color"])
+    if str(shard["rs_z"]):
+        cluster.rs_z[color] = str(shard["rs_z"])
+        cluster.upper_photo_z_error[color] = float(shard["upper_photo_z_error"])
+        cluster.lower_photo_z_error[color] = float(shard["lower_photo_z_error"])
+
+    if len(shard["RS_member"]) != len(cluster.sources_list):
+        other_classes.EndProgramError("A saved fit doesn't match the sources in its cluster. The catalogs probably "
+                                      "changed, so delete the shards and fit again.", cluster.name)
+    for source, in_location, rs_member, residual in zip(cluster.sources_list, shard["in_location"].tolist(),
+                                                        shard["RS_member"].tolist(), shard["color_residual"].tolist()):
+        source.in_location = in_location
+        source.RS_member = rs_member
+        if not np.isnan(residual):
+            source.color_residual = residual
+
+
+def _shard_filename(name, color):
+    return name + "__" + color + ".npz"
+
+
+def _make_directory(directory):
+    """Make a directory if it isn't there. Several processes might try at once, so it's fine if another one wins."""
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+
+def _atomic_savez(path, arrays):
+    """Save arrays to a .npz file by writing a temporary file and moving it into place, so a crash (or another
+    process reading at the same time) never sees half a file. The temporary name has the process ID in it, so two
+    processes can't write to the same one. savez adds .npz to names without it, so that has to stay at the end.
+    """
+    temp_path = path[:-4] + ".tmp." + str(os.getpid()) + ".npz"
+    np.savez(temp_path, **arrays)
+    os.rename(temp_path, path)
+
+
+def write_index(directory, entries):
+    """Write the index of a checkpoint, the same way as the .npz files: to a temporary file, then moved into place.
+
+    :param directory: checkpoint directory
+    :param entries: list of the entries for each cluster, from save_cluster.
+    :return: None
+    """
+    _make_directory(directory)
+    index_path = os.path.join(directory, index_filename)
+    index_file = open(index_path + ".tmp", "w")
+    json.dump({"version": checkpoint_version, "clusters": entries}, index_file, indent=1, sort_keys=True)
+    index_file.close()
+    os.rename(index_path + ".tmp", index_path)
+
+
+def _cluster_metadata(cluster):
+    """The things about a cluster that go in the index. The redshifts are the strings the rest of the code uses."""
+    return {"name": cluster.name,
+            "file": cluster_filename(cluster.name),
+            "n_sources": len(cluster.sources_list),
+            "spec_z": cluster.spec_z,
+            # clusters in the old pickles don't have a center
+            "center": getattr(cluster, "center", None),
+            "bands": sorted(cluster.bands),
+            "rs_z": cluster.rs_z,
+            "upper_photo_z_error": cluster.upper_photo_z_error,
+            "lower_photo_z_error": cluster.lower_photo_z_error}
+
+
+def _cluster_from_metadata(entry, sources):
+    """Rebuild a Cluster object from its index entry and its sources."""
+    cluster = Cluster.Cluster(str(entry["name"]), sources)
+    # JSON gives back unicode strings. Turn them back into regular ones, since the redshifts are used as keys.
+    cluster.spec_z = str(entry["spec_z"]) if entry["spec_z"] is not None else None
+    # indexes from before clusters could have a center don't have one
+    cluster.center = tuple(entry["center"]) if entry.get("center") is not None else None
+    cluster.bands = set(str(band) for band in entry["bands"])
+    cluster.rs_z = {str(color): str(z) for color, z in entry["rs_z"].items()}
+    cluster.upper_photo_z_error = {str(color): error for color, error in entry["upper_photo_z_error"].items()}
+    cluster.lower_photo_z_error = {str(color): error for color, error in entry["lower_photo_z_error"].items()}
+    return cluster
+
+
+def cluster_filename(name):
+    return name + ".npz"
+
+
+def _to_float_column(values):
+    """Make a float array out of a list that might have Nones in it. The Nones become NaN."""
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def _id_from_float(value):
+    """IDs are integers (or None) before saving, so turn them back into that."""
+    if np.isnan(value):
+        return None
+    return int(value)
@@ -1,3 +1,9 @@
 filters_list = ["sloan_r", "sloan_i", "sloan_z", "ch1", "ch2", "wfc3_f105w", "wfc3_f140w", "wfc3_f160w", "acs_f606w",
                 "acs_f814w", "acs_f850lp"]
 fitted_colors = ["sloan_r-sloan_z", "sloan_i-ch1", "sloan_r-ch1", "ch1-ch2", "wfc3_f814w-wfc3_f140w"]
+
+# The models the prediction cube is made from (see predictions.make_prediction_cube). There is one model for each
+# combination of these. The model names have {metallicity} where the metallicity goes in the EzGal model filename.
+sps_models = ["bc03_exp_0.1_z_{metallicity}_chab"]
+metallicities = [0.02]
+formation_redshifts = [3.0]
@@ -0,0 +1,228 @@
+"""Trying many sets of cuts on a cluster at once, to tune the cuts fit_z uses.
+
+fit_z uses the cuts that are attributes of Cluster: the location cut radius, the schedule of color cuts that get
+narrower each round, the magnitude cuts, and the final cuts. Finding better values by changing them and fitting
+again is slow. sweep_cuts takes a list of values for each of them, and fits every combination at once.
+
+Everything that doesn't depend on the cuts is only done once per cluster:
+    - the center of the location cut, and which sources are within each radius
+    - the color residual of every source from the red sequence at every redshift, as a matrix of
+      [redshifts, sources]
+    - each source's term of the chi-squared at every redshift, as a matrix of the same shape
+Then each round of fitting is done for all the combinations together. The members of each combination are found
+from the residual matrix, and the chi-squared curve of each combination is one row of the product of the
+[combinations, sources] membership matrix and the chi-squared terms.
+
+The default of each list is the one value Cluster uses now, so sweep_cuts with nothing but the cluster and color gives
+what fit_z would (except for the chi-squared values being added up in a different order).
+
+To see which cuts do best against the clusters with spectroscopic redshifts:
+    results = cut_sweep.sweep_clusters(cluster_list, "sloan_r-sloan_z", radii=[1.0, 1.5, 2.0],
+                                       brighter_mag_cuts=[-1.6, -1.4, -1.2])
+    scores = cut_sweep.score_against_spec_z(results, cluster_list)
+    best = results[0][np.argmin(scores["median_offset"])]
+"""
+import itertools
+import numpy as np
+from PhotoZ import Cluster
+from PhotoZ import batch_fitting
+from PhotoZ import other_classes
+from PhotoZ import implied_redshift
+
+
+def sweep_cuts(cluster, color, radii=None, bluer_color_cuts=None, redder_color_cuts=None, brighter_mag_cuts=None,
+               dimmer_mag_cuts=None, final_cuts=None):
+    """Fit a cluster with every combination of the given cuts. Nothing about the cluster is changed.
+
+    Each parameter is a list of values to try. Leaving one out uses the value in Cluster.
+
+    :param cluster: Cluster object
+    :param color: color to fit, like "sloan_r-sloan_z"
+    :param radii: location cut radii, in arcminutes
+    :param bluer_color_cuts: schedules of bluer color cuts, one per round of fitting, like [-0.25, -0.225, -0.20]
+    :param redder_color_cuts: schedules of redder color cuts. They must have as many rounds as the bluer ones.
+    :param brighter_mag_cuts: brighter magnitude cuts
+    :param dimmer_mag_cuts: dimmer magnitude cuts
+    :param final_cuts: final cuts, each like (bluer color, redder color, brighter mag, fainter mag)
+    :return: structured array with one entry per combination of the cuts, with the fields:
+             "radius", "bluer_color_cuts", "redder_color_cuts", "brighter_mag_cut", "dimmer_mag_cut", "final_cuts":
+             the cuts used.
+             "z", "lower_error", "upper_error": the best redshift and its errors, which are NaN if there weren't
+             enough members to fit.
+             "n_members": how many sources pass the final cuts, or how many were left when there weren't enough.
+    """
+    grids = _make_grids(radii, bluer_color_cuts, redder_color_cuts, brighter_mag_cuts, dimmer_mag_cuts, final_cuts)
+    combinations = list(itertools.product(*[range(len(grid)) for grid in grids]))
+    results = _empty_results(len(combinations), len(grids[1][0]))
+    for field, grid, column in zip(_cut_fields, grids, zip(*combinations)):
+        results[field] = [grid[i] for i in column]
+    if len(cluster.sources_list) == 0:
+        return results
+
+    redshift_axis = Cluster.Cluster.redshift_axis
+    zeropoints, slopes, pivot_mags = Cluster.Cluster._get_model_lines(color)
+    mags = cluster.get_mags(color.split("-")[1]).values
+    colors = cluster.get_colors(color)
+    good_errors = colors.errors <= 0.2
+
+    # The matrices every combination uses, with dimensions of [redshifts, sources].
+    with np.errstate(invalid="ignore"):
+        model_colors = zeropoints[:, np.newaxis] + slopes[:, np.newaxis] * (mags - pivot_mags[:, np.newaxis])
+        residuals = colors.values - model_colors
+        chi_terms = ((model_colors - colors.values) / colors.errors)**2
+    residuals[np.isnan(residuals)] = 999
+    # sources without data are never in a sample, so they can be left out of the sums like this
+    chi_terms[~np.isfinite(chi_terms)] = 0
+
+    # which sources are in each location cut, and the initial redshift for each
+    radius_index = np.array([combination[0] for combination in combinations], dtype=int)
+    in_location = _find_apertures(cluster, color, grids[0])
+    bluer_cut, redder_cut, brighter_cut, dimmer_cut = Cluster.Cluster.initial_cuts
+    with np.errstate(invalid="ignore"):
+        near_line = (good_errors & (mags > pivot_mags[:, np.newaxis] + brighter_cut) &
+                     (mags < pivot_mags[:, np.newaxis] + dimmer_cut) & (bluer_cut < residuals) &
+                     (residuals < redder_cut))
+    if len(redshift_axis) >= 7 and Cluster.Cluster.fast_initial_redshift:
+        initial_z = batch_fitting.pick_initial_redshifts(np.column_stack([
+            implied_redshift.count_near_red_sequence(color, Cluster.Cluster._get_model_lines(color), mags,
+                                                     colors.values, colors.errors, in_aperture,
+                                                     Cluster.Cluster.initial_cuts)[:, 0]
+            for in_aperture in in_location]))
+    elif len(redshift_axis) >= 7:
+        initial_z = batch_fitting.pick_initial_redshifts(np.dot(near_line.astype(int),
+                                                                in_location.T.astype(int)))
+    else:
+        initial_z = -np.ones(len(grids[0]), dtype=int)
+    initial_z[initial_z < 0] = redshift_axis.index("0.5")
+
+    best_z = initial_z[radius_index]
+    bluer_cuts, redder_cuts = results["bluer_color_cuts"], results["redder_color_cuts"]
+    brighter_cuts = results["brighter_mag_cut"][:, np.newaxis]
+    dimmer_cuts = results["dimmer_mag_cut"][:, np.newaxis]
+    fitting = np.ones(len(combinations), dtype=bool)
+    for i in range(bluer_cuts.shape[1]):
+        members = _member_matrix(in_location[radius_index], good_errors, mags, residuals, pivot_mags, best_z,
+                                 bluer_cuts[:, i], redder_cuts[:, i], brighter_cuts, dimmer_cuts)
+        n_members = members.sum(axis=1)
+
+        # like fit_z, stop on the ones without enough members, and don't give them a redshift
+        stopping = fitting & (n_members < 3)
+        results["n_members"][stopping] = n_members[stopping]
+        for field in ["z", "lower_error", "upper_error"]:
+            results[field][stopping] = np.nan
+        fitting &= ~stopping
+        if not fitting.any():
+            return results
+
+        chi_values = np.dot(members[fitting].astype(np.float64), chi_terms.T)
+        chi_values /= (n_members[fitting] - 1 - 1)[:, np.newaxis]
+        fits = batch_fitting.stats_from_chi(redshift_axis.redshifts, chi_values)
+        results["z"][fitting], results["lower_error"][fitting], results["upper_error"][fitting] = fits
+        # the best redshift can be between grid points, but the cuts are done at the closest one
+        best_z[fitting] = [redshift_axis.nearest(redshift) for redshift in fits[0]]
+
+    final = results["final_cuts"]
+    members = _member_matrix(np.ones((1, len(mags)), dtype=bool), good_errors, mags, residuals, pivot_mags, best_z,
+                             final[:, 0], final[:, 1], final[:, 2:3], final[:, 3:4])
+    results["n_members"][fitting] = members[fitting].sum(axis=1)
+    return results
+
+
+def sweep_clusters(cluster_list, color, **cuts):
+    """Run sweep_cuts on many clusters, with the same cuts.
+
+    :param cluster_list: list of Cluster objects
+    :param color: color to fit
+    :param cuts: lists of cuts to try. See sweep_cuts.
+    :return: structured array of the results, with dimensions of [clusters, combinations of cuts]
+    """
+    return np.array([sweep_cuts(cluster, color, **cuts) for cluster in cluster_list])
+
+
+def score_against_spec_z(results, cluster_list):
+    """See how well each combination of cuts does on the clusters with spectroscopic redshifts.
+
+    :param results: the results of sweep_clusters
+    :param cluster_list: the clusters it was run on, in the same order
+    :return: structured array with one entry per combination of cuts, with the fields "median_offset" (the median
+             of |z - spec z| / (1 + spec z)), "outliers" (how many are off by more than 0.1 of that), and "missed"
+             (how many couldn't be fit). The median is NaN if none of them could be fit.
+    """
+    has_spec_z = np.array([cluster.spec_z is not None for cluster in cluster_list], dtype=bool)
+    spec_zs = np.array([float(cluster.spec_z) for cluster in cluster_list if cluster.spec_z is not None])
+    z = results["z"][has_spec_z]
+    with np.errstate(invalid="ignore"):
+        offsets = np.abs(z - spec_zs[:, np.newaxis]) / (1 + spec_zs[:, np.newaxis])
+        scores = np.zeros(results.shape[1], dtype=[("median_offset", np.float64), ("outliers", np.int64),
+                                                   ("missed", np.int64)])
+        scores["outliers"] = np.sum(offsets > 0.1, axis=0)
+    scores["missed"] = np.sum(np.isnan(z), axis=0)
+    for i in range(results.shape[1]):
+        fitted = offsets[:, i][np.isfinite(offsets[:, i])]
+        scores["median_offset"][i] = np.median(fitted) if len(fitted) else np.nan
+    return scores
+
+
+# the fields of the results that hold the cuts, in the order they are in the combinations
+_cut_fields = ["radius", "bluer_color_cuts", "redder_color_cuts", "brighter_mag_cut", "dimmer_mag_cut", "final_cuts"]
+
+
+def _make_grids(radii, bluer_color_cuts, redder_color_cuts, brighter_mag_cuts, dimmer_mag_cuts, final_cuts):
+    """Fill in the defaults from Cluster, and check that the schedules all have the same number of rounds."""
+    fitter = Cluster.Cluster
+    grids = [radii or [fitter.location_cut_radius],
+             bluer_color_cuts or [fitter.bluer_color_cuts],
+             redder_color_cuts or [fitter.redder_color_cuts],
+             brighter_mag_cuts or [fitter.brighter_mag_cut],
+             dimmer_mag_cuts or [fitter.dimmer_mag_cut],
+             final_cuts or [fitter.final_cuts]]
+    rounds = set(len(schedule) for schedule in grids[1] + grids[2])
+    if len(rounds) != 1:
+        other_classes.EndProgramError("Every schedule of color cuts needs the same number of rounds.", rounds)
+    return grids
+
+
+def _empty_results(n_combinations, n_rounds):
+    results = np.zeros(n_combinations, dtype=[("radius", np.float64),
+                                              ("bluer_color_cuts", np.float64, (n_rounds,)),
+                                              ("redder_color_cuts", np.float64, (n_rounds,)),
+                                              ("brighter_mag_cut", np.float64),
+                                              ("dimmer_mag_cut", np.float64),
+                                              ("final_cuts", np.float64, (4,)),
+                                              ("z", np.float64),
+                                              ("lower_error", np.float64),
+                                              ("upper_error", np.float64),
+                                              ("n_members", np.int64)])
+    for field in ["z", "lower_error", "upper_error"]:
+        results[field] = np.nan
+    return results
+
+
+def _find_apertures(cluster, color, radii):
+    """Which sources are in each location cut, like fit_z would have them. Has dimensions of [radii, sources]."""
+    if cluster._has_location_cut():
+        return cluster.find_apertures(radii, color)[1]
+    # fit_z leaves these alone
+    in_location = np.array([source.in_location for source in cluster.sources_list], dtype=bool)
+    return np.tile(in_location, (len(radii), 1))
+
+
+def _member_matrix(in_sample, good_errors, mags, residuals, pivot_mags, redshifts, bluer_cuts, redder_cuts,
+                   brighter_cuts, dimmer_cuts):
+    """Cluster._rs_member_mask for every combination of cuts at once.
+
+    :param in_sample: boolean array of which sources can be members, with dimensions of [combinations, sources], or
+                      one row for all of them.
+    :param redshifts: array of the index of the redshift each combination is cut at
+    :param bluer_cuts: array of the bluer color cut of each combination. The same for redder_cuts.
+    :param brighter_cuts: array of the brighter magnitude cut of each combination, with dimensions of
+                          [combinations, 1]. The same for dimmer_cuts.
+    :return: boolean array with dimensions of [combinations, sources]
+    """
+    combination_residuals = residuals[redshifts]
+    predicted_mags = pivot_mags[redshifts][:, np.newaxis]
+    with np.errstate(invalid="ignore"):
+        return (in_sample & good_errors &
+                (mags > predicted_mags + brighter_cuts) & (mags < predicted_mags + dimmer_cuts) &
+                (bluer_cuts[:, np.newaxis] < combination_residuals) &
+                (combination_residuals < redder_cuts[:, np.newaxis]))
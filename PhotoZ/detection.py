@@ -0,0 +1,478 @@
+import os
+import collections
+import numpy as np
+from scipy import ndimage
+from astropy.io import fits
+from astropy import wcs
+from PhotoZ import SExtractor_functions
+from PhotoZ import seeing
+from PhotoZ import other_classes
+from PhotoZ import tiling
+
+# Columns written to the catalogs, in order. These are the same names SExtractor uses, and the same ones that
+# read_in_catalogs and _create_catalogs look for. There are 8 of them, which is where the data_start=8 in the
+# read_catalog calls comes from.
+catalog_columns = [("NUMBER", "{:10d}", "Running object number"),
+                   ("ALPHA_J2000", "{:15.7f}", "Right ascension of barycenter (J2000)  [deg]"),
+                   ("DELTA_J2000", "{:15.7f}", "Declination of barycenter (J2000)  [deg]"),
+                   ("MAG_APER", "{:10.4f}", "Fixed aperture magnitude vector  [mag]"),
+                   ("MAGERR_APER", "{:10.4f}", "RMS error vector for fixed aperture mag.  [mag]"),
+                   ("FWHM_IMAGE", "{:10.3f}", "FWHM assuming a gaussian core  [pixel]"),
+                   ("FLAGS", "{:4d}", "Extraction flags"),
+                   ("CLASS_STAR", "{:6.3f}", "S/G classifier output")]
+
+# The same flag bits SExtractor uses, so cuts like "FLAGS < 4" mean the same thing.
+flag_saturated = 4
+flag_truncated = 8
+flag_aperture_incomplete = 16
+
+# For CLASS_STAR: sources brighter than this signal to noise set what the concentration of a star is, and a source
+# this fraction less concentrated than a star is well on its way to being a galaxy. See _stellarity.
+stellarity_bright_snr = 50.0
+stellarity_tolerance = 0.1
+
+# Aperture photometry is done on this many bytes of pixels at a time (in each of the arrays it uses), so big apertures
+# don't use a lot of memory.
+photometry_chunk_bytes = 32 * 1024**2
+
+# Detections and aperture fluxes don't depend on the zeropoint, so they are kept around. That way the second run
+# in _create_catalogs (after calibration) is just a rewrite of the catalog with different magnitudes. Only the last
+# few are kept, which is enough for both runs on a detection and a measurement image, so a long run of sextractor_main
+# doesn't keep the arrays of every image it has done. The most recently used are last.
+max_cached_images = 2
+_detections_cache = collections.OrderedDict()
+_photometry_cache = collections.OrderedDict()
+_background_cache = collections.OrderedDict()
+
+
+def run_detection(detection_image, measurement_image, sex_file, zeropoint, fwhm, catalog_path, tile_size=1024,
+                  processes=1):
+    """In-process replacement for running SExtractor in dual image mode. Same arguments as _run_sextractor.
+
+    Sources are detected in the detection image, then aperture photometry is done in the measurement image at those
+    same positions. Both images are memory mapped and processed one tile at a time, so this works on mosaics that
+    don't fit in memory. The detection parameters are read from the same .sex file SExtractor would use.
+
+    :param detection_image: path of the detection image
+    :param measurement_image: path of the measurement image (can be the same as the detection image). Needs to be
+                              on the same pixel grid as the detection image, just like in SExtractor.
+    :param sex_file: path to the .sex configuration file
+    :param zeropoint: zeropoint for the magnitudes.
+    :param fwhm: full width half max of the image, in arcseconds.
+    :param catalog_path: path where the resulting catalog will be stored.
+    :param tile_size: width of the square tiles the images are processed in, in pixels.
+    :param processes: how many processes the detection tiles are spread over.
+    :return: None, but the resulting catalog is saved to disk, in the same format SExtractor writes.
+    """
+    config = _read_config(sex_file)
+
+    # Dual image mode only makes sense if the pixels line up.
+    detection_header = fits.getheader(detection_image, 0)
+    measurement_header = fits.getheader(measurement_image, 0)
+    if (detection_header["NAXIS1"], detection_header["NAXIS2"]) != (measurement_header["NAXIS1"],
+                                                                    measurement_header["NAXIS2"]):
+        other_classes.EndProgramError("The detection and measurement images need to be the same size.",
+                                      measurement_image)
+
+    sources = detect_sources(detection_image, float(fwhm), config, tile_size, processes)
+
+    key = (_file_key(detection_image), _file_key(measurement_image), config["aperture"])
+    photometry = _get_cached(_photometry_cache, key)
+    if photometry is None:
+        photometry = _set_cached(_photometry_cache, key, aperture_photometry(measurement_image, sources["x"],
+                                                                             sources["y"], config))
+    flux, flux_error, photometry_flags = photometry
+
+    mags, mag_errors = flux_to_mags(flux, flux_error, float(zeropoint))
+    write_catalog(catalog_path, sources, mags, mag_errors, sources["flags"] | photometry_flags)
+
+
+def detect_sources(image_path, fwhm, config, tile_size=1024, processes=1):
+    """Find all the sources in an image, tile by tile.
+
+    For each tile: subtract the background, smooth with a Gaussian the size of the seeing, threshold, and find the
+    connected groups of pixels. The tiling layer reads each tile with a margin around it, so objects near the tile
+    edges are seen completely, and keeps each object only in the tile its center falls in, so objects in the
+    overlaps aren't counted twice. There is no deblending, so blended objects come out as one source.
+
+    :param image_path: path to the detection image
+    :param fwhm: seeing, in arcseconds
+    :param config: dictionary of detection parameters, from _read_config
+    :param tile_size: width of the tiles, in pixels
+    :param processes: how many processes the tiles are spread over.
+    :return: dictionary of arrays, with keys "x", "y", "ra", "dec", "fwhm", "flags", "class_star". Pixel positions
+             start at 0.
+    """
+    key = (_file_key(image_path), fwhm, config["thresh"], config["minarea"], config["back_size"])
+    sources = _get_cached(_detections_cache, key)
+    if sources is not None:
+        return sources
+
+    header = fits.getheader(image_path, 0)
+    pixel_scale = seeing.get_pixel_scale(header)
+    if pixel_scale is None:
+        other_classes.EndProgramError("Can't do detection on an image without a pixel scale in the header.",
+                                      image_path)
+    fwhm_pixels = fwhm / pixel_scale
+    saturation = header.get("SATURATE", config["saturation"])
+
+    background, rms = _get_background_map(image_path, tiling.open_image(image_path), config["back_size"])
+
+    # Like SExtractor, the threshold is in units of the rms of the unsmoothed image, even though it is applied to
+    # the smoothed one.
+    smoothing_sigma = fwhm_pixels / seeing.sigma_to_fwhm
+    margin = int(max(4 * fwhm_pixels, 16))
+
+    # The background maps are small (one number per mesh), so it's fine to send them to every worker.
+    sources = tiling.map_tiles(image_path, _detect_in_tile, tile_size, margin,
+                               args=(background, rms, config, smoothing_sigma, saturation), processes=processes)
+    if len(sources) == 0:
+        sources = {name: np.array([]) for name in ["x", "y", "fwhm", "peak"]}
+        sources["flags"] = np.array([], dtype=np.int64)
+
+    # Sort them top to bottom, like SExtractor does, so the numbers are the same from run to run.
+    order = np.lexsort((sources["x"], sources["y"]))
+    sources = {name: values[order] for name, values in sources.items()}
+
+    if len(sources["x"]) > 0:
+        sources["ra"], sources["dec"] = wcs.WCS(header).all_pix2world(sources["x"], sources["y"], 0)
+    else:
+        sources["ra"], sources["dec"] = np.array([]), np.array([])
+    sources["class_star"] = _stellarity(image_path, sources["x"], sources["y"], fwhm_pixels, config)
+
+    return _set_cached(_detections_cache, key, sources)
+
+
+def _detect_in_tile(tile_data, tile, image_shape, background, rms, config, smoothing_sigma, saturation):
+    """Does the detection for one tile. Called by tiling.map_tiles.
+
+    :return: dictionary of arrays for the objects found, in whole image coordinates. Includes the ones in the
+             margin, which map_tiles will throw out.
+    """
+    subtracted = tile_data - _interpolate_map(background, config["back_size"], tile.read)
+    tile_rms = _interpolate_map(rms, config["back_size"], tile.read)
+
+    smoothed = ndimage.gaussian_filter(subtracted, smoothing_sigma)
+    above = smoothed > config["thresh"] * tile_rms
+    labels, n_objects = ndimage.label(above, structure=np.ones((3, 3)))
+    if n_objects == 0:
+        return None
+
+    # All the per-object sums at once with bincount, rather than looping through objects. Only the pixels in
+    # objects matter, which is a small fraction of the tile.
+    object_pixels = np.flatnonzero(labels)
+    object_labels = labels.ravel()[object_pixels]
+    flux = np.clip(subtracted.ravel()[object_pixels], 0, None)
+    grid_y = (object_pixels // tile_data.shape[1]).astype(np.float64)
+    grid_x = (object_pixels % tile_data.shape[1]).astype(np.float64)
+    area = np.bincount(object_labels, minlength=n_objects + 1)[1:]
+    total = np.bincount(object_labels, weights=flux, minlength=n_objects + 1)[1:]
+    sum_y = np.bincount(object_labels, weights=flux * grid_y, minlength=n_objects + 1)[1:]
+    sum_x = np.bincount(object_labels, weights=flux * grid_x, minlength=n_objects + 1)[1:]
+    sum_yy = np.bincount(object_labels, weights=flux * grid_y**2, minlength=n_objects + 1)[1:]
+    sum_xx = np.bincount(object_labels, weights=flux * grid_x**2, minlength=n_objects + 1)[1:]
+    peak = np.full(n_objects + 1, -np.inf)
+    np.maximum.at(peak, object_labels, tile_data.ravel()[object_pixels])
+    peak = peak[1:]
+
+    good = (area >= config["minarea"]) & (total > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = sum_y / total
+        x = sum_x / total
+        variance = (sum_yy / total - y**2 + sum_xx / total - x**2) / 2.0
+    y, x = tile.to_image_coordinates(y, x)
+
+    flags = np.zeros(n_objects, dtype=np.int64)
+    flags[peak >= saturation] |= flag_saturated
+    # objects touching the edge of the image (not the tile) are cut off
+    top, bottom, left, right = tile.touches_image_edge(image_shape)
+    edge_labels = np.unique(np.concatenate([labels[0, :] if top else [], labels[-1, :] if bottom else [],
+                                            labels[:, 0] if left else [], labels[:, -1] if right else []]).astype(int))
+    edge_labels = edge_labels[edge_labels > 0]
+    flags[edge_labels - 1] |= flag_truncated
+
+    return {"x": x[good], "y": y[good], "fwhm": seeing.sigma_to_fwhm * np.sqrt(np.clip(variance[good], 0, None)),
+            "peak": peak[good], "flags": flags[good]}
+
+
+def aperture_photometry(image_path, xs, ys, config, chunk_size=5000, diameter=None):
+    """Measure the flux in circular apertures at the given positions.
+
+    Pixels on the edge of the aperture are weighted by how much of them is inside it (found by splitting each pixel
+    into a 5x5 grid, one point of the grid at a time). The local background is subtracted using the same background
+    map used for detection.
+
+    :param image_path: path to the measurement image
+    :param xs: array of x positions of the aperture centers, in pixels starting at 0
+    :param ys: array of y positions
+    :param config: dictionary of parameters, from _read_config
+    :param chunk_size: how many apertures are done at once. Keeps memory use bounded for big catalogs. The sources
+                       from detect_sources are sorted by y, so each chunk only reads one band of rows of the image. For
+                       big apertures, fewer are done at once, so each chunk fits in photometry_chunk_bytes.
+    :param diameter: diameter of the apertures, in pixels. Defaults to the first of PHOT_APERTURES.
+    :return: flux, flux error, flags. All arrays.
+    """
+    header = fits.getheader(image_path, 0)
+    image = tiling.open_image(image_path)
+    gain = header.get("GAIN", config["gain"])
+
+    background, rms = _get_background_map(image_path, image, config["back_size"])
+
+    if diameter is None:
+        diameter = config["aperture"]
+    radius = diameter / 2.0
+    half = int(np.ceil(radius)) + 1
+    offsets = np.arange(-half, half + 1)
+    sub_pixel = (np.arange(5) - 2) / 5.0
+    chunk_size = max(1, min(chunk_size, photometry_chunk_bytes // (8 * len(offsets)**2)))
+
+    flux = np.zeros(len(xs))
+    flux_error = np.zeros(len(xs))
+    flags = np.zeros(len(xs), dtype=np.int64)
+    for start in range(0, len(xs), chunk_size):
+        x = xs[start:start + chunk_size]
+        y = ys[start:start + chunk_size]
+        center_x = np.round(x).astype(int)
+        center_y = np.round(y).astype(int)
+
+        pixel_ys = center_y[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+        pixel_xs = center_x[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+        on_image = ((pixel_ys >= 0) & (pixel_ys < image.shape[0]) & (pixel_xs >= 0) & (pixel_xs < image.shape[1]))
+
+        # how much of each pixel is inside the aperture. The distances along each axis are separate, so only one
+        # point of the sub-pixel grid is compared at a time.
+        dy = pixel_ys - y[:, np.newaxis, np.newaxis]
+        dx = pixel_xs - x[:, np.newaxis, np.newaxis]
+        coverage = np.zeros(on_image.shape)
+        for sub_y in sub_pixel:
+            dy_squared = (dy + sub_y)**2
+            for sub_x in sub_pixel:
+                coverage += (dx + sub_x)**2 + dy_squared < radius**2
+        coverage /= len(sub_pixel)**2
+
+        # Read all the cutouts at once. Clip the indices so things at the edge don't fail, then zero those pixels
+        cutouts = np.asarray(image[np.clip(pixel_ys, 0, image.shape[0] - 1),
+                                   np.clip(pixel_xs, 0, image.shape[1] - 1)], dtype=np.float64)
+        cutouts = np.where(on_image & np.isfinite(cutouts), cutouts, 0.0)
+
+        local_background = ndimage.map_coordinates(background, _mesh_coordinates(y, x, config["back_size"]),
+                                                   order=1, mode="nearest")
+        local_rms = ndimage.map_coordinates(rms, _mesh_coordinates(y, x, config["back_size"]), order=1,
+                                            mode="nearest")
+
+        weights = coverage * on_image
+        area = weights.sum(axis=(1, 2))
+        this_flux = (cutouts * weights).sum(axis=(1, 2)) - local_background * area
+        variance = area * local_rms**2
+        if gain > 0:
+            variance += np.clip(this_flux, 0, None) / gain
+
+        flux[start:start + chunk_size] = this_flux
+        flux_error[start:start + chunk_size] = np.sqrt(variance)
+        incomplete = ((coverage > 0) & ~on_image).any(axis=(1, 2))
+        flags[start:start + chunk_size][incomplete] |= flag_aperture_incomplete
+
+    return flux, flux_error, flags
+
+
+def background_map(image, mesh_size):
+    """Estimate the background and its rms on a coarse grid of meshes, the way SExtractor does.
+
+    The image is read one row of meshes at a time, so only mesh_size rows are in memory at once. Each mesh gets a
+    sigma clipped median, and then the grid is median filtered to get rid of meshes that landed on big objects.
+
+    :param image: 2D image array (can be memory mapped)
+    :param mesh_size: width of the meshes, in pixels
+    :return: background grid, rms grid. Both are (n_mesh_y, n_mesh_x) arrays.
+    """
+    n_mesh_y = int(np.ceil(image.shape[0] / float(mesh_size)))
+    n_mesh_x = int(np.ceil(image.shape[1] / float(mesh_size)))
+    background = np.zeros((n_mesh_y, n_mesh_x))
+    rms = np.zeros((n_mesh_y, n_mesh_x))
+
+    for mesh_row in range(n_mesh_y):
+        strip = np.asarray(image[mesh_row * mesh_size:(mesh_row + 1) * mesh_size], dtype=np.float64)
+        # pad the strip so it divides evenly into meshes. The padding is NaN, which gets ignored.
+        padded = np.full((mesh_size, n_mesh_x * mesh_size), np.nan)
+        padded[:strip.shape[0], :strip.shape[1]] = strip
+        # turn it into (n_mesh_x, pixels in mesh)
+        meshes = padded.reshape(mesh_size, n_mesh_x, mesh_size).transpose(1, 0, 2).reshape(n_mesh_x, -1)
+
+        background[mesh_row], rms[mesh_row] = _clipped_stats_rows(meshes)
+
+    if min(background.shape) >= 3:
+        background = ndimage.median_filter(background, size=3, mode="nearest")
+        rms = ndimage.median_filter(rms, size=3, mode="nearest")
+    return background, rms
+
+
+def _clipped_stats_rows(array, n_sigma=3.0, iterations=3):
+    """Sigma clipped median and standard deviation of each row of an array, ignoring NaNs.
+
+    Each row is sorted once. After that the values that survive the clipping are always a contiguous piece of the
+    sorted row, so every iteration is just finding the ends of that piece. The standard deviation comes from the
+    16th and 84th percentiles, which is robust to whatever is left of the sources.
+
+    :return: median, standard deviation. Both are arrays with one value per row. Rows with nothing in them get 0.
+    """
+    # Make the NaNs infinite, so sorting puts them at the end (sorting with the NaNs still in is much slower).
+    valid = np.isfinite(array)
+    sorted_array = np.sort(np.where(valid, array, np.inf), axis=1)
+    rows = np.arange(array.shape[0])
+    low = np.zeros(array.shape[0], dtype=int)
+    high = valid.sum(axis=1)
+
+    median, sigma = np.zeros(array.shape[0]), np.zeros(array.shape[0])
+    for _ in range(iterations):
+        n = high - low
+        empty = n <= 0
+        n = np.maximum(n, 1)
+        last = array.shape[1] - 1
+        median = (sorted_array[rows, np.minimum(low + (n - 1) // 2, last)] +
+                  sorted_array[rows, np.minimum(low + n // 2, last)]) / 2.0
+        sigma = (sorted_array[rows, np.minimum(low + (0.8413 * (n - 1)).astype(int), last)] -
+                 sorted_array[rows, np.minimum(low + (0.1587 * (n - 1)).astype(int), last)]) / 2.0
+        median[empty], sigma[empty] = 0.0, 0.0
+
+        low = (sorted_array < (median - n_sigma * sigma)[:, np.newaxis]).sum(axis=1)
+        high = (sorted_array <= (median + n_sigma * sigma)[:, np.newaxis]).sum(axis=1)
+    return median, sigma
+
+
+def flux_to_mags(flux, flux_error, zeropoint):
+    """Turn fluxes into magnitudes. Like SExtractor, things with no positive flux get a magnitude of 99.
+
+    :return: magnitudes, magnitude errors
+    """
+    positive = flux > 0
+    safe_flux = np.where(positive, flux, 1.0)
+    mags = np.where(positive, zeropoint - 2.5 * np.log10(safe_flux), 99.0)
+    # 2.5 / ln(10) = 1.0857
+    mag_errors = np.where(positive, 1.0857 * flux_error / safe_flux, 99.0)
+    return mags, mag_errors
+
+
+def write_catalog(catalog_path, sources, mags, mag_errors, flags):
+    """Write a catalog in the SExtractor ASCII_HEAD format, with one header line per column.
+
+    Numbers are always written in fixed point, since the catalog reader doesn't understand exponents.
+    """
+    catalog_file = open(catalog_path, "w")
+    for column_number, (name, _, description) in enumerate(catalog_columns):
+        catalog_file.write("#{:4d} {:22s} {}\n".format(column_number + 1, name, description))
+
+    row_format = " ".join([column[1] for column in catalog_columns]) + "\n"
+    for i in range(len(mags)):
+        catalog_file.write(row_format.format(i + 1, sources["ra"][i], sources["dec"][i], mags[i], mag_errors[i],
+                                             sources["fwhm"][i], int(flags[i]), sources["class_star"][i]))
+    catalog_file.close()
+
+
+def _read_config(sex_file):
+    """Read the parameters we need from the .sex file, falling back on SExtractor's defaults."""
+    apertures = SExtractor_functions.find_config_value(sex_file, "PHOT_APERTURES", "5")
+    return {"thresh": float(SExtractor_functions.find_config_value(sex_file, "DETECT_THRESH", "1.5").split(",")[0]),
+            "minarea": int(SExtractor_functions.find_config_value(sex_file, "DETECT_MINAREA", "5")),
+            "back_size": int(SExtractor_functions.find_config_value(sex_file, "BACK_SIZE", "64").split(",")[0]),
+            "aperture": float(apertures.split(",")[0]),
+            "gain": float(SExtractor_functions.find_config_value(sex_file, "GAIN", "0.0")),
+            "saturation": float(SExtractor_functions.find_config_value(sex_file, "SATUR_LEVEL", "50000.0"))}
+
+
+def _get_background_map(image_path, image, mesh_size):
+    """background_map, but only done once per image, since detection and photometry both need it."""
+    key = (_file_key(image_path), mesh_size)
+    maps = _get_cached(_background_cache, key)
+    if maps is None:
+        maps = _set_cached(_background_cache, key, background_map(image, mesh_size))
+    return maps
+
+
+def _get_cached(cache, key):
+    """Get something from one of the caches, marking it as the most recently used. None if it isn't there."""
+    if key not in cache:
+        return None
+    value = cache.pop(key)
+    cache[key] = value
+    return value
+
+
+def _set_cached(cache, key, value):
+    """Put something in one of the caches, dropping the least recently used to keep it small. Returns the value."""
+    while len(cache) >= max_cached_images:
+        cache.popitem(last=False)
+    cache[key] = value
+    return value
+
+
+def _file_key(path):
+    """Key for the caches that changes if the file does."""
+    stat = os.stat(path)
+    return os.path.realpath(path), stat.st_mtime, stat.st_size
+
+
+def _mesh_coordinates(ys, xs, mesh_size):
+    """Convert pixel positions into positions on the mesh grid. Mesh centers are at integer mesh coordinates."""
+    return np.array([(ys + 0.5) / mesh_size - 0.5, (xs + 0.5) / mesh_size - 0.5])
+
+
+def _interpolate_map(mesh_map, mesh_size, region):
+    """Bilinearly interpolate a mesh map onto every pixel in a region of the image."""
+    # The interpolation is separable, so find the neighboring meshes and weights along each axis once, then combine
+    # them with broadcasting.
+    mesh_ys = np.clip((np.arange(region[0], region[1]) + 0.5) / mesh_size - 0.5, 0, mesh_map.shape[0] - 1)
+    mesh_xs = np.clip((np.arange(region[2], region[3]) + 0.5) / mesh_size - 0.5, 0, mesh_map.shape[1] - 1)
+    y_below = np.floor(mesh_ys).astype(int)
+    x_below = np.floor(mesh_xs).astype(int)
+    y_above = np.minimum(y_below + 1, mesh_map.shape[0] - 1)
+    x_above = np.minimum(x_below + 1, mesh_map.shape[1] - 1)
+    y_weight = (mesh_ys - y_below)[:, np.newaxis]
+    x_weight = (mesh_xs - x_below)[np.newaxis, :]
+
+    lower_row = mesh_map[y_below][:, x_below] * (1 - x_weight) + mesh_map[y_below][:, x_above] * x_weight
+    upper_row = mesh_map[y_above][:, x_below] * (1 - x_weight) + mesh_map[y_above][:, x_above] * x_weight
+    return (lower_row * (1 - y_weight) + upper_row * y_weight).astype(np.float32)
+
+
+def _stellarity(image_path, xs, ys, psf_fwhm, config):
+    """A simple star/galaxy classifier, standing in for SExtractor's neural network CLASS_STAR.
+
+    Uses how concentrated each source's light is: the flux within half the seeing of its center over the flux within
+    twice the seeing. Apertures get all the light, unlike the isophotes the FWHM column comes from, which cut off the
+    faint outer parts of galaxies and make them look almost as small as stars. Stars all have the concentration of
+    the PSF, and galaxies are less concentrated. The concentration of the PSF is taken from the most concentrated of
+    the bright sources, so it doesn't matter what shape the PSF is.
+
+    1 is a star, and 0 is a galaxy. Sources too faint to tell go towards 0.5, like with SExtractor.
+
+    :param image_path: path to the detection image
+    :param xs: array of x positions of the sources, in pixels starting at 0
+    :param ys: array of y positions
+    :param psf_fwhm: seeing, in pixels
+    :param config: dictionary of parameters, from _read_config
+    :return: array of the stellarity of each source
+    """
+    if len(xs) == 0:
+        return np.array([])
+    inner, inner_error = aperture_photometry(image_path, xs, ys, config, diameter=psf_fwhm)[:2]
+    outer, outer_error = aperture_photometry(image_path, xs, ys, config, diameter=4 * psf_fwhm)[:2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        concentration = inner / outer
+        concentration_error = np.abs(concentration) * np.sqrt((inner_error / inner)**2 + (outer_error / outer)**2)
+    measured = (outer > 0) & np.isfinite(concentration) & np.isfinite(concentration_error)
+
+    # the stellar locus, from the bright sources. A Gaussian PSF has half its light within half its FWHM.
+    bright = measured & (outer > stellarity_bright_snr * outer_error)
+    if np.sum(bright) >= 10:
+        psf_concentration = np.percentile(concentration[bright], 90)
+    else:
+        psf_concentration = 0.5
+
+    # How much less concentrated than the PSF a source is, relative to the difference a galaxy makes. The fainter it
+    # is, the less it's trusted, since the difference could just be noise.
+    tolerance = stellarity_tolerance * psf_concentration
+    with np.errstate(invalid="ignore"):
+        difference = np.clip(psf_concentration - concentration, 0, None) / tolerance
+        trust = 1.0 / (1.0 + (concentration_error / tolerance)**2)
+    stellarity = trust * np.exp(-0.5 * difference**2) + (1 - trust) * 0.5
+    return np.where(measured, stellarity, 0.5)
@@ -0,0 +1,232 @@
+"""Cache of the results of Cluster.fit_z, saved on disk.
+
+Fitting the same sources with the same cuts and the same models always gives the same answer, so there is no need
+to do it again. Each result is saved in its own .npz file in global_paths.fit_cache_directory, named by a key that
+is a hash of everything the fit depends on:
+    - the sources: positions, magnitudes, and colors (with errors). For the few clusters fit_z doesn't do the
+      location cut on, whether they are in the location cut too. For the rest, fit_z finds it again every time from
+      the center and radius, so what's left on the sources from before doesn't matter.
+    - the name of the cluster, since a few clusters are treated differently
+    - the center of the location cut, for clusters that have one (see Cluster.center)
+    - the color being fit
+    - the cuts in Cluster (the location cut radius, how its center is found, and all the color and magnitude cuts),
+      and how the initial redshift is found
+    - the predictions: every redshift, with its magnitudes and red sequence slope
+    - fit_version, which is bumped when fit_z itself changes
+If any of them change, the key changes, so there's no way to get a stale result. Old results just stop being
+used, and get cleaned out by evict once the cache gets too big or they get too old.
+
+Each file holds the redshift, its errors, and the RS membership, location cut, and color residual of every source,
+which is everything fit_z leaves behind.
+"""
+import os
+import time
+import hashlib
+import numpy as np
+from PhotoZ import global_paths
+
+# Limits on the cache. When it gets bigger than this, the least recently used results are deleted first. Results
+# that haven't been used in this many days are deleted no matter what.
+max_cache_size = 2 * 1024**3  # bytes
+max_cache_age = 90  # days
+# How many results are stored between checks of the limits. Checking means listing the whole directory.
+eviction_interval = 200
+
+# Bump this when fit_z changes in a way that changes its results, so results from before aren't used.
+fit_version = 3
+
+_stores_since_eviction = 0
+# The predictions are the same for every fit, so their hash only needs to be calculated once. Keys are colors, and
+# values are (the predictions dictionary, its hash). The dictionary itself is kept, rather than its id, so the hash
+# is only used for that same dictionary.
+_predictions_hash = dict()
+
+
+def make_key(cluster, color):
+    """Make the key for fitting this cluster in this color, as things are right now.
+
+    Needs to be called before fitting starts, since fit_z changes the location cut on the sources of the clusters
+    that keep theirs.
+
+    :param cluster: Cluster object
+    :param color: color that will be fit, like "sloan_r-sloan_z"
+    :return: hex string
+    """
+    sha = hashlib.sha1()
+    center = tuple(cluster.center) if cluster.center is not None else None
+    sha.update(repr((cluster.name, center)))
+    sha.update(make_settings_key(cluster, color))
+    sha.update(_hash_sources(cluster.sources_list, not cluster._has_location_cut()))
+    return sha.hexdigest()
+
+
+def make_settings_key(cluster, color):
+    """Make a key for how a color is fit, without anything about the cluster's sources: the cuts, the predictions,
+    and fit_version. The pipeline uses this too, to know when its fits are out of date.
+
+    :param cluster: Cluster object, or the Cluster class, whose cuts and predictions will be used.
+    :param color: color that will be fit, like "sloan_r-sloan_z"
+    :return: hex string
+    """
+    sha = hashlib.sha1()
+    sha.update(repr((fit_version, color, cluster.location_cut_radius, cluster.center_bin_size,
+                     cluster.center_smoothing, cluster.initial_cuts, cluster.bluer_color_cuts,
+                     cluster.redder_color_cuts, cluster.brighter_mag_cut, cluster.dimmer_mag_cut, cluster.final_cuts,
+                     cluster.fast_initial_redshift)))
+    sha.update(_hash_predictions(cluster.predictions_dict, color))
+    return sha.hexdigest()
+
+
+def load(cluster, color, key):
+    """Look for a result in the cache. If it's there, put it into the cluster just like fit_z would have.
+
+    :param cluster: Cluster object
+    :param color: color that was fit
+    :param key: key from make_key
+    :return: True if the result was found, False if not.
+    """
+    path = _result_path(key)
+    if not os.path.isfile(path):
+        return False
+    try:
+        result = np.load(path)
+        cached = {name: result[name] for name in result.files}
+        result.close()
+    except (IOError, ValueError):
+        # Something else is deleting it, or it's broken. Either way just fit again.
+        return False
+    if len(cached["RS_member"]) != len(cluster.sources_list):
+        return False
+
+    if str(cached["rs_z"]):
+        cluster.rs_z[color] = str(cached["rs_z"])
+        cluster.upper_photo_z_error[color] = float(cached["upper_photo_z_error"])
+        cluster.lower_photo_z_error[color] = float(cached["lower_photo_z_error"])
+    for source, in_location, rs_member, residual in zip(cluster.sources_list, cached["in_location"].tolist(),
+                                                        cached["RS_member"].tolist(),
+                                                        cached["color_residual"].tolist()):
+        source.in_location = in_location
+        source.RS_member = rs_member
+        if not np.isnan(residual):
+            source.color_residual = residual
+
+    # mark it as recently used, so it is the last thing to be evicted
+    os.utime(path, None)
+    return True
+
+
+def store(cluster, color, key):
+    """Save the result of a fit that just finished.
+
+    :param cluster: Cluster object that was just fit
+    :param color: color that was fit
+    :param key: key from make_key, made before the fit started
+    :return: None
+    """
+    global _stores_since_eviction
+    if not os.path.isdir(global_paths.fit_cache_directory):
+        try:
+            os.makedirs(global_paths.fit_cache_directory)
+        except OSError:
+            if not os.path.isdir(global_paths.fit_cache_directory):
+                raise
+
+    sources = cluster.sources_list
+    result = {"rs_z": np.array(cluster.rs_z.get(color, "")),
+              "upper_photo_z_error": np.array(cluster.upper_photo_z_error.get(color, np.nan)),
+              "lower_photo_z_error": np.array(cluster.lower_photo_z_error.get(color, np.nan)),
+              "in_location": np.array([source.in_location for source in sources], dtype=bool),
+              "RS_member": np.array([source.RS_member for source in sources], dtype=bool),
+              "color_residual": np.array([getattr(source, "color_residual", np.nan) for source in sources],
+                                         dtype=np.float64)}
+
+    # write it somewhere else, then move it into place, so no one can read half a file
+    path = _result_path(key)
+    temp_path = path[:-4] + ".tmp." + str(os.getpid()) + ".npz"
+    np.savez(temp_path, **result)
+    os.rename(temp_path, path)
+
+    _stores_since_eviction += 1
+    if _stores_since_eviction >= eviction_interval:
+        evict()
+
+
+def evict(max_size=None, max_age=None):
+    """Delete results that are too old, then the least recently used ones until the cache is small enough.
+
+    :param max_size: biggest the cache can be, in bytes. Defaults to max_cache_size.
+    :param max_age: oldest a result can be, in days since it was last used. Defaults to max_cache_age.
+    :return: number of results deleted
+    """
+    global _stores_since_eviction
+    _stores_since_eviction = 0
+    if max_size is None:
+        max_size = max_cache_size
+    if max_age is None:
+        max_age = max_cache_age
+    if not os.path.isdir(global_paths.fit_cache_directory):
+        return 0
+
+    results = []
+    for filename in os.listdir(global_paths.fit_cache_directory):
+        if not filename.endswith(".npz") or ".tmp." in filename:
+            continue
+        path = os.path.join(global_paths.fit_cache_directory, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # someone else got rid of it
+        results.append((stat.st_mtime, stat.st_size, path))
+    results.sort(reverse=True)  # most recently used first
+
+    oldest_allowed = time.time() - max_age * 24 * 3600
+    total_size = 0
+    deleted = 0
+    for last_used, size, path in results:
+        total_size += size
+        if last_used < oldest_allowed or total_size > max_size:
+            try:
+                os.remove(path)
+                deleted += 1
+            except OSError:
+                pass
+    return deleted
+
+
+def _result_path(key):
+    return os.path.join(global_paths.fit_cache_directory, key + ".npz")
+
+
+def _hash_sources(sources, include_location):
+    """Hash everything about the sources the fit uses. Done with arrays rather than source by source, since there
+    can be a lot of sources.
+
+    :param include_location: whether the location cut on the sources is used by the fit.
+    """
+    sha = hashlib.sha1()
+    sha.update(np.array([source.ra for source in sources], dtype=np.float64).tostring())
+    sha.update(np.array([source.dec for source in sources], dtype=np.float64).tostring())
+    if include_location:
+        sha.update(np.array([source.in_location for source in sources], dtype=bool).tostring())
+    for attribute in ["mags", "colors"]:
+        keys = set()
+        for source in sources:
+            keys.update(getattr(source, attribute))
+        for key in sorted(keys):
+            values = [getattr(source, attribute).get(key) for source in sources]
+            sha.update(key)
+            sha.update(np.array([d.value if d else np.nan for d in values], dtype=np.float64).tostring())
+            sha.update(np.array([d.error if d else np.nan for d in values], dtype=np.float64).tostring())
+    return sha.hexdigest()
+
+
+def _hash_predictions(predictions_dict, color):
+    """Hash the predicted magnitudes and the red sequence slopes at every redshift, for one color."""
+    if color not in _predictions_hash or _predictions_hash[color][0] is not predictions_dict:
+        sha = hashlib.sha1()
+        for z in sorted(predictions_dict):
+            prediction = predictions_dict[z]
+            sha.update(repr((z, sorted(prediction.mags_dict.items()),
+                             prediction.slope_dict.get(color, dict()).get(prediction.redshift))))
+        _predictions_hash[color] = (predictions_dict, sha.hexdigest())
+    return _predictions_hash[color][1]
@@ -0,0 +1,177 @@
+import os
+import json
+from astropy.io import fits
+from PhotoZ import functions
+from PhotoZ import global_paths
+
+# Header keywords the index looks at. Different telescopes put the filter in different places, so check all of them.
+filter_keywords = ["FILTER", "FILTER1", "FILTER2", "FILTER3"]
+# Filter wheel positions that don't tell us anything about the band.
+empty_filter_names = ["open", "clear", "blank", "none", ""]
+
+
+class FitsIndex(object):
+    """Small persistent index of the metadata in the primary headers of all the images.
+
+    Only the headers are read. astropy reads the header blocks at the front of the file and stops, so the pixel data
+    of the (possibly multi-GB) mosaics is never touched. The results are saved to disk as a JSON file, so the next
+    run doesn't have to open the images at all unless they have changed.
+
+    Each entry is a dictionary with keys "fwhm", "band", "cluster", "object", "ra", "dec", "exposure", "filter",
+    "mtime" and "size". Anything not found in the header is None. Entries can also hold things measured from the
+    image, like "measured_fwhm". Those go away with the rest of the entry if the image changes.
+    """
+
+    def __init__(self, index_path=None):
+        """Load the index from disk, or start an empty one if it doesn't exist yet.
+
+        :param index_path: location of the JSON file holding the index. Defaults to the one in global_paths.
+        """
+        if index_path is None:
+            index_path = global_paths.fits_index
+        self.index_path = index_path
+        self.entries = dict()
+        self._changed = False
+
+        if os.path.isfile(self.index_path):
+            index_file = open(self.index_path, "r")
+            try:
+                self.entries = json.load(index_file)
+            except ValueError:
+                # The index got corrupted somehow. It's just a cache, so start over.
+                print "The FITS index at " + self.index_path + " could not be read. Rebuilding it."
+                self.entries = dict()
+            index_file.close()
+
+    def scan(self, directories):
+        """Find all the .fits images in the given directories, and make sure they are all in the index.
+
+        Images that are already in the index and haven't changed since then are not opened again.
+
+        :param directories: directory, or list of directories, to search. Subdirectories are searched too.
+        :return: sorted list of the paths of all the images found.
+        """
+        if type(directories) is str:
+            directories = [directories]
+
+        image_paths = []
+        for directory in directories:
+            functions.find_all_objects(directory, [".fits"], image_paths)
+
+        for path in image_paths:
+            self.lookup(path)
+
+        # Get rid of images that aren't there anymore, so the index doesn't grow forever.
+        for path in self.entries.keys():
+            if not os.path.isfile(path):
+                del self.entries[path]
+                self._changed = True
+
+        self.save()
+        return sorted(image_paths)
+
+    def lookup(self, image_path):
+        """Get the index entry for an image, reading its header only if it is new or has changed on disk.
+
+        :param image_path: path to the .fits image
+        :return: dictionary with the metadata for that image.
+        """
+        image_path = os.path.realpath(image_path)
+        stat = os.stat(image_path)
+        entry = self.entries.get(image_path)
+
+        # use the modification time and size to tell if the file changed since it was indexed
+        if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            entry = read_header_metadata(image_path)
+            entry["mtime"] = stat.st_mtime
+            entry["size"] = stat.st_size
+            self.entries[image_path] = entry
+            self._changed = True
+        return entry
+
+    def mark_changed(self):
+        """Tell the index one of its entries was modified from the outside, so it gets saved next time."""
+        self._changed = True
+
+    def save(self):
+        """Write the index to disk, if anything has changed since it was loaded."""
+        if not self._changed:
+            return
+        directory = os.path.dirname(self.index_path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another process made it in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        # Write to a temporary file first, then move it into place, so a crash can't leave half an index behind. The
+        # temporary file is named by the process, so processes saving at the same time don't write into the same one.
+        temp_path = self.index_path + ".tmp." + str(os.getpid())
+        index_file = open(temp_path, "w")
+        json.dump(self.entries, index_file, indent=1, sort_keys=True)
+        index_file.close()
+        os.rename(temp_path, self.index_path)
+        self._changed = False
+
+
+def read_header_metadata(image_path):
+    """Read the things we care about from the primary header of an image.
+
+    :param image_path: path to the .fits image
+    :return: dictionary of metadata. See the FitsIndex class for the keys.
+    """
+    # getheader only parses the header blocks, it doesn't load (or even memory map) the data.
+    header = fits.getheader(image_path, 0)
+    filename = image_path.split("/")[-1]
+
+    header_filter = None
+    for keyword in filter_keywords:
+        value = str(header.get(keyword, "")).strip()
+        if value.lower() not in empty_filter_names:
+            header_filter = value
+            break
+
+    return {"fwhm": _get_float(header, ["FWHMPSF"]),
+            "band": _band_from_filter(header_filter, filename),
+            "filter": header_filter,
+            # Calling them coordinates is generous, it is just an 8 digit string from the filename. Images with the
+            # same string are of the same cluster.
+            "cluster": functions.get_numbers_from_filename(filename),
+            "object": header.get("OBJECT"),
+            "ra": _get_float(header, ["RA", "CRVAL1"]),
+            "dec": _get_float(header, ["DEC", "CRVAL2"]),
+            "exposure": _get_float(header, ["EXPTIME", "EXPOSURE"])}
+
+
+def _get_float(header, keywords):
+    """Return the value of the first of the keywords that is in the header and is a number, or None."""
+    for keyword in keywords:
+        try:
+            return float(header[keyword])
+        except (KeyError, ValueError, TypeError):
+            # Not there, or not a number (sexagesimal RA, for example). Try the next one.
+            continue
+    return None
+
+
+def _band_from_filter(header_filter, filename):
+    """Find the band of an image. The filename is the convention the rest of the code uses, so that wins if it gives
+    a band we know about. Otherwise fall back to the filter in the header (Gemini calls them things like "z_G0304").
+    """
+    band = functions.get_band_from_filename(filename)
+    if band in ["r", "z"] or header_filter is None:
+        return band
+    return header_filter.split("_")[0].lower()
+
+
+# Only want one index in memory, so everything that asks for it shares it.
+_index = None
+
+
+def get_index():
+    """Return the shared FitsIndex, loading it from disk the first time this is called."""
+    global _index
+    if _index is None:
+        _index = FitsIndex()
+    return _index
@@ -110,19 +110,33 @@ def make_cluster_name(filename):
     return "not working"
 
 
-# TODO: delete this function? whould
-# def get_band_from_filename(filename):
-#     # DOCUMENTED
-#     """Finds the band of an image or catalog based on the filename.
-#
-#     Assumes file names are of the form object_name_band.extension
-#
-#     :param filename: string with the filename
-#     :return: string containing the band
-#     """
-#     file_no_extension = filename.split(".")[0]  # first thing before a .
-#     band = file_no_extension.split("_")[-1]  # the band will be the last thing in the name itself
-#     return band
+def get_band_from_filename(filename):
+    # DOCUMENTED
+    """Finds the band of an image or catalog based on the filename.
+
+    Assumes file names are of the form object_name_band.extension
+
+    :param filename: string with the filename
+    :return: string containing the band
+    """
+    filename = filename.split("/")[-1]  # in case we were passed the whole path
+    file_no_extension = filename.split(".")[0]  # first thing before a .
+    band = file_no_extension.split("_")[-1]  # the band will be the last thing in the name itself
+    return band
+
+
+def get_numbers_from_filename(filename):
+    """Parse the filename, and return the 8 digits that correspond to the coordinates of the image in the file.
+
+    :param filename: filename to be parsed. Do not pass the full path, just the filename.
+    :return: string of digits representing the coordinates from the filename.
+    """
+    coordinate_digits = ""
+    for letter in filename:
+        if len(coordinate_digits) < 8:  # Only the first 8 digits in the filename correspond to coordinates.
+            if letter.isdigit():
+                coordinate_digits += letter
+    return coordinate_digits
 
 def distance(x1, x2, y1, y2):
     """Uses the distance formula to calculate the distance between 2 objects
@@ -19,6 +19,13 @@ home_directory = os.path.dirname(os.path.realpath(__file__)) + "/"  # DO NOT CHA
 # in this directory.
 images_directory = [base_directory + "Astro/RS_finding/Data/Images/Gemini/Corrected/"]
 
+# File holding the index of the metadata in the image headers (FWHM, band, pointing, exposure), so the images don't
+# have to be opened every time we need to know something about them.
+fits_index = base_directory + "GoogleDrive/Research/Data/CodeData/fits_index.json"
+
+# The SExtractor executable itself
+sextractor_executable = "/usr/local/scisoft///bin/sex"
+
 # SExtractor will run from here. This directory should hold the .sex and .param files that SExtractor uses
 sextractor_params_directory = base_directory + "GoogleDrive/Research/SExtractor_files/"
 
@@ -76,9 +83,33 @@ resources = home_directory + "data/resources.p"
 # directory to store RS slopes. W# TODO: consolidate this into one thing with other various data
 rs_slopes = base_directory + "GoogleDrive/Research/Data/CodeData/Best_fit_RS_slope.pickle"
 
-# Place to store Python saved objects. Clusters will be pickled to this location.
-pickle_file = base_directory + "GoogleDrive/Research/Data/CodeData/PythonSavedClusters/Clusters.p"
-finished_pickle_file = base_directory + "GoogleDrive/Research/Data/CodeData/PythonSavedClusters/FinishedClusters.p"
+# Places to store the checkpoints of the cluster list. Each is a directory holding one .npz file per cluster with its
+# sources stored as columns, plus an index.json with the cluster level information. See checkpoints.py.
+checkpoint_directory = base_directory + "GoogleDrive/Research/Data/CodeData/PythonSavedClusters/Clusters/"
+finished_checkpoint_directory = base_directory + "GoogleDrive/Research/Data/CodeData/PythonSavedClusters/" \
+                                                 "FinishedClusters/"
+
+# Directory holding the results of previous fits, so fitting the same thing again can be skipped. See fit_cache.py.
+fit_cache_directory = base_directory + "GoogleDrive/Research/Data/CodeData/fit_cache/"
+
+# Directory where the pipeline keeps track of what it has already made, and from what. See pipeline.py.
+pipeline_state_directory = base_directory + "GoogleDrive/Research/Data/CodeData/pipeline_state/"
+
+# Directory holding prediction cubes, so EzGal doesn't have to make them again. See predictions.make_prediction_cube.
+prediction_cube_directory = base_directory + "GoogleDrive/Research/Data/CodeData/prediction_cubes/"
+
+# Where prediction grids are put so worker processes can share them. This should be in memory, like /dev/shm on
+# Linux, if there is one. See shared_predictions.py.
+if os.path.isdir("/dev/shm"):
+    shared_predictions_directory = "/dev/shm/photoz_predictions/"
+else:
+    shared_predictions_directory = "/tmp/photoz_predictions/"
+
+# Same for the source tables of clusters being worked on in parallel. See source_arena.py.
+if os.path.isdir("/dev/shm"):
+    shared_sources_directory = "/dev/shm/photoz_sources/"
+else:
+    shared_sources_directory = "/tmp/photoz_sources/"
 
 # All these variables that hold file locations will be called as global variables from within functions,
 # just so I don't have to waste time passing all them around. It would be a mess.
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""Finding the initial redshift of a cluster from the redshift each source's color implies, rather than by trying every
+redshift.
+
+_find_initial_redshift counts the sources near the model red sequence at every redshift, which is a
+[redshifts, sources] comparison. But at a given magnitude, the color of the model red sequence goes up with
+redshift, so a source's magnitude and color pick out the one redshift whose red sequence goes through it. The model
+lines are turned around once into a table of that redshift on a grid of magnitude and color, and then the implied
+redshift of every source is one interpolation in the table.
+
+The sources then go into a histogram on the bins of the redshift axis. Each source is spread over the redshifts
+implied by its color moved by the initial color cuts, which are the redshifts _find_initial_redshift would count it
+at, and sources with bigger color errors count less. The same magnitude cuts as the initial cut in fit_z are used, at
+each source's implied redshift. The initial redshift is the peak of the histogram once it's smoothed by adding up the
+neighbors, like _find_initial_redshift does with its counts. Making the histogram is a few passes over the sources,
+rather than one over the sources at every redshift.
+
+Where the model color goes down with redshift, the redder color of the lower redshift is used instead, so the table
+can still be turned around. Sources bluer or redder than every model line by more than the initial color cut don't
+imply any redshift.
+"""
+import hashlib
+import numpy as np
+from scipy import ndimage
+
+# spacing of the grid of the table, in magnitudes and in magnitudes of color
+mag_step = 0.05
+color_step = 0.01
+# how far past the pivot magnitudes of the models the table goes. Fainter or brighter sources use its edge.
+mag_margin = 3.0
+
+# the tables made so far, with (color, color margin, hash of the lines) as keys
+_tables = dict()
+
+
+def implied_redshifts(color, lines, mags, colors, color_margin=0.1):
+    """Find the redshift each source's magnitude and color put it on the red sequence of.
+
+    :param color: color the lines are for, like "sloan_r-sloan_z"
+    :param lines: color zeropoints, slopes, and pivot magnitudes of the model lines at each redshift, like
+                  Cluster._get_model_lines gives.
+    :param mags: array of the magnitudes of the sources in the redder band
+    :param colors: array of their colors
+    :param color_margin: how far bluer or redder than every model line a source can be and still imply the lowest or
+                         highest redshift.
+    :return: array of the implied redshift of each source, as a (fractional) index on the redshift axis. NaN for
+             sources that don't have one.
+    """
+    table, first_mag, first_color = _get_table(color, lines, color_margin)
+    with np.errstate(invalid="ignore"):
+        mag_coordinates = np.clip((mags - first_mag) / mag_step, 0, table.shape[0] - 1)
+        color_coordinates = (colors - first_color) / color_step
+    # sources without data are put off the table, so they get NaN
+    missing = ~(np.isfinite(mag_coordinates) & np.isfinite(color_coordinates))
+    mag_coordinates[missing] = -1
+    color_coordinates[missing] = -1
+    return ndimage.map_coordinates(table, [mag_coordinates, color_coordinates], order=1, mode="constant",
+                                   cval=np.nan)
+
+
+def count_near_red_sequence(color, lines, mags, colors, color_errors, in_sample, cuts, segment=None, n_segments=1):
+    """Make the histogram of the implied redshifts of the sources, for one or many clusters at once.
+
+    Like _find_initial_redshift, each source counts at every redshift whose red sequence is within the initial color
+    cuts of it. That's the range between the redshifts implied by its color moved by each of the cuts, so it's
+    added to the histogram as +1 where the range starts and -1 after it ends, and then added up along the redshifts.
+
+    :param color: color the lines are for
+    :param lines: model lines, like Cluster._get_model_lines gives.
+    :param mags: array of the magnitudes of the sources in the redder band
+    :param colors: array of their colors
+    :param color_errors: array of the errors on their colors
+    :param in_sample: boolean array of which sources count
+    :param cuts: the initial cuts, like Cluster.initial_cuts. The magnitude cuts are done at each source's implied
+                 redshift.
+    :param segment: array of which cluster each source is in, for counting many clusters at once. Defaults to all
+                    in one.
+    :param n_segments: how many clusters there are
+    :return: array of the weighted counts, in thousandths of a source, with dimensions of [redshifts, clusters]
+    """
+    n_redshifts = len(lines[0])
+    if segment is None:
+        segment = np.zeros(len(mags), dtype=int)
+    bluer_cut, redder_cut = cuts[:2]
+    color_margin = max(abs(bluer_cut), abs(redder_cut))
+    # a source is bluer than the red sequence at the redshifts past the one its color implies
+    redshifts, first, last = [implied_redshifts(color, lines, mags, colors + offset, color_margin)
+                              for offset in [0, -redder_cut, -bluer_cut]]
+
+    with np.errstate(invalid="ignore"):
+        counted = in_sample & (color_errors <= 0.2) & np.isfinite(redshifts)
+        predicted_mags = np.interp(np.where(counted, redshifts, 0), np.arange(n_redshifts), lines[2])
+        counted &= (mags > predicted_mags + cuts[2]) & (mags < predicted_mags + cuts[3])
+    # past the ends of the table, the range goes to the end of the redshifts
+    first, last = first[counted], last[counted]
+    first = np.ceil(np.where(np.isnan(first), 0, first)).astype(int)
+    last = np.floor(np.where(np.isnan(last), n_redshifts - 1, last)).astype(int)
+    # A source with no error counts once, and ones with errors as big as the color cut count half. They are in
+    # thousandths, so they are whole numbers and the counts come out the same whatever order they are added up in.
+    weights = np.rint(1000 * color_margin**2 / (color_errors[counted]**2 + color_margin**2))
+
+    segment = segment[counted]
+    changes = (np.bincount(first * n_segments + segment, weights, minlength=(n_redshifts + 1) * n_segments) -
+               np.bincount((last + 1) * n_segments + segment, weights, minlength=(n_redshifts + 1) * n_segments))
+    return np.cumsum(changes.reshape(n_redshifts + 1, n_segments), axis=0)[:-1].astype(int)
+
+
+def _get_table(color, lines, color_margin):
+    """Get the table of the redshift implied by each magnitude and color, making it the first time.
+
+    The lines are hashed for the key, so the same lines always find the same table, even when they are a different
+    copy, and tables of lines that aren't around anymore can't be found by new ones.
+
+    :return: the table, as an array of indices on the redshift axis with dimensions of [magnitudes, colors], then the
+             magnitude and color of its first row and column.
+    """
+    sha = hashlib.sha1()
+    for line in lines:
+        sha.update(np.ascontiguousarray(line, dtype=np.float64).tostring())
+    key = (color, color_margin, sha.hexdigest())
+    if key not in _tables:
+        zeropoints, slopes, pivot_mags = lines
+        indices = np.arange(len(zeropoints), dtype=np.float64)
+        mag_grid = np.arange(pivot_mags.min() - mag_margin, pivot_mags.max() + mag_margin + mag_step, mag_step)
+        # the model color at every magnitude and redshift, with dimensions of [magnitudes, redshifts]. Where it goes
+        # down with redshift, the redder color of a lower redshift is kept, so it can be turned around.
+        model_colors = zeropoints + slopes * (mag_grid[:, np.newaxis] - pivot_mags)
+        model_colors = np.maximum.accumulate(model_colors, axis=1)
+
+        first_color = model_colors.min() - color_margin
+        color_grid = np.arange(first_color, model_colors.max() + color_margin + color_step, color_step)
+        table = np.array([np.interp(color_grid, row, indices) for row in model_colors])
+        # past the ends of a row is only within color_margin of its bluest or reddest line
+        table[(color_grid < model_colors[:, :1] - color_margin) |
+              (color_grid > model_colors[:, -1:] + color_margin)] = np.nan
+        _tables[key] = (table, mag_grid[0], first_color)
+    return _tables[key]
@@ -164,17 +164,15 @@ def make_all_equiv_z(colors, print_results=False):
 
 
 
-def make_slopes(colors):
+def fit_slopes(colors):
     """
-    Calculate the slope of the red sequence in different filter combinations.
+    Fit the slope of the red sequence as a function of redshift, in different filter combinations.
 
-    :param colors:strings that are filter combinations of the form [bluer filter]-[redder filter]. Check config_data.py
-    for examples.
-    :return:dictionary of keys=filter combinations and values=lambda functions describing the red sequence in that filter
-        as a function of redshift. The given redshift will be input to the lambda function, and the slope of the red
-        sequence will be returned.
+    :param colors: strings that are filter combinations of the form [bluer filter]-[redder filter]. Check
+    config_data.py for examples.
+    :return: dictionary of keys=filter combinations and values=polynomial coefficients of the fit, constant term
+        first, like numpy.polynomial.polynomial.polyval wants them. The slope at redshift z is fit[0] + z * fit[1].
     """
-
     # first get the equivalent redshifts
     color_equivalent_redshifts = make_all_equiv_z(colors, print_results=False)
 
@@ -185,16 +183,29 @@ def make_slopes(colors):
     #turn these errors into weights
     weights = [1/error for error in slope_errors]
 
+    return {color: polynomial.polyfit(color_equivalent_redshifts[color], slopes, 1, w=weights)
+            for color in color_equivalent_redshifts}
+
+
+def make_slopes(colors):
+    """
+    Calculate the slope of the red sequence in different filter combinations.
+
+    :param colors:strings that are filter combinations of the form [bluer filter]-[redder filter]. Check config_data.py
+    for examples.
+    :return:dictionary of keys=filter combinations and values=lambda functions describing the red sequence in that filter
+        as a function of redshift. The given redshift will be input to the lambda function, and the slope of the red
+        sequence will be returned.
+    """
+
     # initialize a dictionary that will be populated with lambda functions that describe the slope of the red sequence
     # as a function of redshift
     slope_dict = dict()
 
-    for color in color_equivalent_redshifts:
-        redshifts = color_equivalent_redshifts[color]
-
-        # make the best fit line
-        fit = polynomial.polyfit(redshifts, slopes, 1, w=weights)  # this returns 2 coefficients (first is constant,
-        #  second is coefficient in front of x)
+    # make the best fit lines. Each has 2 coefficients (first is constant, second is coefficient in front of x)
+    fits = fit_slopes(colors)
+    for color in fits:
+        fit = fits[color]
 
         # turn these coefficients into a dictionary
         slope_dict[color] = {str(round(z, 2)): fit[0] + z * fit[1] for z in np.arange(0, 3, 0.01)}
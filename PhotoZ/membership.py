@@ -0,0 +1,139 @@
+"""Finding the red sequence with a probability of membership for each source, rather than with cuts.
+
+fit_z picks the red sequence members with hard color and magnitude cuts, which get narrower over three rounds, and
+scans the chi-squared again after each one. fit_z_em fits the same thing with expectation-maximization instead. The
+color residuals of the sources from the red sequence at some redshift are modeled as a mixture of:
+    - the red sequence: a Gaussian around the model line, as wide as each source's color error and the intrinsic
+      scatter of the red sequence added in quadrature
+    - the field: a broad Gaussian, whose mean and width are fit too
+Each pass:
+    - finds the probability that each source is on the red sequence, given the redshift and the mixture
+    - finds the redshift where the chi-squared, with each source weighted by that probability, is lowest, and the
+      fraction of sources on the red sequence and the mean and width of the field
+It stops once the redshift is on the same grid point as the pass before and the probabilities have stopped
+changing, which usually takes a few passes. The residuals and chi-squared terms of every source at every redshift are
+made once, as [redshifts, sources] matrices, so a pass is a row of the residuals and a product of the chi-squared
+terms with the probabilities.
+
+Only sources in the location cut, with good colors, and in fit_z's magnitude range around the model at the current
+redshift can be members. The rest have a probability of 0.
+"""
+import numpy as np
+from PhotoZ import Cluster
+from PhotoZ import batch_fitting
+
+# Intrinsic scatter of the red sequence around the model line, in magnitudes of color.
+rs_scatter = 0.05
+# The field is never narrower than this, so it can't take over the red sequence.
+minimum_field_width = 0.1
+# Fitting stops after this many passes, even if it hasn't converged.
+max_iterations = 20
+# Biggest change in any source's probability that still counts as converged.
+tolerance = 1e-3
+
+
+def fit_z_em(cluster, color):
+    """Find the redshift of a cluster by fitting its red sequence as a mixture of the red sequence and the field.
+
+    Sets rs_z and the errors on the cluster like fit_z does. The sources more likely than not to be on the red
+    sequence are set as RS members, and their color residuals are from the best redshift. The fit cache isn't used.
+
+    :param cluster: Cluster object
+    :param color: color to fit, like "sloan_r-sloan_z"
+    :return: array of the probability that each source in sources_list is on the red sequence. None if there weren't
+             enough sources to fit, in which case nothing is set.
+    """
+    if cluster._has_location_cut():
+        cluster._find_location_cut(cluster.location_cut_radius, color)
+    best_z = cluster._find_initial_redshift(color)
+
+    redshifts = cluster.redshift_axis.redshifts
+    zeropoints, slopes, pivot_mags = cluster._get_model_lines(color)
+    mags = cluster.get_mags(color.split("-")[1]).values
+    colors = cluster.get_colors(color)
+    in_location = np.array([source.in_location for source in cluster.sources_list], dtype=bool)
+    with np.errstate(invalid="ignore"):
+        usable = in_location & (colors.errors <= 0.2) & np.isfinite(mags) & np.isfinite(colors.values)
+
+    # the matrices every pass uses, with dimensions of [redshifts, sources]
+    rs_variances = colors.errors**2 + rs_scatter**2
+    with np.errstate(invalid="ignore"):
+        residuals = colors.values - (zeropoints[:, np.newaxis] + slopes[:, np.newaxis] *
+                                     (mags - pivot_mags[:, np.newaxis]))
+        chi_terms = residuals**2 / rs_variances
+    residuals[:, ~usable] = 0
+    chi_terms[:, ~usable] = 0
+
+    # start with the sources near the line at the initial redshift, like fit_z's initial cut
+    eligible = _eligible(usable, mags, pivot_mags[best_z])
+    near_line = eligible & (np.abs(residuals[best_z]) < Cluster.Cluster.initial_cuts[1])
+    if np.sum(near_line) < 3:
+        return None
+    rs_fraction = max(np.sum(near_line) / float(np.sum(eligible)), 0.01)
+    field_mean = np.mean(residuals[best_z][eligible & ~near_line]) if np.any(eligible & ~near_line) else 0.0
+    field_width = max(np.std(residuals[best_z][eligible]), minimum_field_width)
+
+    probabilities = np.zeros(len(mags))
+    for _ in range(max_iterations):
+        # expectation: the probability each source is on the red sequence
+        eligible = _eligible(usable, mags, pivot_mags[best_z])
+        new_probabilities = _rs_probabilities(residuals[best_z], colors.errors, rs_variances, eligible, rs_fraction,
+                                              field_mean, field_width)
+        n_members = np.sum(new_probabilities)
+        if n_members < 3:
+            return None
+
+        # maximization: the mixture, then the redshift
+        field_weights = np.where(eligible, 1 - new_probabilities, 0)
+        rs_fraction = n_members / float(np.sum(eligible))
+        if np.sum(field_weights) > 0:
+            field_mean = np.average(residuals[best_z], weights=field_weights)
+            field_width = max(np.sqrt(np.average((residuals[best_z] - field_mean)**2, weights=field_weights)),
+                              minimum_field_width)
+        chi_values = np.dot(chi_terms, new_probabilities) / (n_members - 1 - 1)
+        best_redshift, lower_error, upper_error = [value[0] for value in
+                                                   batch_fitting.stats_from_chi(redshifts, chi_values[np.newaxis])]
+        last_z, best_z = best_z, cluster.redshift_axis.nearest(best_redshift)
+
+        converged = best_z == last_z and np.max(np.abs(new_probabilities - probabilities)) < tolerance
+        probabilities = new_probabilities
+        if converged:
+            break
+
+    cluster.rs_z[color] = str(round(float(best_redshift), 3))
+    cluster.upper_photo_z_error[color] = float(upper_error)
+    cluster.lower_photo_z_error[color] = float(lower_error)
+    cluster._set_residuals(best_z, color)
+    for source, probability in zip(cluster.sources_list, probabilities.tolist()):
+        source.RS_member = probability > 0.5
+
+    print cluster, color, cluster.rs_z[color], "(EM)"
+    return probabilities
+
+
+def _eligible(usable, mags, predicted_mag):
+    """Which sources can be members at a redshift, with fit_z's magnitude cuts around its predicted magnitude."""
+    return (usable & (mags > predicted_mag + Cluster.Cluster.brighter_mag_cut) &
+            (mags < predicted_mag + Cluster.Cluster.dimmer_mag_cut))
+
+
+def _rs_probabilities(residuals, color_errors, rs_variances, eligible, rs_fraction, field_mean, field_width):
+    """The probability of each source being on the red sequence rather than in the field.
+
+    :param residuals: array of the color residuals of the sources from the red sequence
+    :param color_errors: array of the errors on their colors
+    :param rs_variances: array of the variance of the red sequence at each source, with its error
+    :param eligible: boolean array of which sources can be members. The rest get 0.
+    :param rs_fraction: fraction of the eligible sources on the red sequence
+    :param field_mean: mean of the field's residuals
+    :param field_width: width of the field, without the errors of the sources
+    :return: array of probabilities
+    """
+    field_variances = field_width**2 + color_errors**2
+    with np.errstate(invalid="ignore", over="ignore", divide="ignore"):
+        rs_density = rs_fraction * np.exp(-residuals**2 / (2 * rs_variances)) / np.sqrt(rs_variances)
+        field_density = ((1 - rs_fraction) * np.exp(-(residuals - field_mean)**2 / (2 * field_variances)) /
+                         np.sqrt(field_variances))
+        probabilities = rs_density / (rs_density + field_density)
+    # far from both, the densities can both be 0
+    return np.where(eligible & np.isfinite(probabilities), probabilities, 0)
@@ -1,21 +1,128 @@
 import math
+from array import array
+from scipy import interpolate
+from numpy.polynomial import polynomial
 from PhotoZ import making_slopes
 from PhotoZ import config_data
 import numpy as np
 
 # TODO: document
 
+# Every band (or color) that any source has data in gets a number the first time it is seen. BandData objects store
+# their data at that position, rather than keeping a dictionary of their own.
+band_indices = dict()
+band_names = []
+
+
+def _band_index(band):
+    """Get the number of a band, giving it one if it doesn't have one yet."""
+    if band not in band_indices:
+        band_indices[band] = len(band_names)
+        band_names.append(band)
+    return band_indices[band]
+
+
+class BandData(object):
+    """Holds a source's data in each band, like a dictionary with bands as keys and data objects as values.
+
+    There can be tens of thousands of sources in a cluster, each with a few of these, so they are kept small. The
+    values and errors go in one array of floats, with two spots for each band in band_indices, and which bands
+    actually have data is kept as the bits of an integer. Getting an item makes a new data object each time, so
+    changing that object doesn't change what is stored here. Assign a new data object instead.
+    """
+    __slots__ = ("_data", "_present")
+
+    def __init__(self, items=None):
+        self._data = None  # not made until there is something to put in it, since lots of these stay empty
+        self._present = 0
+        if items:
+            for band, measurement in items:
+                self[band] = measurement
+
+    def __getitem__(self, band):
+        index = band_indices.get(band)
+        if index is None or not (self._present >> index) & 1:
+            raise KeyError(band)
+        return data(self._data[2 * index], self._data[2 * index + 1])
+
+    def __setitem__(self, band, measurement):
+        index = _band_index(band)
+        if self._data is None:
+            self._data = array("d")
+        if len(self._data) <= 2 * index:
+            self._data.extend([0.0] * (2 * index + 2 - len(self._data)))
+        self._data[2 * index] = measurement.value
+        self._data[2 * index + 1] = measurement.error
+        self._present |= 1 << index
+
+    def __delitem__(self, band):
+        if band not in self:
+            raise KeyError(band)
+        self._present &= ~(1 << band_indices[band])
+
+    def __contains__(self, band):
+        index = band_indices.get(band)
+        return index is not None and bool((self._present >> index) & 1)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return bin(self._present).count("1")
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, band, default=None):
+        if band in self:
+            return self[band]
+        return default
+
+    def keys(self):
+        return [band_names[i] for i in range(self._present.bit_length()) if (self._present >> i) & 1]
+
+    def values(self):
+        return [self[band] for band in self.keys()]
+
+    def items(self):
+        return [(band, self[band]) for band in self.keys()]
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        return iter(self.items())
+
+    # The numbers of the bands are different in each process, so pickles store the band names.
+    def __reduce__(self):
+        return BandData, (self.items(),)
+
+
 class Source(object):
-    """Class representing a source detected by SExtractor. Holds data in all bands that exist for the object."""
+    """Class representing a source detected by SExtractor. Holds data in all bands that exist for the object.
+
+    Colors aren't stored on each source, unless they came straight from a catalog. Clusters calculate the colors they
+    need for all their sources at once (see Cluster.get_colors).
+    """
+    __slots__ = ("ra", "dec", "mags", "mag_residuals", "colors", "r_id", "z_id", "in_location", "RS_member",
+                 "color_residual")
+
+    # Goes up every time band data is added to any source, so clusters know to recalculate their colors.
+    band_data_version = 0
 
     def __init__(self, ra, dec, mag_bands, mags, mag_errors, color_bands=None, color_values=None, color_errors =
     None, r_id=None, z_id=None):
         """Create a galaxy object using the information passed in."""
         self.ra = float(ra)
         self.dec = float(dec)
-        self.mags = dict()
-        self.mag_residuals = dict()
-        self.colors = dict()
+        self.mags = BandData()
+        self.mag_residuals = BandData()
+        self.colors = BandData()
         self.r_id = r_id
         self.z_id = z_id
         self.in_location = True
@@ -37,6 +144,7 @@ class Source(object):
 
     def add_band_data(self, mag_band, mag, mag_error):
         self.mags[mag_band] = data(mag, mag_error)
+        Source.band_data_version += 1
 
     def __repr__(self):  # Shows how sources are printed.
         return "(" + "ra=" + str(self.ra) + ", dec=" + str(self.dec) + ")"
@@ -49,16 +157,22 @@ class Source(object):
         """
         self.mag_residuals[band] = data(comparison_mag - self.mags[band].value, self.mags[band].error)
 
-    def calculate_color(self):
-        for band1 in self.mags:
-            for band2 in self.mags:
-                if not band1 == band2:
-                    self.colors[band1 + "-" + band2] = self.mags[band1] - self.mags[band2]
-                    # That line does the error things automatically, since noth mags are data objects
+    # Slotted objects need to say how they are pickled. This also reads sources that were pickled before they had
+    # slots, which have their attributes in a dictionary.
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if name in ["mags", "mag_residuals", "colors"] and not isinstance(value, BandData):
+                value = BandData(value.items())
+            setattr(self, name, value)
 
 
 class data(object):
     """Class that represents a data point. Has a value and a error attribute."""
+    __slots__ = ("value", "error")
+
     def __init__(self, value, error):
         self.value = value
         self.error = error
@@ -91,11 +205,151 @@ class data(object):
     def __ge__(self, other):
         return self.value >= other
 
+    def __getstate__(self):
+        return self.value, self.error
+
+    def __setstate__(self, state):
+        # old pickles have a dictionary of attributes
+        if isinstance(state, dict):
+            state = state["value"], state["error"]
+        self.value, self.error = state
+
+
+class MeasurementArray(object):
+    """Many data points at once. Holds the values and errors as two numpy arrays of the same length.
+
+    Works like a data object, but on whole arrays: adding or subtracting another MeasurementArray (or a data object)
+    adds the values and adds the errors in quadrature, and adding or subtracting a plain number just shifts the
+    values. Comparisons use just the values, like data, and give boolean arrays. Missing measurements are NaN, which
+    fails every comparison.
+
+    Indexing with a number gives a MeasurementView of that element, which acts like a data object but doesn't copy
+    anything. Indexing with a slice or a boolean or integer array gives a new MeasurementArray.
+    """
+
+    def __init__(self, values, errors):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.errors = np.asarray(errors, dtype=np.float64)
+        if self.values.shape != self.errors.shape:
+            EndProgramError("The values and errors of a MeasurementArray need to be the same shape.",
+                            (self.values.shape, self.errors.shape))
+
+    @classmethod
+    def from_data(cls, data_list):
+        """Make a MeasurementArray out of a list of data objects. Nones become NaN.
+
+        :param data_list: list of data objects, or None where there is no measurement.
+        :return: MeasurementArray
+        """
+        return cls([np.nan if d is None else d.value for d in data_list],
+                   [np.nan if d is None else d.error for d in data_list])
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "MeasurementArray(values=" + repr(self.values) + ", errors=" + repr(self.errors) + ")"
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, np.integer)):
+            return MeasurementView(self, index)
+        return MeasurementArray(self.values[index], self.errors[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield MeasurementView(self, i)
+
+    @property
+    def valid(self):
+        """Boolean array of which elements actually have a measurement."""
+        return ~np.isnan(self.values)
+
+    def _other_values_and_errors(self, other):
+        """Get the values and errors of the other thing in an operation. Plain numbers don't have errors."""
+        if isinstance(other, (MeasurementArray, data)):
+            return (other.values, other.errors) if isinstance(other, MeasurementArray) else (other.value, other.error)
+        return other, 0.0
+
+    def __add__(self, other):
+        """Add values, and add errors in quadrature."""
+        values, errors = self._other_values_and_errors(other)
+        return MeasurementArray(self.values + values, np.sqrt(self.errors**2 + errors**2))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        """Subtract values, and add errors in quadrature."""
+        values, errors = self._other_values_and_errors(other)
+        return MeasurementArray(self.values - values, np.sqrt(self.errors**2 + errors**2))
+
+    def __rsub__(self, other):
+        values, errors = self._other_values_and_errors(other)
+        return MeasurementArray(values - self.values, np.sqrt(self.errors**2 + errors**2))
+
+    def __neg__(self):
+        return MeasurementArray(-self.values, self.errors)
+
+    def __mul__(self, scale):
+        """Multiply by a number. The errors get scaled too."""
+        return MeasurementArray(self.values * scale, self.errors * abs(scale))
+
+    __rmul__ = __mul__
+
+    # comparison operators. Just use the values, ignore the errors. Leave NaNs out without warning about them.
+    def __lt__(self, other):
+        with np.errstate(invalid="ignore"):
+            return self.values < other
+
+    def __gt__(self, other):
+        with np.errstate(invalid="ignore"):
+            return self.values > other
+
+    def __le__(self, other):
+        with np.errstate(invalid="ignore"):
+            return self.values <= other
+
+    def __ge__(self, other):
+        with np.errstate(invalid="ignore"):
+            return self.values >= other
+
+
+class MeasurementView(data):
+    """One element of a MeasurementArray, for code that wants data objects. It reads (and writes) the arrays
+    directly, so no copies are made, and it can be used anywhere a data object can.
+    """
+
+    __slots__ = ("_measurements", "_index")
+
+    # pickled as a plain data object, rather than dragging the whole array along
+    def __reduce__(self):
+        return data, (self.value, self.error)
+
+    def __init__(self, measurements, index):
+        self._measurements = measurements
+        self._index = index
+
+    @property
+    def value(self):
+        return float(self._measurements.values[self._index])
+
+    @value.setter
+    def value(self, new_value):
+        self._measurements.values[self._index] = new_value
+
+    @property
+    def error(self):
+        return float(self._measurements.errors[self._index])
+
+    @error.setter
+    def error(self, new_error):
+        self._measurements.errors[self._index] = new_error
+
 
 class Predictions(object):
     """
     Class storing data from the EzGal models.
     """
+    __slots__ = ("redshift", "mags_dict")
 
     #get slopes for all redshifts
     slope_dict = making_slopes.make_slopes(config_data.fitted_colors)
@@ -143,6 +397,18 @@ class Predictions(object):
         return lambda mag: color_zeropoint + self.slope_dict[filter_pair][self.redshift] \
                                              * (mag - self.mags_dict[redder_band])
 
+    def get_line_parameters(self, filter_pair):
+        """Get the numbers that describe the red sequence line get_lambda makes.
+
+        The line is color = zeropoint + slope * (mag - pivot_mag)
+
+        :param filter_pair: color, like "sloan_r-sloan_z"
+        :return: color zeropoint, slope, and pivot magnitude (the predicted magnitude in the redder band)
+        """
+        bluer_band, redder_band = filter_pair.split("-")
+        return (self.mags_dict[bluer_band] - self.mags_dict[redder_band], self.slope_dict[filter_pair][self.redshift],
+                self.mags_dict[redder_band])
+
 
 
 
@@ -151,6 +417,14 @@ class Predictions(object):
     def __repr__(self):
         return str(self.mags_dict)
 
+    def __getstate__(self):
+        return self.redshift, self.mags_dict
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = state["redshift"], state["mags_dict"]
+        self.redshift, self.mags_dict = state
+
     # TODO: delete this function below?
     # def _make_line(self, slope, l_star_mag, l_star_color):
     #     """
@@ -170,6 +444,268 @@ class Predictions(object):
     #     return Line(xs, slope=slope, x_point=l_star_mag, y_point=l_star_color)
 
 
+class ContinuousPredictions(object):
+    """The EzGal model predictions at any redshift, rather than just the ones a Predictions object was made for.
+
+    The predicted magnitudes in each filter are interpolated with cubic splines through a grid of predictions, and
+    the slopes of the red sequence come straight from the fits making_slopes does, so any redshift between the ends
+    of the grid can be used without going back to EzGal. Everything takes arrays of redshifts (or single numbers),
+    and gives back arrays the same shape.
+    """
+    # the fits of the slope of the red sequence as a function of redshift, for all colors
+    slope_fits = making_slopes.fit_slopes(config_data.fitted_colors)
+
+    def __init__(self, redshifts, mags_dict):
+        """
+        :param redshifts: array of the redshifts of the grid, in increasing order.
+        :param mags_dict: dictionary of keys=filters, values=array of predicted magnitudes at those redshifts.
+        """
+        self.redshifts = np.asarray(redshifts, dtype=np.float64)
+        self.filters = sorted(mags_dict)
+        # ext=2 makes them complain about redshifts off the ends, rather than make something up.
+        self._splines = {band: interpolate.InterpolatedUnivariateSpline(self.redshifts, mags_dict[band], k=3, ext=2)
+                         for band in self.filters}
+
+    @classmethod
+    def from_predictions(cls, predictions_dict):
+        """Make the continuous version of a dictionary of Predictions objects, like make_prediction_dictionary makes.
+
+        :param predictions_dict: dictionary of keys=redshifts, values=Predictions objects
+        :return: ContinuousPredictions object
+        """
+        keys = sorted(predictions_dict, key=float)
+        filters = predictions_dict[keys[0]].mags_dict.keys()
+        return cls([float(key) for key in keys],
+                   {band: [predictions_dict[key].mags_dict[band] for key in keys] for band in filters})
+
+    @property
+    def redshift_range(self):
+        """Lowest and highest redshifts that predictions can be made for."""
+        return self.redshifts[0], self.redshifts[-1]
+
+    def get_mags(self, band, redshifts):
+        """Get the predicted magnitudes in one band.
+
+        :param band: filter, like "sloan_z"
+        :param redshifts: array of redshifts, or one redshift
+        :return: array of magnitudes at those redshifts
+        """
+        return self._splines[band](np.asarray(redshifts, dtype=np.float64))
+
+    def get_colors(self, filter_pair, redshifts):
+        """Get the predicted color of the red sequence at its characteristic magnitude.
+
+        :param filter_pair: color, like "sloan_r-sloan_z"
+        :param redshifts: array of redshifts, or one redshift
+        :return: array of colors at those redshifts
+        """
+        bluer_band, redder_band = filter_pair.split("-")
+        return self.get_mags(bluer_band, redshifts) - self.get_mags(redder_band, redshifts)
+
+    def get_slopes(self, filter_pair, redshifts):
+        """Get the slope of the red sequence.
+
+        :param filter_pair: color, like "sloan_r-sloan_z"
+        :param redshifts: array of redshifts, or one redshift
+        :return: array of slopes at those redshifts
+        """
+        return polynomial.polyval(np.asarray(redshifts, dtype=np.float64), self.slope_fits[filter_pair])
+
+    def get_line_parameters(self, filter_pair, redshifts):
+        """Get the numbers that describe the red sequence lines, like Predictions.get_line_parameters, at many
+        redshifts at once. These can be passed straight to predictions.chi_square_grid.
+
+        :param filter_pair: color, like "sloan_r-sloan_z"
+        :param redshifts: array of redshifts, or one redshift
+        :return: arrays of the color zeropoints, slopes, and pivot magnitudes (the predicted magnitudes in the
+                 redder band)
+        """
+        return (self.get_colors(filter_pair, redshifts), self.get_slopes(filter_pair, redshifts),
+                self.get_mags(filter_pair.split("-")[1], redshifts))
+
+    def get_lambda(self, filter_pair, redshift):
+        """Get a function for the red sequence line at one redshift, like Predictions.get_lambda.
+
+        :param filter_pair: color, like "sloan_r-sloan_z"
+        :param redshift: the redshift, as a number or string
+        :return: function that takes magnitudes in the redder band, and gives the color of the red sequence there.
+        """
+        zeropoint, slope, pivot_mag = [float(x) for x in self.get_line_parameters(filter_pair, float(redshift))]
+        return lambda mag: zeropoint + slope * (mag - pivot_mag)
+
+
+class PredictionCube(object):
+    """Predicted magnitudes of many models at once: an array with dimensions of [models, redshifts, filters].
+
+    Each model is a tuple of the model name (with {metallicity} where the metallicity goes), the metallicity, and
+    the formation redshift, like predictions.default_model. The slopes of the red sequence only depend on redshift,
+    so they are the same for every model. Use predictions.make_prediction_cube to make one.
+    """
+
+    def __init__(self, models, redshifts, filters, mags):
+        """
+        :param models: list of model tuples
+        :param redshifts: list of redshifts, as strings, in increasing order.
+        :param filters: list of filters
+        :param mags: array of magnitudes with dimensions of [models, redshifts, filters]
+        """
+        self.models = [tuple(model) for model in models]
+        self.redshift_axis = RedshiftAxis(redshifts)
+        self.filters = list(filters)
+        self.mags = np.asarray(mags, dtype=np.float64)
+        if self.mags.shape != (len(self.models), len(self.redshift_axis), len(self.filters)):
+            EndProgramError("The magnitudes in a PredictionCube need dimensions of [models, redshifts, filters].",
+                            self.mags.shape)
+
+    def __repr__(self):
+        return "PredictionCube(" + str(len(self.models)) + " models, " + repr(self.redshift_axis) + ")"
+
+    def get_mags(self, band):
+        """Get the predicted magnitudes in one band.
+
+        :param band: filter, like "sloan_z"
+        :return: array with dimensions of [models, redshifts]
+        """
+        return self.mags[:, :, self.filters.index(band)]
+
+    def get_line_parameters(self, filter_pair):
+        """Get the numbers that describe the red sequence lines for every model at every redshift, like
+        Predictions.get_line_parameters. These can be passed straight to predictions.chi_square_grid.
+
+        :param filter_pair: color, like "sloan_r-sloan_z"
+        :return: arrays of the color zeropoints, slopes, and pivot magnitudes, each with dimensions of
+                 [models, redshifts]
+        """
+        bluer_band, redder_band = filter_pair.split("-")
+        slopes = np.array([Predictions.slope_dict[filter_pair][key] for key in self.redshift_axis.keys])
+        return (self.get_mags(bluer_band) - self.get_mags(redder_band),
+                np.repeat(slopes[np.newaxis, :], len(self.models), axis=0), self.get_mags(redder_band))
+
+    def get_predictions_dict(self, model):
+        """Get one model as a dictionary of Predictions objects, like predictions.make_prediction_dictionary makes.
+
+        :param model: model tuple
+        :return: dictionary, where keys=redshifts and values=predictions object
+        """
+        model_mags = self.mags[self.models.index(tuple(model))]
+        return {key: Predictions(key, dict(zip(self.filters, model_mags[z_index])))
+                for z_index, key in enumerate(self.redshift_axis.keys)}
+
+    def save(self, path):
+        """Save the cube to a .npz file."""
+        np.savez(path, model_names=np.array([model[0] for model in self.models]),
+                 metallicities=np.array([model[1] for model in self.models], dtype=np.float64),
+                 formation_redshifts=np.array([model[2] for model in self.models], dtype=np.float64),
+                 redshifts=np.array(self.redshift_axis.keys), filters=np.array(self.filters), mags=self.mags)
+
+    @classmethod
+    def load(cls, path):
+        """Read a cube saved with save."""
+        npz_file = np.load(path)
+        models = zip(npz_file["model_names"].tolist(), npz_file["metallicities"].tolist(),
+                     npz_file["formation_redshifts"].tolist())
+        cube = cls(models, npz_file["redshifts"].tolist(), npz_file["filters"].tolist(), npz_file["mags"])
+        npz_file.close()
+        return cube
+
+
+class RedshiftAxis(object):
+    """The redshifts the predictions are made at, in order, so fitting can work with their positions in the list.
+
+    Outside of fitting, redshifts are strings like "1.05" (the keys of predictions_dict, and the values of
+    Cluster.rs_z), since those don't have floating point errors. Fitting instead uses the index of each redshift in
+    this axis, and the keys are only turned into indices (or back) at the edges.
+
+    Redshifts are rounded to the given number of decimals, so "1.05", 1.05, and 1.0500000001 are all the same one.
+    """
+
+    def __init__(self, redshifts, decimals=2):
+        """
+        :param redshifts: the redshifts, in any order, as strings or numbers. Things like the keys of predictions_dict.
+        :param decimals: how many decimal places the redshifts are rounded to when turning them into keys.
+        """
+        self.decimals = decimals
+        self.keys = sorted(set(self._make_key(z) for z in redshifts), key=float)
+        # floats made from the keys, so they compare exactly the same as float(key) would
+        self.redshifts = np.array([float(key) for key in self.keys], dtype=np.float64)
+        self._indices = {key: index for index, key in enumerate(self.keys)}
+
+        # if they are evenly spaced, the nearest index can be calculated directly rather than searched for
+        spacings = np.diff(self.redshifts)
+        if len(spacings) > 0 and np.allclose(spacings, spacings[0], rtol=0, atol=10**-(decimals + 2)):
+            self.spacing = spacings[0]
+        else:
+            self.spacing = None
+
+    def _make_key(self, redshift):
+        return str(round(float(redshift), self.decimals))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        return self.redshifts[index]
+
+    def __contains__(self, redshift):
+        return self._make_key(redshift) in self._indices
+
+    def __repr__(self):
+        return "RedshiftAxis(" + self.keys[0] + " to " + self.keys[-1] + ", " + str(len(self)) + " redshifts)"
+
+    def index(self, redshift):
+        """Get the index of a redshift that is on the axis.
+
+        :param redshift: the redshift, as a string or a number
+        :return: index of that redshift
+        """
+        try:
+            return self._indices[self._make_key(redshift)]
+        except KeyError:
+            raise KeyError("Redshift " + str(redshift) + " is not on the axis.")
+
+    def key(self, index):
+        """Turn an index back into the string version of its redshift."""
+        return self.keys[index]
+
+    def nearest(self, redshift):
+        """Get the index of the redshift on the axis closest to the given one. Things off either end give that end.
+
+        :param redshift: any number
+        :return: index
+        """
+        redshift = float(redshift)
+        if self.spacing is not None:
+            index = int(round((redshift - self.redshifts[0]) / self.spacing))
+        else:
+            index = int(np.searchsorted(self.redshifts, redshift))
+            # the one found is the first one bigger, so the one before it could be closer
+            if index > 0 and (index == len(self) or
+                              redshift - self.redshifts[index - 1] <= self.redshifts[index] - redshift):
+                index -= 1
+        return min(max(index, 0), len(self) - 1)
+
+    def bracket(self, redshift):
+        """Get the indices of the two redshifts on the axis on either side of the given one.
+
+        :param redshift: number between the first and last redshifts on the axis.
+        :return: indices i and i + 1, where axis[i] <= redshift <= axis[i + 1]
+        """
+        redshift = float(redshift)
+        if not self.redshifts[0] <= redshift <= self.redshifts[-1] or len(self) < 2:
+            raise ValueError("Redshift " + str(redshift) + " is not inside the axis, which is " + repr(self))
+        if self.spacing is not None:
+            lower = int((redshift - self.redshifts[0]) // self.spacing)
+            # rounding can put it one off
+            if lower > 0 and self.redshifts[lower] > redshift:
+                lower -= 1
+            elif lower < len(self) - 1 and self.redshifts[lower + 1] <= redshift:
+                lower += 1
+        else:
+            lower = int(np.searchsorted(self.redshifts, redshift, side="right")) - 1
+        lower = min(lower, len(self) - 2)
+        return lower, lower + 1
+
+
 class Line(object):
     """
     Class that holds data for lines. This makes handling the line data easier, especially for predictions
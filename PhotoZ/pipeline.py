@@ -0,0 +1,294 @@
+"""Runs the whole process, from images to results, only redoing the parts whose inputs have changed.
+
+The stages, and what each one makes:
+    images      -> catalogs     Source detection and SDSS calibration of one cluster's r and z images.
+    catalogs    -> cluster      Reading one cluster's catalogs and calculating colors. Saved in the checkpoint in
+                                global_paths.checkpoint_directory.
+    cluster     -> fit          One fit_z for one color of one cluster. Saved as a shard (see checkpoints.py).
+    fits        -> finished     The cluster with all its fits. Saved in global_paths.finished_checkpoint_directory.
+    finished    -> results      Corrections and the results file. This uses all the clusters at once, and only
+                                needs the index of the finished checkpoint, so it is always redone.
+
+Every stage except the last is done per cluster, and each thing it makes is recorded with a key: a hash of
+everything that went into making it (the keys of the things it was made from, the parameters, and the version of
+the stage in stage_versions). If the key hasn't changed and the output is still there, the stage is skipped. So
+adding a new cluster's catalogs only reads and fits that cluster, and changing one catalog only redoes that cluster.
+
+The catalogs are hashed by their contents. The images can be several GB, so they are identified by their size and
+modification time from the FITS index instead.
+
+The clusters don't depend on each other until the last stage, so the rest of each cluster's stages can be run in
+separate processes. Everything each process saves is written to a temporary file and renamed into place, so they
+can't interfere with each other, and a crash never leaves a half written file that looks finished. The processes all
+fit with one copy of the prediction grid, in shared memory (see shared_predictions.py).
+"""
+import os
+import json
+import hashlib
+import multiprocessing
+from PhotoZ import global_paths
+from PhotoZ import functions
+from PhotoZ import fits_index
+from PhotoZ import SExtractor
+from PhotoZ import read_in_catalogs
+from PhotoZ import checkpoints
+from PhotoZ import config_data
+from PhotoZ import fit_cache
+from PhotoZ import shared_predictions
+from PhotoZ import Cluster
+
+# Bump one of these when the code for that stage changes in a way that changes its results, so everything that stage
+# made gets redone.
+stage_versions = {"images": 1, "cluster": 1, "fit": 3, "finished": 1}
+
+
+class PipelineState(object):
+    """Keeps track of what the pipeline has made, and the key of the inputs it was made from.
+
+    Each record is its own small file in the state directory, rather than one big file, so that separate processes
+    can record things at the same time without a lock.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: directory the records are kept in. Defaults to the one in global_paths.
+        """
+        if directory is None:
+            directory = global_paths.pipeline_state_directory
+        self.directory = directory
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # another process made it in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def lookup(self, artifact):
+        """Get the record for something the pipeline made.
+
+        :param artifact: name of the thing, like "cluster:MOO1014+0038"
+        :return: dictionary with "key" and "info", or None if it hasn't been made.
+        """
+        path = self._record_path(artifact)
+        if not os.path.isfile(path):
+            return None
+        record_file = open(path, "r")
+        try:
+            return json.load(record_file)
+        except ValueError:
+            # a broken record just means it gets made again
+            return None
+        finally:
+            record_file.close()
+
+    def is_current(self, artifact, key, outputs=()):
+        """Whether the thing was made from the same inputs, and all its output files are still there.
+
+        :param artifact: name of the thing
+        :param key: key of the inputs it would be made from now
+        :param outputs: paths of the files it makes
+        :return: bool
+        """
+        record = self.lookup(artifact)
+        return record is not None and record["key"] == key and all(os.path.isfile(path) for path in outputs)
+
+    def record(self, artifact, key, info=None):
+        """Record that something was made from the inputs with the given key.
+
+        :param artifact: name of the thing
+        :param key: key of the inputs it was made from
+        :param info: anything that can be saved as JSON that later stages want to know about it without loading it.
+        :return: None
+        """
+        path = self._record_path(artifact)
+        temp_path = path + ".tmp." + str(os.getpid())
+        record_file = open(temp_path, "w")
+        json.dump({"key": key, "info": info}, record_file, sort_keys=True)
+        record_file.close()
+        os.rename(temp_path, path)
+
+    def _record_path(self, artifact):
+        # cluster names have + and -, which are fine in filenames, but the colons aren't on every system.
+        return os.path.join(self.directory, artifact.replace(":", "__") + ".json")
+
+
+def run_pipeline(detection_backend="sextractor", image_processes=1, processes=1):
+    """Run everything that is out of date, then do the corrections and write the results.
+
+    :param detection_backend: what does the source detection. See SExtractor.sextractor_main.
+    :param image_processes: how many processes the tiles of each image are spread over.
+    :param processes: how many clusters are read and fit at the same time.
+    :return: list of finished Cluster objects. They only have their results, not their sources.
+    """
+    state = PipelineState()
+
+    print "Checking images\n"
+    run_image_stage(state, detection_backend, image_processes)
+
+    print "\nChecking catalogs and fits\n"
+    catalog_path_list = functions.find_all_objects(global_paths.catalogs_look_directory, [".cat", ".dat"], [])
+    cluster_names, catalogs_dict = read_in_catalogs.group_catalogs(catalog_path_list)
+    jobs = [(name, catalogs_dict[name]) for name in cluster_names]
+
+    if processes > 1:
+        shared = shared_predictions.publish("pipeline_" + str(os.getpid()), Cluster.Cluster.predictions_dict,
+                                            config_data.fitted_colors)
+        try:
+            pool = multiprocessing.Pool(processes, initializer=_attach_predictions, initargs=(shared.name,))
+            try:
+                results = pool.map(run_cluster_stages, jobs, chunksize=1)
+                pool.close()
+            except:
+                # stop the workers before the predictions they are using are deleted
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        finally:
+            shared.release()
+    else:
+        results = [run_cluster_stages(job) for job in jobs]
+
+    # The indexes are rewritten from scratch, so clusters that don't have catalogs anymore drop out.
+    checkpoints.write_index(global_paths.checkpoint_directory, [result[0] for result in results])
+    checkpoints.write_index(global_paths.finished_checkpoint_directory, [result[1] for result in results])
+
+    print "\nDoing corrections and writing results\n"
+    cluster_list = checkpoints.load_results(global_paths.finished_checkpoint_directory)
+    functions.fit_corrections(cluster_list, read_in=True, plot=True)
+    functions.write_results(cluster_list)
+
+    # keep the fit cache from growing forever
+    fit_cache.evict()
+    return cluster_list
+
+
+def _attach_predictions(name):
+    """Runs when each worker process starts, so it fits with the shared prediction grid."""
+    Cluster.Cluster.use_shared_predictions(shared_predictions.attach(name))
+
+
+def run_image_stage(state, detection_backend="sextractor", image_processes=1):
+    """Make calibrated catalogs for the clusters whose images (or SExtractor settings) changed since last time.
+
+    :param state: PipelineState
+    :param detection_backend: see SExtractor.sextractor_main
+    :param image_processes: see SExtractor.sextractor_main
+    :return: None
+    """
+    directories = [directory for directory in global_paths.images_directory if os.path.isdir(directory)]
+    if len(directories) == 0:
+        return
+    index = fits_index.get_index()
+    image_list = index.scan(directories)
+    config_hash = file_hash(global_paths.gemini_config_file)
+
+    out_of_date_images = []
+    made = []
+    for group in SExtractor._group_images(image_list):
+        r_image, z_image = SExtractor._find_r_and_z_images(group)
+        if not (r_image and z_image):
+            continue  # sextractor_main can't do anything with these either
+
+        artifact = "images:" + functions.make_cluster_name(z_image.split("/")[-1])
+        images = [(path.split("/")[-1], index.lookup(path)["mtime"], index.lookup(path)["size"])
+                  for path in [r_image, z_image]]
+        key = make_key("images", images, config_hash, detection_backend)
+        outputs = [SExtractor.get_catalog_path(r_image), SExtractor.get_catalog_path(z_image)]
+        if not state.is_current(artifact, key, outputs):
+            out_of_date_images += [r_image, z_image]
+            made.append((artifact, key, outputs))
+
+    if len(out_of_date_images) == 0:
+        return
+    # Note that the calibration plots only have the clusters that were redone.
+    SExtractor.sextractor_main(out_of_date_images, detection_backend, image_processes)
+
+    # If calibration didn't work, there won't be catalogs, so those clusters get tried again next time.
+    for artifact, key, outputs in made:
+        if all(os.path.isfile(path) for path in outputs):
+            state.record(artifact, key)
+
+
+def run_cluster_stages(job):
+    """Bring one cluster's checkpoint, fits, and finished checkpoint up to date.
+
+    Takes one tuple so it works with Pool.map. It makes its own PipelineState, so it works in other processes.
+
+    :param job: tuple of the name of the cluster and the list of its catalogs
+    :return: the cluster's entries for the index of the checkpoint and of the finished checkpoint.
+    """
+    name, catalog_paths = job
+    state = PipelineState()
+    cluster = None  # only loaded if something needs it
+
+    # reading the catalogs and calculating colors
+    cluster_key = make_key("cluster", sorted((path.split("/")[-1], file_hash(path)) for path in catalog_paths))
+    cluster_artifact = "cluster:" + name
+    cluster_file = os.path.join(global_paths.checkpoint_directory, checkpoints.cluster_filename(name))
+    if state.is_current(cluster_artifact, cluster_key, [cluster_file]):
+        cluster_entry = state.lookup(cluster_artifact)["info"]
+    else:
+        print "Reading catalogs for " + name
+        cluster = read_in_catalogs.read_cluster_catalogs(name, catalog_paths)
+        cluster.calculate_color()
+        cluster_entry = checkpoints.save_cluster(cluster, global_paths.checkpoint_directory)
+        state.record(cluster_artifact, cluster_key, cluster_entry)
+
+    # fitting each color. The colors are done in order, on the same cluster, like they always have been.
+    colors = [color for color in config_data.fitted_colors
+              if color.split("-")[0] in cluster_entry["bands"] and color.split("-")[1] in cluster_entry["bands"]]
+    fit_keys = []
+    for color in colors:
+        # the cuts and predictions fit_z uses are part of the key, so changing them redoes the fits
+        fit_key = make_key("fit", cluster_key, color, fit_cache.make_settings_key(Cluster.Cluster, color))
+        fit_artifact = "fit:" + name + ":" + color
+        fit_keys.append(fit_key)
+        if state.is_current(fit_artifact, fit_key) and checkpoints.shard_exists(
+                global_paths.finished_checkpoint_directory, name, color):
+            continue
+        if cluster is None:
+            cluster = checkpoints.load_cluster_from_entry(global_paths.checkpoint_directory, cluster_entry)
+        cluster.fit_z(color, plot_figures=True)
+        checkpoints.save_fit_shard(cluster, color, global_paths.finished_checkpoint_directory)
+        state.record(fit_artifact, fit_key)
+
+    # putting the fits together
+    finished_key = make_key("finished", cluster_key, fit_keys)
+    finished_artifact = "finished:" + name
+    finished_file = os.path.join(global_paths.finished_checkpoint_directory, checkpoints.cluster_filename(name))
+    if state.is_current(finished_artifact, finished_key, [finished_file]):
+        finished_entry = state.lookup(finished_artifact)["info"]
+    else:
+        if cluster is None:
+            cluster = checkpoints.load_cluster_from_entry(global_paths.checkpoint_directory, cluster_entry)
+        checkpoints.apply_fit_shards(cluster, global_paths.finished_checkpoint_directory, colors)
+        finished_entry = checkpoints.save_cluster(cluster, global_paths.finished_checkpoint_directory)
+        state.record(finished_artifact, finished_key, finished_entry)
+
+    return cluster_entry, finished_entry
+
+
+def make_key(stage, *inputs):
+    """Make the key for something made by a stage from the given inputs.
+
+    :param stage: name of the stage. Its version is included, so changing the version changes all its keys.
+    :param inputs: anything that can be turned into JSON
+    :return: hex string of the hash
+    """
+    return hashlib.sha1(json.dumps([stage, stage_versions[stage], inputs], sort_keys=True)).hexdigest()
+
+
+def file_hash(path):
+    """Hash the contents of a file, reading it in pieces so big files don't have to fit in memory.
+
+    :param path: path of the file
+    :return: hex string of the hash
+    """
+    sha = hashlib.sha1()
+    hashed_file = open(path, "rb")
+    for chunk in iter(lambda: hashed_file.read(1 << 20), b""):
+        sha.update(chunk)
+    hashed_file.close()
+    return sha.hexdigest()
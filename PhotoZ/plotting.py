@@ -26,24 +26,21 @@ def plot_color_mag(cluster, color, band, predictions=True, distinguish_red_seque
              second: axes object for the CMD itself. This is needed because I need to over plot things later, and
              returning the object is easier than making this function way more complicated than it already is.
     """
-    # Need to make lists that can be plotted on the CMD
-    valid_sources = [source for source in cluster.sources_list if (color in source.colors and band in source.mags and
-                                                                   source.colors[color].error < 5.0 and
-                                                                   source.in_location)]
-    # start by initializing empty lists to append to
-    non_rs_mags, rs_mags, non_rs_colors, rs_colors, rs_color_errs, non_rs_color_errs = [], [], [], [], [], []
+    # Need to make lists that can be plotted on the CMD. Only use sources with the right data.
+    mags = cluster.get_mags(band).values
+    colors = cluster.get_colors(color)
+    color_errors = colors.errors
+    with np.errstate(invalid="ignore"):
+        valid = (~np.isnan(mags) & colors.valid & (color_errors < 5.0) &
+                 np.array([source.in_location for source in cluster.sources_list], dtype=bool))
+    colors = colors.values
     if distinguish_red_sequence:
-        # The many if statements are to make sure only objects with the right data are included
-        rs_mags = [source.mags[band].value for source in valid_sources if source.RS_member]
-        non_rs_mags = [source.mags[band].value for source in valid_sources if not source.RS_member]
-        rs_colors = [source.colors[color].value for source in valid_sources if source.RS_member]
-        non_rs_colors = [source.colors[color].value for source in valid_sources if not source.RS_member]
-        rs_color_errs = [source.colors[color].error for source in valid_sources if source.RS_member]
-        non_rs_color_errs = [source.colors[color].error for source in valid_sources if not source.RS_member]
+        rs = np.array([source.RS_member for source in cluster.sources_list], dtype=bool)
+        rs_mags, rs_colors, rs_color_errs = mags[valid & rs], colors[valid & rs], color_errors[valid & rs]
+        non_rs_mags, non_rs_colors, non_rs_color_errs = mags[valid & ~rs], colors[valid & ~rs], \
+            color_errors[valid & ~rs]
     else:  # use non_rs lists
-        non_rs_mags = [source.mags[band].value for source in valid_sources]
-        non_rs_colors = [source.colors[color].value for source in valid_sources]
-        non_rs_color_errs = [source.colors[color].error for source in valid_sources]
+        non_rs_mags, non_rs_colors, non_rs_color_errs = mags[valid], colors[valid], color_errors[valid]
 
 
 
@@ -298,12 +295,13 @@ def plot_fitting_procedure(cluster, color, band, redshift, other_info=None, colo
     fig, ax = plot_color_mag(cluster, color=color, band=redder_band, predictions=False,
                                                                       distinguish_red_sequence=color_red_sequence,
                              return_axis=True)
-    line = cluster.predictions_dict[redshift].get_lambda(color)
+    # the redshift can be between the ones there are predictions for, so use the continuous model
+    line = cluster.prediction_model.get_lambda(color, redshift)
     mags = np.arange(10, 30, 0.01)
-    colors = [line(mag) for mag in mags]
+    colors = line(mags)
     ax.plot(mags, colors, "k-", linewidth=0.5, label="Initial z")
-    ax.scatter(cluster.predictions_dict[redshift].mags_dict[redder_band], cluster.predictions_dict[redshift].mags_dict[
-               bluer_band] - cluster.predictions_dict[redshift].mags_dict[redder_band], c="r", s=10)
+    ax.scatter(cluster.prediction_model.get_mags(redder_band, float(redshift)),
+               cluster.prediction_model.get_colors(color, float(redshift)), c="r", s=10)
                 # Plot characteristic magnitude point
     fig.text(0.1, 0.90, "z = " + str(round(apply_correction(float(redshift), color), 2)), transform = ax.transAxes,
              horizontalalignment="left", verticalalignment="top", bbox=dict(ec="k", fc="none"))  # plot current redshift in the top left
@@ -1,8 +1,17 @@
 import ezgal
 import numpy as np
 import os
+import hashlib
 from PhotoZ import other_classes
 from PhotoZ import config_data
+from PhotoZ import global_paths
+
+# The model make_prediction_dictionary uses. For simplicity right now, just use the 0.1 gyr exponential model
+default_model = ("bc03_exp_0.1_z_{metallicity}_chab", 0.02, 3.0)
+
+# Prediction cubes already made in this process, so they are only read from disk once.
+_cubes = dict()
+
 
 def make_prediction_dictionary(spacing):
     """
@@ -13,11 +22,45 @@ def make_prediction_dictionary(spacing):
     :param spacing: float of how far apart the redshift predictions will be.
     :return: dictionary, where keys=redshifts and values=predictions object
     """
+    zs = np.arange(0.5, 1.5000001, spacing)
+
+    print config_data.filters_list
+    # Calculate observables in AB mags
+    mags = get_model_mags(default_model, zs, config_data.filters_list)
+    # mags has dimensions of: [redshifts, filters]
+
+    print mags
+
+    # change redshifts to string format, so they don't get floating point errors
+    zs = [str(round(z, 2)) for z in zs]
+
+    # Initialize an empty dictionary
+    predictions_dict = dict()
+    # fill the dictionary with values generated by the models.
+    for z_index, z in enumerate(zs):
+        mag_dict = dict()
+        for filter_index, filter in enumerate(config_data.filters_list):
+            mag_dict[filter] = mags[z_index][filter_index]
+        predictions_dict[z] = other_classes.Predictions(redshift=z, mags=mag_dict)
+    return predictions_dict
+
+
+def get_model_mags(model, zs, filters):
+    """
+    Use the EzGal module to get the predicted magnitudes of one model.
+
+    :param model: tuple of the model name (with {metallicity} where the metallicity goes), the metallicity, and the
+                  formation redshift. Like default_model.
+    :param zs: array of the observed redshifts
+    :param filters: list of filters
+    :return: array of AB magnitudes, with dimensions of [redshifts, filters]
+    """
+    model_name, metallicity, zf = model
+    model_name = model_name.format(metallicity=metallicity)
 
     # Make the models
-    # For simplicity right now, just use the 0.1 gyr exponential model
-    evolved_model = "bc03_exp_0.1_z_0.02_chab_evolved_zf_3.0.model"
-    default_model = "bc03_exp_0.1_z_0.02_chab.model"
+    evolved_model = model_name + "_evolved_zf_" + str(zf) + ".model"
+    default_model = model_name + ".model"
     try:  # to open the evolved model
         model = ezgal.ezgal(evolved_model)
         build = False
@@ -31,20 +74,11 @@ def make_prediction_dictionary(spacing):
                              "(ezgal/data/models/)\nbc03 is recommended, but you can choose another if you wish.")
         build = True
 
-
-    # Set formation redshift and observed redshifts
-    zf = 3.0
-    zs = np.arange(0.5, 1.5000001, spacing)
-
     # Normalize to Coma
     model.set_normalization(filter='ks', mag=10.9, apparent=True, vega=True, z=0.023)
 
-    print config_data.filters_list
     # Calculate observables in AB mags
-    mags = model.get_apparent_mags(zf, filters=config_data.filters_list, zs=zs, vega=False)
-    # mags has dimensions of: [redshifts, filters]
-
-    print mags
+    mags = model.get_apparent_mags(zf, filters=filters, zs=zs, vega=False)
 
     # If we recently build and evolved the model, save it so we don't have to do that again.
     if build:
@@ -64,44 +98,91 @@ def make_prediction_dictionary(spacing):
         location = model.data_dir + "models/" + evolved_model
         model.save_model(location)
 
-    # change redshifts to string format, so they don't get floating point errors
-    zs = [str(round(z, 2)) for z in zs]
+    return mags
 
-    # Initialize an empty dictionary
-    predictions_dict = dict()
-    # fill the dictionary with values generated by the models.
-    for z_index, z in enumerate(zs):
-        mag_dict = dict()
-        for filter_index, filter in enumerate(config_data.filters_list):
-            mag_dict[filter] = mags[z_index][filter_index]
-        predictions_dict[z] = other_classes.Predictions(redshift=z, mags=mag_dict)
-    return predictions_dict
+
+def get_model_list():
+    """Get all the models in config_data, as tuples like default_model."""
+    return [(name, metallicity, zf) for name in config_data.sps_models for metallicity in config_data.metallicities
+            for zf in config_data.formation_redshifts]
+
+
+def make_prediction_cube(spacing, models=None):
+    """
+    Get the predicted magnitudes of many models, at many redshifts, in all the filters, in one PredictionCube.
+
+    EzGal is slow, so each cube is saved in global_paths.prediction_cube_directory, named by a hash of what's in
+    it, and only made if it isn't there. It is also kept in memory, so the same cube is only read once.
+
+    :param spacing: float of how far apart the redshift predictions will be.
+    :param models: list of models, as tuples like default_model. Defaults to all the ones in config_data.
+    :return: PredictionCube
+    """
+    if models is None:
+        models = get_model_list()
+    models = [(str(name), float(metallicity), float(zf)) for name, metallicity, zf in models]
+    zs = np.arange(0.5, 1.5000001, spacing)
+    redshifts = [str(round(z, 2)) for z in zs]
+
+    key = hashlib.sha1(repr((models, redshifts, config_data.filters_list))).hexdigest()
+    if key in _cubes:
+        return _cubes[key]
+
+    path = os.path.join(global_paths.prediction_cube_directory, key + ".npz")
+    if os.path.isfile(path):
+        cube = other_classes.PredictionCube.load(path)
+    else:
+        mags = np.array([get_model_mags(model, zs, config_data.filters_list) for model in models])
+        cube = other_classes.PredictionCube(models, redshifts, config_data.filters_list, mags)
+
+        if not os.path.isdir(global_paths.prediction_cube_directory):
+            os.makedirs(global_paths.prediction_cube_directory)
+        # write it somewhere else, then move it into place, so no one can read half a file
+        temp_path = path[:-4] + ".tmp." + str(os.getpid()) + ".npz"
+        cube.save(temp_path)
+        os.rename(temp_path, path)
+
+    _cubes[key] = cube
+    return cube
 
 make_prediction_dictionary(0.05)
 
-def simple_chi_square(sources, color, band, model_line):
+def simple_chi_square(mags, colors, color_errors, model_line):
     # TODO: why is this function here?
     """Does a simple reduced chi-square fit for a list of sources to a model line.
 
     Doesn't do any filtering. All sources passed in will be used. If any filtering of the sources is needed, do that
     outside this function.
 
-    :param sources: List of sources to be included in the fit
-    :param model_line: Line object holding data that represents the model's predictions we are fitting to
+    :param mags: array of the magnitudes of the sources, in the redder band of the color
+    :param colors: array of the colors of the sources
+    :param color_errors: array of the errors on those colors
+    :param model_line: function that gives the model's predicted color at a given magnitude. Has to work on arrays.
     :return: reduced chi-squared value
     """
-    # Initialize some placeholders
-    chi_sq = 0
-    for source in sources:
-        chi_sq += ((model_line(source.mags[band].value) - source.colors[color].value) / source.colors[color].error)**2
-
+    chi_sq = np.sum(((model_line(mags) - colors) / color_errors)**2)
+    # Reduced chi squared takes the total chi squared value and divides by degrees of freedom.
+    # Degrees of freedom = number of data points - number of parameters (redshift, in this case) - 1
+    return chi_sq / (len(mags) - 1 - 1)
 
 
+def chi_square_grid(mags, colors, color_errors, zeropoints, slopes, pivot_mags):
+    """Does simple_chi_square against the model lines at many redshifts at once.
 
+    The model line at each redshift is color = zeropoint + slope * (mag - pivot_mag), like Predictions.get_lambda
+    makes. See Predictions.get_line_parameters.
 
-        # # find color model predictions for the galaxy at the given magnitude
-        # idx = model_line.xs.index(round(source.mags[band].value, 2))
-        # chi_sq += ((model_line.ys[idx] - source.colors[color].value) / source.colors[color].error)**2
-    # Reduced chi squared takes the total chi squared value and divides by degrees of freedom.
-    # Degrees of freedom = number of data points - number of parameters (redshift, in this case) - 1
-    return chi_sq / (len(sources) - 1 - 1)
+    :param mags: array of the magnitudes of the sources, in the redder band of the color
+    :param colors: array of the colors of the sources
+    :param color_errors: array of the errors on those colors
+    :param zeropoints: array of the color zeropoints of the model lines, one for each redshift. Can have more than
+                       one dimension, like the ones from PredictionCube.get_line_parameters.
+    :param slopes: array of the slopes of the model lines, the same shape
+    :param pivot_mags: array of the magnitudes the model lines pivot around, the same shape
+    :return: array of reduced chi-squared values, the same shape as the lines
+    """
+    # the sources go along a new last axis, so the lines can have any shape (like models by redshifts)
+    zeropoints, slopes, pivot_mags = [np.asarray(x)[..., np.newaxis] for x in [zeropoints, slopes, pivot_mags]]
+    model_colors = zeropoints + slopes * (mags - pivot_mags)
+    chi_sq = np.sum(((model_colors - colors) / color_errors)**2, axis=-1)
+    return chi_sq / (len(mags) - 1 - 1)
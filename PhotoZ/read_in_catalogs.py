@@ -12,23 +12,42 @@ def read_sex_catalogs():
     # First find all catalogs
     catalog_path_list = functions.find_all_objects(global_paths.catalogs_look_directory, [".cat", ".dat"], [])
 
-    # Initialize an empty list of clusters
-    cluster_list = []
+    # Then make one cluster out of all the catalogs with the same cluster name
+    cluster_names, catalogs_dict = group_catalogs(catalog_path_list)
+    return [read_cluster_catalogs(name, catalogs_dict[name]) for name in cluster_names]
 
+
+def group_catalogs(catalog_path_list):
+    """Sort catalogs by which cluster they belong to, based on their filenames.
+
+    :param catalog_path_list: list of paths to catalogs
+    :return: list of cluster names, in the order they first show up in the list of catalogs, and a dictionary with
+             cluster names as keys and lists of the paths of that cluster's catalogs as values.
+    """
+    cluster_names = []
+    catalogs_dict = dict()
     for cat in catalog_path_list:
-        # Match the catalog to a cluster if there is one already in the list with the same name. If not,
-        # make a new cluster with that name.
-        cat_filename = cat.split("/")[-1]
-        cluster_name = functions.make_cluster_name(cat_filename)
+        cluster_name = functions.make_cluster_name(cat.split("/")[-1])
+        if cluster_name not in catalogs_dict:
+            cluster_names.append(cluster_name)
+            catalogs_dict[cluster_name] = []
+        catalogs_dict[cluster_name].append(cat)
+    return cluster_names, catalogs_dict
+
+
+def read_cluster_catalogs(cluster_name, catalog_paths):
+    """Make one cluster out of all of its catalogs.
 
-        for c in cluster_list:
-            if c.name == cluster_name:
-                this_cluster = c
-                break
-        else: # no break, which means a matching cluster wasn't found
-            # make one
-            this_cluster = Cluster.Cluster(cluster_name, [])
-            cluster_list.append(this_cluster)
+    This only reads that cluster's catalogs, so one cluster can be (re)read without touching the rest.
+
+    :param cluster_name: name of the cluster
+    :param catalog_paths: list of paths to the catalogs that have this cluster's data
+    :return: Cluster object
+    """
+    this_cluster = Cluster.Cluster(cluster_name, [])
+
+    for cat in catalog_paths:
+        cat_filename = cat.split("/")[-1]
 
         # Use regular expressions to determine what type a catalog is.
         sextractor_catalog = re.compile(r"MOO[0-9]{4}([+]|[-])[0-9]{4}_sloan_(r|z)[.]cat")
@@ -148,5 +167,4 @@ def read_sex_catalogs():
         else:
             print cat_filename, "no match"
 
-    return cluster_list
-
+    return this_cluster
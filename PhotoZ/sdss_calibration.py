@@ -94,6 +94,11 @@ def _call_sdss_sql(command, data_format="csv"):
     # my_file = urllib.urlopen(url + params)
     # return my_file.readlines()
 
+# Where the reference stars come from. This gets called with the SQL command, and needs to return the text SDSS
+# would send back. It can be swapped out for something that reads a local catalog instead, like the benchmark does.
+reference_source = _call_sdss_sql
+
+
 def make_sdss_catalog(stars_catalog, path):
 
     # TODO: document
@@ -115,7 +120,7 @@ def make_sdss_catalog(stars_catalog, path):
               "and (u between 17.0 and 20.5 or g between 17.0 and 20.5 or r between 17.0 and 20.5 or i between 17.0 " \
               "and 20.5 or z between 17.0 and 20.5) and type=6" %(min_ra, max_ra, min_dec, max_dec)
 
-    data = _call_sdss_sql(command)
+    data = reference_source(command)
 
     lines = [line.strip().split(",") for line in data.split()]
 
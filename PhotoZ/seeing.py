@@ -0,0 +1,231 @@
+import numpy as np
+from scipy import ndimage
+from scipy import spatial
+from astropy.io import fits
+from PhotoZ import tiling
+
+# Conversion from the sigma of a Gaussian to its full width at half max. 2 * sqrt(2 * ln(2))
+sigma_to_fwhm = 2.0 * np.sqrt(2.0 * np.log(2.0))
+# Width of the cutouts around each star, in arcseconds, when it isn't given. It's several times a 1" FWHM, since the
+# fits only keep stars with an FWHM less than half the cutout.
+cutout_width = 4.0
+# If the seeing comes out bigger than this fraction of the cutout, or none of the stars fit in it, the cutouts are
+# made twice as big and the stars are fit again, up to this many times, since the wings of the stars were cut off.
+largest_fwhm_fraction = 0.25
+max_regrows = 2
+
+
+def estimate_fwhm(image_path, cutout_size=None, max_stars=300, detection_sigma=50.0, tile_size=1024, processes=1):
+    """Measure the seeing of an image directly from the stars in it.
+
+    Used when the header doesn't have an FWHMPSF keyword. The image is memory mapped, so only the pieces we
+    actually look at get read. The process is:
+        1. Estimate the background and noise from a random sample of pixels.
+        2. Go through the image tile by tile to find local maxima that are bright, but not saturated.
+        3. Pull out a small cutout around each of these peaks, all at once, into one (N, size, size) array.
+        4. Fit a circular Gaussian to every cutout at the same time, using weighted least squares on the log of
+           the profile.
+        5. Throw out things that are elongated or too big (galaxies), and take the median of what's left.
+
+    :param image_path: path to the .fits image.
+    :param cutout_size: width in pixels of the cutouts around each star. Should be a few times the FWHM. Defaults to
+                        cutout_width arcseconds. Either way, it's made bigger if the stars turn out to be too big for
+                        it.
+    :param max_stars: the most stars that will be fit. The brightest unsaturated ones are used.
+    :param detection_sigma: how many sigma above the background a peak has to be to count as bright.
+    :param tile_size: width of the tiles the image is split into when finding peaks.
+    :param processes: how many processes the tiles are spread over.
+    :return: FWHM in arcseconds, or None if there weren't enough good stars to measure it.
+    """
+    header = fits.getheader(image_path, 0)
+    if header.get("NAXIS") != 2:
+        return None
+    image = tiling.open_image(image_path)
+
+    pixel_scale = get_pixel_scale(header)
+    if pixel_scale is None:
+        return None
+    if cutout_size is None:
+        cutout_size = max(int(np.ceil(cutout_width / pixel_scale)), 15)
+    # odd, so the cutouts are centered on the peaks
+    cutout_size += 1 - cutout_size % 2
+    background, noise = background_stats(image)
+    saturation = header.get("SATURATE")
+
+    peaks = tiling.map_tiles(image_path, _peaks_in_tile, tile_size, cutout_size,
+                             args=(background + detection_sigma * noise, cutout_size), processes=processes)
+    if len(peaks) == 0:
+        return None
+    fwhm_pixels = _fwhm_from_peaks(image, peaks["y"], peaks["x"], peaks["peak"], background, saturation, cutout_size,
+                                   max_stars)
+    for _ in range(max_regrows):
+        if fwhm_pixels is not None and fwhm_pixels < largest_fwhm_fraction * cutout_size:
+            break
+        cutout_size = 2 * cutout_size + 1
+        fwhm_pixels = _fwhm_from_peaks(image, peaks["y"], peaks["x"], peaks["peak"], background, saturation,
+                                       cutout_size, max_stars)
+
+    if fwhm_pixels is None:
+        return None
+    return fwhm_pixels * pixel_scale
+
+
+def get_pixel_scale(header):
+    """Find the pixel scale of an image, in arcseconds per pixel, from its WCS keywords.
+
+    :param header: header of the image
+    :return: pixel scale, or None if it couldn't be found.
+    """
+    if "CD1_1" in header:
+        # the determinant of the CD matrix is the area of a pixel, in square degrees.
+        determinant = (header["CD1_1"] * header.get("CD2_2", 0.0) - header.get("CD1_2", 0.0) * header.get("CD2_1",
+                                                                                                           0.0))
+        return np.sqrt(abs(determinant)) * 3600.0
+    elif "CDELT1" in header:
+        return abs(header["CDELT1"]) * 3600.0
+    elif "PIXSCALE" in header:
+        return float(header["PIXSCALE"])
+    return None
+
+
+def background_stats(image, n_samples=100000, seed=0):
+    """Estimate the background level and noise of an image from a random sample of its pixels.
+
+    Sampling (rather than looking at every pixel) is what keeps this cheap for memory mapped images. The pixels are
+    read in sorted order so the reads go through the file front to back.
+
+    :param image: 2D array (can be memory mapped)
+    :param n_samples: number of pixels to sample
+    :param seed: seed for the random number generator, so the results are reproducible
+    :return: background level, noise (both in counts)
+    """
+    random_state = np.random.RandomState(seed)
+    n_pixels = image.shape[0] * image.shape[1]
+    flat_idx = np.sort(random_state.randint(0, n_pixels, size=min(n_samples, n_pixels)))
+    sample = np.asarray(image[flat_idx // image.shape[1], flat_idx % image.shape[1]], dtype=np.float64)
+    sample = sample[np.isfinite(sample)]
+
+    # Sigma clip a few times to get rid of the sources. Use the median absolute deviation, since it is robust.
+    median, sigma = 0.0, 0.0
+    for _ in range(5):
+        median = np.median(sample)
+        sigma = 1.4826 * np.median(np.abs(sample - median))
+        sample = sample[np.abs(sample - median) < 3.0 * sigma]
+    return median, sigma
+
+
+def _peaks_in_tile(tile_data, tile, image_shape, threshold, box_size):
+    """Find local maxima above the threshold in one tile. Called by tiling.map_tiles.
+
+    :return: dictionary with the y and x positions (in the whole image) and values of the peaks.
+    """
+    is_peak = (tile_data == ndimage.maximum_filter(tile_data, size=box_size)) & (tile_data > threshold)
+    peak_ys, peak_xs = np.nonzero(is_peak)
+    peaks = tile_data[peak_ys, peak_xs]
+    peak_ys, peak_xs = tile.to_image_coordinates(peak_ys, peak_xs)
+    return {"y": peak_ys, "x": peak_xs, "peak": peaks}
+
+
+def _fwhm_from_peaks(image, ys, xs, peaks, background, saturation, cutout_size, max_stars):
+    """Fit circular Gaussians to cutouts around the peaks, all at once, and turn that into an FWHM for the image.
+
+    :return: FWHM in pixels, or None if there weren't enough stars.
+    """
+    half = cutout_size // 2
+
+    # Get rid of things with another peak close by, since the neighbor would mess up the profile. Saturated
+    # stars count as neighbors too, so do this before throwing them out.
+    if len(ys) > 1:
+        tree = spatial.cKDTree(np.column_stack([ys, xs]))
+        neighbor_distance = tree.query(np.column_stack([ys, xs]), k=2)[0][:, 1]
+        isolated = neighbor_distance > cutout_size
+        ys, xs, peaks = ys[isolated], xs[isolated], peaks[isolated]
+
+    # Need the whole cutout to be on the image
+    good = (ys >= half) & (ys < image.shape[0] - half) & (xs >= half) & (xs < image.shape[1] - half)
+    ys, xs, peaks = ys[good], xs[good], peaks[good]
+
+    # Get rid of saturated things. If the header doesn't tell us, be conservative and don't use anything close to
+    # the brightest peak in the image.
+    if saturation is None and len(peaks) > 0:
+        saturation = background + 0.8 * (peaks.max() - background)
+    if saturation is not None:
+        good = peaks < background + 0.8 * (saturation - background)
+        ys, xs, peaks = ys[good], xs[good], peaks[good]
+
+    # use the brightest ones
+    brightest = np.argsort(peaks)[::-1][:max_stars]
+    ys, xs = ys[brightest], xs[brightest]
+    if len(ys) < 5:
+        return None
+
+    # Pull out all the cutouts at once with fancy indexing. This only reads those pixels from the memory map.
+    offsets = np.arange(-half, half + 1)
+    cutout_ys = ys[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+    cutout_xs = xs[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    cutouts = np.nan_to_num(np.asarray(image[cutout_ys, cutout_xs], dtype=np.float64))
+
+    return _fit_gaussian_fwhm(cutouts)
+
+
+def _fit_gaussian_fwhm(cutouts):
+    """Fit a circular Gaussian to each of a stack of star cutouts, with no Python loop over the stars.
+
+    ln(I) = ln(A) - r^2 / (2 sigma^2) is a line in r^2, so each fit is a weighted linear regression. Pixels are
+    weighted by their flux squared, which is roughly inverse variance in log space, and only pixels above 10% of the
+    peak are used, since the wings are mostly noise.
+
+    :param cutouts: (N, size, size) array of cutouts centered on the peaks
+    :return: FWHM in pixels, or None if there weren't enough good fits.
+    """
+    n, size = cutouts.shape[0], cutouts.shape[1]
+
+    # subtract the local background, measured on the border of each cutout
+    border = np.concatenate([cutouts[:, 0, :], cutouts[:, -1, :], cutouts[:, 1:-1, 0], cutouts[:, 1:-1, -1]], axis=1)
+    cutouts = cutouts - np.median(border, axis=1)[:, np.newaxis, np.newaxis]
+    flux = np.clip(cutouts, 0, None)
+    total = flux.sum(axis=(1, 2))
+    good = total > 0
+    cutouts, flux, total = cutouts[good], flux[good], total[good]
+    if len(cutouts) < 5:
+        return None
+
+    # Centroids and second moments, to get sub-pixel centers and the shapes
+    grid_y, grid_x = np.mgrid[0:size, 0:size].astype(np.float64)
+    center_y = (flux * grid_y).sum(axis=(1, 2)) / total
+    center_x = (flux * grid_x).sum(axis=(1, 2)) / total
+    dy = grid_y[np.newaxis] - center_y[:, np.newaxis, np.newaxis]
+    dx = grid_x[np.newaxis] - center_x[:, np.newaxis, np.newaxis]
+    m_yy = (flux * dy**2).sum(axis=(1, 2)) / total
+    m_xx = (flux * dx**2).sum(axis=(1, 2)) / total
+    m_xy = (flux * dx * dy).sum(axis=(1, 2)) / total
+    ellipticity = np.sqrt((m_xx - m_yy)**2 + (2 * m_xy)**2) / (m_xx + m_yy)
+
+    # The weighted regression of ln(I) against r^2
+    r_squared = dx**2 + dy**2
+    peak = cutouts.max(axis=(1, 2))
+    use = cutouts > 0.1 * peak[:, np.newaxis, np.newaxis]
+    weights = np.where(use, cutouts**2, 0.0)
+    log_flux = np.log(np.where(use, cutouts, 1.0))
+
+    sum_w = weights.sum(axis=(1, 2))
+    sum_wx = (weights * r_squared).sum(axis=(1, 2))
+    sum_wy = (weights * log_flux).sum(axis=(1, 2))
+    sum_wxx = (weights * r_squared**2).sum(axis=(1, 2))
+    sum_wxy = (weights * r_squared * log_flux).sum(axis=(1, 2))
+    denominator = sum_w * sum_wxx - sum_wx**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (sum_w * sum_wxy - sum_wx * sum_wy) / denominator
+        fwhm = sigma_to_fwhm * np.sqrt(-1.0 / (2.0 * slope))
+
+    # Keep round things with a sensible fit. Galaxies will be bigger than stars, so after that sigma clip from the
+    # small side, around the stellar locus
+    good = np.isfinite(fwhm) & (slope < 0) & (ellipticity < 0.2) & (fwhm < size / 2.0)
+    fwhm = fwhm[good]
+    if len(fwhm) < 5:
+        return None
+    for _ in range(3):
+        median = np.median(fwhm)
+        spread = max(1.4826 * np.median(np.abs(fwhm - median)), 0.05 * median)
+        fwhm = fwhm[np.abs(fwhm - median) < 2.5 * spread]
+    return float(np.median(fwhm))
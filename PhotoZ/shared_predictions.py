@@ -0,0 +1,201 @@
+"""Prediction grids that many processes can use without each having their own copy.
+
+Fitting only needs the predicted magnitudes and red sequence slopes at each redshift, as arrays. publish writes
+those arrays as .npy files in a directory under global_paths.shared_predictions_directory, which is in memory on
+Linux (/dev/shm). Other processes attach to it by name, and get numpy arrays that are memory maps of those files,
+so every process reads the same pages and nothing is copied or unpickled. The arrays are read only.
+
+Each process that attaches leaves a reference file with its process ID in the grid's directory, and removes it when
+it detaches. The grid is deleted once the process that published it has released it and there are no references
+left. References from processes that died without detaching don't count.
+
+Layout of a grid's directory:
+    meta.json       the redshifts (as strings), filters, and colors, which give the order of the arrays
+    mags.npy        predicted magnitudes, with dimensions of [filters, redshifts]
+    slopes.npy      red sequence slopes, with dimensions of [colors, redshifts]
+    references/     one empty file per attached process
+    released        exists once the publishing process is done with it
+"""
+import os
+import json
+import errno
+import shutil
+import itertools
+import numpy as np
+from multiprocessing import util
+from PhotoZ import global_paths
+from PhotoZ import other_classes
+
+# numbers the references made by this process, so one process can attach more than once
+_reference_counter = itertools.count()
+
+
+class SharedPredictions(object):
+    """A process's view of a published prediction grid."""
+
+    def __init__(self, name, owner=False):
+        """Attach to a grid that has already been published. Use attach or publish instead of calling this.
+
+        :param name: name the grid was published under
+        :param owner: whether this process published it, so it is the one that releases it.
+        """
+        self.name = name
+        self.directory = _grid_directory(name)
+        self.owner = owner
+        if not os.path.isfile(os.path.join(self.directory, "meta.json")):
+            raise IOError("There are no shared predictions called " + name)
+
+        # take a reference before reading anything, so it can't be deleted in the meantime
+        self._reference = _take_reference(self.directory)
+        self.attached = True
+
+        meta_file = open(os.path.join(self.directory, "meta.json"), "r")
+        meta = json.load(meta_file)
+        meta_file.close()
+        self.redshift_axis = other_classes.RedshiftAxis(meta["redshifts"])
+        self.filters = [str(band) for band in meta["filters"]]
+        self.colors = [str(color) for color in meta["colors"]]
+        self.mags = np.load(os.path.join(self.directory, "mags.npy"), mmap_mode="r")
+        self.slopes = np.load(os.path.join(self.directory, "slopes.npy"), mmap_mode="r")
+
+    def __repr__(self):
+        return "SharedPredictions(" + self.name + ", " + repr(self.redshift_axis) + ")"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owner:
+            self.release()
+        else:
+            self.detach()
+
+    def get_mags(self, band):
+        """Get the predicted magnitudes in one band at every redshift. This is a view, not a copy."""
+        return self.mags[self.filters.index(band)]
+
+    def get_line_parameters(self, filter_pair):
+        """Get the red sequence lines at every redshift, like Cluster._get_model_lines.
+
+        :param filter_pair: color, like "sloan_r-sloan_z"
+        :return: arrays of the color zeropoints, slopes, and pivot magnitudes. The last two are views of the shared
+                 arrays. The zeropoints are calculated, but are only one number per redshift.
+        """
+        bluer_band, redder_band = filter_pair.split("-")
+        return (self.get_mags(bluer_band) - self.get_mags(redder_band), self.slopes[self.colors.index(filter_pair)],
+                self.get_mags(redder_band))
+
+    def detach(self):
+        """Stop using the grid. It's deleted if this was the last reference and it has been released."""
+        if not self.attached:
+            return
+        self.attached = False
+        # the memory maps are closed once nothing is using the arrays anymore
+        self.mags = self.slopes = None
+        _remove_file(self._reference)
+        _clean_up(self.directory)
+
+    def release(self):
+        """Called by the process that published the grid once it's done with it. It is deleted as soon as every
+        other process detaches, or right away if none are attached.
+        """
+        open(os.path.join(self.directory, "released"), "w").close()
+        self.detach()
+
+
+def publish(name, predictions_dict, colors):
+    """Put a prediction grid where other processes can attach to it.
+
+    :param name: name to publish it as. Should be unique, like something with the process ID in it.
+    :param predictions_dict: dictionary of keys=redshifts, values=Predictions objects, like Cluster.predictions_dict
+    :param colors: colors to include the red sequence slopes of. Ones without slopes are left out.
+    :return: SharedPredictions attached to it, with this process as the owner. Release it when done.
+    """
+    colors = [color for color in colors if color in other_classes.Predictions.slope_dict]
+    axis = other_classes.RedshiftAxis(predictions_dict)
+    filters = sorted(predictions_dict[axis.keys[0]].mags_dict)
+    mags = np.array([[predictions_dict[key].mags_dict[band] for key in axis.keys] for band in filters],
+                    dtype=np.float64)
+    slopes = np.array([[other_classes.Predictions.slope_dict[color][key] for key in axis.keys] for color in colors],
+                      dtype=np.float64)
+
+    # make it all somewhere else, then move it into place, so no one can attach to half of it
+    directory = _grid_directory(name)
+    temp_directory = directory.rstrip("/") + ".tmp." + str(os.getpid())
+    os.makedirs(os.path.join(temp_directory, "references"))
+    np.save(os.path.join(temp_directory, "mags.npy"), mags)
+    np.save(os.path.join(temp_directory, "slopes.npy"), slopes)
+    meta_file = open(os.path.join(temp_directory, "meta.json"), "w")
+    json.dump({"redshifts": axis.keys, "filters": filters, "colors": colors}, meta_file)
+    meta_file.close()
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)  # left over from a run that crashed
+    os.rename(temp_directory, directory)
+
+    return SharedPredictions(name, owner=True)
+
+
+def attach(name, detach_at_exit=True):
+    """Attach to a grid some other process published.
+
+    :param name: name it was published as
+    :param detach_at_exit: detach automatically when this process exits. This works for multiprocessing workers too.
+    :return: SharedPredictions
+    """
+    shared = SharedPredictions(name)
+    if detach_at_exit:
+        util.Finalize(None, shared.detach, exitpriority=10)
+    return shared
+
+
+def live_references(name):
+    """Count the processes attached to a grid. References from processes that have died are deleted."""
+    return _count_references(_grid_directory(name))
+
+
+def _take_reference(directory):
+    """Leave a reference for this process in a shared directory. Returns its path, to remove when done."""
+    reference = os.path.join(directory, "references", str(os.getpid()) + "." + str(next(_reference_counter)))
+    open(reference, "w").close()
+    return reference
+
+
+def _count_references(directory):
+    """Count the live references in a shared directory, deleting the ones left by processes that have died."""
+    references_directory = os.path.join(directory, "references")
+    if not os.path.isdir(references_directory):
+        return 0
+    count = 0
+    for reference in os.listdir(references_directory):
+        if _process_is_alive(int(reference.split(".")[0])):
+            count += 1
+        else:
+            _remove_file(os.path.join(references_directory, reference))
+    return count
+
+
+def _clean_up(directory):
+    """Delete a shared directory if it has been released and nothing references it."""
+    if os.path.isfile(os.path.join(directory, "released")) and _count_references(directory) == 0:
+        # more than one process can get here at once, which is fine
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _grid_directory(name):
+    return os.path.join(global_paths.shared_predictions_directory, name)
+
+
+def _process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        # EPERM means it exists, but belongs to someone else
+        return error.errno == errno.EPERM
+    return True
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,321 @@
+"""Cluster sources that many processes can use without each having their own copy.
+
+Handing a cluster to another process normally means pickling every one of its Source objects, which is slow once
+there are thousands of clusters. Instead, publish writes the sources of every cluster as columns (the same columns
+as a checkpoint, see checkpoints.py) into one file under global_paths.shared_sources_directory, which is in memory
+on Linux (/dev/shm). Each cluster gets a ClusterDescriptor, which only holds the cluster's index entry and where its
+columns are in that file, so it is cheap to send to a worker. The worker maps the file once, and its numpy arrays
+point straight into it, so nothing is copied. The magnitude arrays are handed to the cluster as they are (see
+Cluster.use_source_arrays). Results come back as small arrays too: a fit comes back like a shard
+(checkpoints.make_fit_result), and is put back onto the original cluster by the parent process.
+
+Like shared_predictions.py, each process that attaches leaves a reference file, and the arena is deleted once the
+process that published it has released it and there are no references left.
+
+Layout of an arena's directory:
+    meta.json       the descriptors of the clusters in it
+    sources.bin     every column of every cluster, one after another, each starting at a multiple of column_alignment
+    references/     one empty file per attached process
+    released        exists once the publishing process is done with it
+
+The columns are only read, so the arena should be published after anything that changes the sources, and published
+again if they change later.
+"""
+import os
+import json
+import shutil
+import multiprocessing
+import numpy as np
+from multiprocessing import util
+from PhotoZ import global_paths
+from PhotoZ import other_classes
+from PhotoZ import checkpoints
+from PhotoZ import shared_predictions
+from PhotoZ import Cluster
+
+# Columns start at multiples of this many bytes, so the arrays are aligned like they would be if numpy made them.
+column_alignment = 64
+
+# arenas this process has attached to, by name, so each worker only maps an arena once
+_attached = dict()
+
+
+class ClusterDescriptor(object):
+    """Where one cluster's sources are in an arena. This is all that has to be sent to another process."""
+    __slots__ = ["arena", "entry", "n_sources", "columns"]
+
+    def __init__(self, arena, entry, n_sources, columns):
+        """
+        :param arena: name of the arena the cluster is in
+        :param entry: the cluster's index entry, like checkpoints._cluster_metadata makes
+        :param n_sources: number of sources in the cluster
+        :param columns: dictionary with column names as keys, and (offset in bytes, numpy dtype string) as values
+        """
+        self.arena = arena
+        self.entry = entry
+        self.n_sources = n_sources
+        self.columns = columns
+
+    def __repr__(self):
+        return "ClusterDescriptor(" + self.arena + ", " + self.entry["name"] + ")"
+
+    def __getstate__(self):
+        return self.arena, self.entry, self.n_sources, self.columns
+
+    def __setstate__(self, state):
+        self.arena, self.entry, self.n_sources, self.columns = state
+
+    def to_json(self):
+        return {"arena": self.arena, "entry": self.entry, "n_sources": self.n_sources,
+                "columns": {column: list(place) for column, place in self.columns.items()}}
+
+    @classmethod
+    def from_json(cls, info):
+        # JSON gives back unicode strings, but the column names are used to find bands
+        return cls(str(info["arena"]), info["entry"], info["n_sources"],
+                   {str(column): (offset, str(dtype)) for column, (offset, dtype) in info["columns"].items()})
+
+
+class SourceArena(object):
+    """A process's view of a published arena."""
+
+    def __init__(self, name, owner=False):
+        """Attach to an arena that has already been published. Use attach or publish instead of calling this.
+
+        :param name: name the arena was published under
+        :param owner: whether this process published it, so it is the one that releases it.
+        """
+        self.name = name
+        self.directory = _arena_directory(name)
+        self.owner = owner
+        if not os.path.isfile(os.path.join(self.directory, "meta.json")):
+            raise IOError("There is no source arena called " + name)
+
+        # take a reference before reading anything, so it can't be deleted in the meantime
+        self._reference = shared_predictions._take_reference(self.directory)
+        self.attached = True
+
+        meta_file = open(os.path.join(self.directory, "meta.json"), "r")
+        self.descriptors = [ClusterDescriptor.from_json(info) for info in json.load(meta_file)["clusters"]]
+        meta_file.close()
+        sources_path = os.path.join(self.directory, "sources.bin")
+        # a memory map of an empty file isn't allowed
+        if os.path.getsize(sources_path) > 0:
+            self.buffer = np.memmap(sources_path, dtype=np.uint8, mode="r")
+        else:
+            self.buffer = np.zeros(0, dtype=np.uint8)
+
+    def __repr__(self):
+        return "SourceArena(" + self.name + ", " + str(len(self.descriptors)) + " clusters)"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owner:
+            self.release()
+        else:
+            self.detach()
+
+    def get_column(self, descriptor, column):
+        """Get one column of one cluster's sources. This is a read only view of the arena, not a copy.
+
+        :param descriptor: ClusterDescriptor of the cluster
+        :param column: name of the column, like "mag:sloan_z:value"
+        :return: numpy array with one entry per source
+        """
+        offset, dtype = descriptor.columns[column]
+        return np.ndarray(descriptor.n_sources, dtype=np.dtype(dtype), buffer=self.buffer, offset=offset)
+
+    def load_cluster(self, descriptor):
+        """Make a Cluster object out of a cluster in this arena.
+
+        The Source objects are new, but get_mags gives arrays that are views of the arena.
+
+        :param descriptor: ClusterDescriptor of the cluster
+        :return: Cluster object
+        """
+        table = {column: self.get_column(descriptor, column) for column in descriptor.columns}
+        cluster = checkpoints._cluster_from_metadata(descriptor.entry, checkpoints.sources_from_columns(table))
+
+        mags = dict()
+        for column in table:
+            if column.startswith("mag:") and column.endswith(":value"):
+                band = column[len("mag:"):-len(":value")]
+                mags[band] = other_classes.MeasurementArray(table[column], table["mag:" + band + ":error"])
+        cluster.use_source_arrays(mags)
+        return cluster
+
+    def detach(self):
+        """Stop using the arena. It's deleted if this was the last reference and it has been released."""
+        if not self.attached:
+            return
+        self.attached = False
+        # the memory map is closed once nothing is using the arrays anymore
+        self.buffer = None
+        if _attached.get(self.name) is self:
+            del _attached[self.name]
+        shared_predictions._remove_file(self._reference)
+        shared_predictions._clean_up(self.directory)
+
+    def release(self):
+        """Called by the process that published the arena once it's done with it. It is deleted as soon as every
+        other process detaches, or right away if none are attached.
+        """
+        open(os.path.join(self.directory, "released"), "w").close()
+        self.detach()
+
+
+def publish(name, cluster_list):
+    """Put the sources of some clusters where other processes can use them.
+
+    :param name: name to publish it as. Should be unique, like something with the process ID in it.
+    :param cluster_list: list of Cluster objects
+    :return: SourceArena attached to it, with this process as the owner. Its descriptors are in the same order as
+             cluster_list. Release it when done.
+    """
+    # make it all somewhere else, then move it into place, so no one can attach to half of it
+    directory = _arena_directory(name)
+    temp_directory = directory.rstrip("/") + ".tmp." + str(os.getpid())
+    os.makedirs(os.path.join(temp_directory, "references"))
+
+    descriptors = []
+    sources_file = open(os.path.join(temp_directory, "sources.bin"), "wb")
+    offset = 0
+    for cluster in cluster_list:
+        columns = dict()
+        for column, values in sorted(checkpoints.make_source_columns(cluster).items()):
+            values = np.ascontiguousarray(values)
+            padding = -offset % column_alignment
+            sources_file.write(b"\0" * padding)
+            offset += padding
+            columns[column] = (offset, values.dtype.str)
+            sources_file.write(values.tostring())
+            offset += values.nbytes
+        descriptors.append(ClusterDescriptor(name, checkpoints._cluster_metadata(cluster),
+                                             len(cluster.sources_list), columns))
+    sources_file.close()
+
+    meta_file = open(os.path.join(temp_directory, "meta.json"), "w")
+    json.dump({"clusters": [descriptor.to_json() for descriptor in descriptors]}, meta_file)
+    meta_file.close()
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)  # left over from a run that crashed
+    os.rename(temp_directory, directory)
+
+    return SourceArena(name, owner=True)
+
+
+def attach(name, detach_at_exit=True):
+    """Attach to an arena some other process published. Attaching again to the same arena gives the same object.
+
+    :param name: name it was published as
+    :param detach_at_exit: detach automatically when this process exits. This works for multiprocessing workers too.
+    :return: SourceArena
+    """
+    if name not in _attached:
+        arena = SourceArena(name)
+        if detach_at_exit:
+            util.Finalize(None, arena.detach, exitpriority=10)
+        _attached[name] = arena
+    return _attached[name]
+
+
+def load_cluster(descriptor):
+    """Make a Cluster object out of a descriptor, attaching to its arena if this process hasn't yet."""
+    return attach(descriptor.arena).load_cluster(descriptor)
+
+
+def fit_clusters(cluster_list, colors, processes=1, plot_figures=False):
+    """Run fit_z on many clusters at once. The results are set on the clusters in cluster_list, just like running
+    fit_z on each of them here would.
+
+    :param cluster_list: list of Cluster objects
+    :param colors: colors to fit, in order
+    :param processes: how many processes to spread the clusters over.
+    :param plot_figures: whether fit_z makes its plots
+    :return: None
+    """
+    if processes <= 1:
+        for cluster in cluster_list:
+            for color in colors:
+                cluster.fit_z(color, plot_figures)
+        return
+
+    results = _map_clusters(_fit_cluster, cluster_list, (colors, plot_figures), processes, colors)
+    for cluster, fits in zip(cluster_list, results):
+        for fit in fits:
+            checkpoints.apply_fit_result(cluster, fit)
+
+
+def write_rs_catalogs(cluster_list, processes=1):
+    """Write the red sequence catalog of many clusters. Run this after fitting them.
+
+    :param cluster_list: list of Cluster objects
+    :param processes: how many processes to spread the clusters over.
+    :return: None
+    """
+    if processes <= 1:
+        for cluster in cluster_list:
+            cluster._write_rs_catalog()
+        return
+    _map_clusters(_write_rs_catalog, cluster_list, (), processes)
+
+
+def _map_clusters(function, cluster_list, arguments, processes, colors=None):
+    """Publish the clusters, then run function((descriptor,) + arguments) on each cluster in a pool of processes.
+
+    :param colors: colors the workers need predictions for. If there are any, the prediction grid is shared with
+                   the workers too, like in pipeline.py.
+    :return: list of what function returned for each cluster, in the same order as cluster_list.
+    """
+    arena = publish("arena_" + str(os.getpid()), cluster_list)
+    predictions = None
+    try:
+        if colors:
+            predictions = shared_predictions.publish("arena_predictions_" + str(os.getpid()),
+                                                     Cluster.Cluster.predictions_dict, colors)
+        pool = multiprocessing.Pool(processes, initializer=_initialize_worker,
+                                    initargs=(predictions.name if predictions is not None else None,))
+        try:
+            # a cluster at a time, since they can take very different amounts of time
+            results = pool.map(function, [(descriptor,) + arguments for descriptor in arena.descriptors],
+                               chunksize=1)
+            pool.close()
+        except:
+            # stop the workers before the arena they are reading is deleted
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        arena.release()
+        if predictions is not None:
+            predictions.release()
+    return results
+
+
+def _initialize_worker(predictions_name):
+    if predictions_name is not None:
+        Cluster.Cluster.use_shared_predictions(shared_predictions.attach(predictions_name))
+
+
+def _fit_cluster(arguments):
+    """Run in a worker: fit one cluster, and return the results of each color like checkpoints.make_fit_result."""
+    descriptor, colors, plot_figures = arguments
+    cluster = load_cluster(descriptor)
+    fits = []
+    for color in colors:
+        cluster.fit_z(color, plot_figures)
+        fits.append(checkpoints.make_fit_result(cluster, color))
+    return fits
+
+
+def _write_rs_catalog(arguments):
+    """Run in a worker: write one cluster's red sequence catalog."""
+    descriptor, = arguments
+    load_cluster(descriptor)._write_rs_catalog()
+
+
+def _arena_directory(name):
+    return os.path.join(global_paths.shared_sources_directory, name)
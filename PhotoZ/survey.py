@@ -0,0 +1,187 @@
+"""Fitting cluster candidates out of one big survey catalog, rather than a set of catalogs for each cluster.
+
+The survey catalog is read once into columns (see SurveyCatalog), and a k-d tree is made of the positions of its
+sources. Each candidate is a name and a position. Its cluster is made of the survey sources in a cone around that
+position, which is found as an array of indices into the survey's columns, so the survey itself is never copied. The
+location cut of the cluster is centered on the candidate, rather than on the middle of its sources (see
+Cluster.center).
+
+The cones of all the candidates are found at once, with a second tree made of the candidates, so candidates close to
+each other share the work of going through the survey's tree (see cKDTree.query_ball_tree). The candidates are then
+fit a chunk at a time with batch_fitting.fit_clusters, spread over a pool of processes. The workers are forked with
+the survey already in memory, so they share it rather than each having a copy, and each chunk only sends back the
+redshifts and errors of its clusters.
+
+To use it, something like:
+    survey_catalog = survey.SurveyCatalog.from_catalog(path, {"sloan_r": ("MAG_R", "MAGERR_R"),
+                                                              "sloan_z": ("MAG_Z", "MAGERR_Z")},
+                                                       label_type="m", data_start=8)
+    cluster_list = survey.fit_candidates(survey_catalog, [("MOO0012+1602", 3.0604, 16.0378), ...],
+                                         config_data.fitted_colors, processes=8)
+"""
+import math
+import multiprocessing
+import numpy as np
+from scipy import spatial
+from PhotoZ import catalog
+from PhotoZ import checkpoints
+from PhotoZ import other_classes
+from PhotoZ import batch_fitting
+from PhotoZ import Cluster
+
+# Radius of the cone of sources that makes each candidate's cluster, in arcminutes. It's bigger than the location
+# cut, so the cluster has field galaxies around it like a cluster with its own catalogs does.
+cone_radius = 3.0
+# How many candidates each process fits at once.
+chunk_size = 200
+
+# the survey the worker processes use. It's set when they start.
+_survey = None
+
+
+class SurveyCatalog(object):
+    """The sources of a whole survey as columns, with a k-d tree of where they are."""
+
+    def __init__(self, ras, decs, mags, mag_errors):
+        """
+        :param ras: array of the RA of each source, in degrees
+        :param decs: array of the dec of each source, in degrees
+        :param mags: dictionary with bands as keys and arrays of magnitudes as values. Sources that weren't
+                     measured in a band have NaN there.
+        :param mag_errors: dictionary with bands as keys and arrays of magnitude errors as values.
+        """
+        self.ras = np.asarray(ras, dtype=np.float64)
+        self.decs = np.asarray(decs, dtype=np.float64)
+        self.bands = sorted(mags)
+        self.mags = {band: other_classes.MeasurementArray(mags[band], mag_errors[band]) for band in self.bands}
+        for band in self.bands:
+            if len(self.mags[band]) != len(self.ras):
+                other_classes.EndProgramError("Every column of the survey needs one entry per source.",
+                                              (band, len(self.mags[band]), len(self.ras)))
+        self.tree = spatial.cKDTree(_unit_vectors(self.ras, self.decs))
+
+    def __len__(self):
+        return len(self.ras)
+
+    def __repr__(self):
+        return "SurveyCatalog(" + str(len(self)) + " sources, bands=" + repr(self.bands) + ")"
+
+    @classmethod
+    def from_catalog(cls, path, band_columns, ra_column="ALPHA_J2000", dec_column="DELTA_J2000", **read_options):
+        """Read a survey catalog.
+
+        :param path: path to the catalog
+        :param band_columns: dictionary with bands as keys, and (magnitude column, error column) as values.
+        :param ra_column: column with the RA, in degrees
+        :param dec_column: column with the dec, in degrees
+        :param read_options: passed on to catalog.read_catalog, like label_type, data_start, and filters.
+        :return: SurveyCatalog
+        """
+        bands = sorted(band_columns)
+        columns = [ra_column, dec_column] + [column for band in bands for column in band_columns[band]]
+        table = np.array(catalog.read_catalog(path, columns, **read_options), dtype=np.float64).reshape(-1,
+                                                                                                      len(columns))
+        return cls(table[:, 0], table[:, 1], {band: table[:, 2 + 2 * i] for i, band in enumerate(bands)},
+                   {band: table[:, 3 + 2 * i] for i, band in enumerate(bands)})
+
+    def find_cones(self, ras, decs, radius=None):
+        """Find the sources around many positions at once.
+
+        :param ras: RAs of the centers of the cones, in degrees
+        :param decs: decs of the centers of the cones, in degrees
+        :param radius: radius of the cones, in arcminutes. Defaults to cone_radius.
+        :return: list of arrays of the indices of the sources in each cone, in the order they are in the survey.
+        """
+        if radius is None:
+            radius = cone_radius
+        if len(ras) == 0:
+            return []
+        centers = spatial.cKDTree(_unit_vectors(np.asarray(ras, dtype=np.float64),
+                                                np.asarray(decs, dtype=np.float64)))
+        # the distance through the sphere between two points that are radius apart on it
+        chord = 2 * math.sin(math.radians(radius / 60.0) / 2)
+        return [np.array(sorted(cone), dtype=np.intp) for cone in centers.query_ball_tree(self.tree, chord)]
+
+    def make_cluster(self, name, ra, dec, indices):
+        """Make a Cluster out of some of the survey's sources, centered on a position.
+
+        :param name: name of the cluster
+        :param ra: RA of the center, in degrees
+        :param dec: dec of the center, in degrees
+        :param indices: array of the indices of the sources to put in it, like find_cones gives.
+        :return: Cluster object. Its magnitude arrays are already made from the survey's columns.
+        """
+        table = {"ra": self.ras[indices], "dec": self.decs[indices]}
+        mags = dict()
+        for band in self.bands:
+            mags[band] = self.mags[band][indices]
+            table["mag:" + band + ":value"] = mags[band].values
+            table["mag:" + band + ":error"] = mags[band].errors
+
+        cluster = Cluster.Cluster(name, checkpoints.sources_from_columns(table))
+        cluster.center = (float(ra), float(dec))
+        cluster.bands = set(self.bands)
+        cluster.use_source_arrays(mags)
+        return cluster
+
+
+def fit_candidates(survey, candidates, colors, radius=None, processes=1, use_cache=True):
+    """Find the redshift of cluster candidates in a survey.
+
+    Only one chunk of clusters per process exists at a time, so this works for any number of candidates.
+
+    :param survey: SurveyCatalog
+    :param candidates: list of (name, RA, dec) of each candidate, with the positions in degrees
+    :param colors: colors to fit, in order
+    :param radius: radius of the cone around each candidate, in arcminutes. Defaults to cone_radius.
+    :param processes: how many processes to spread the candidates over.
+    :param use_cache: whether to use the fit cache. See fit_z.
+    :return: list of Cluster objects with their redshifts and errors, but no sources, like checkpoints.load_results
+             gives. They are in the same order as the candidates.
+    """
+    names = [candidate[0] for candidate in candidates]
+    ras = [candidate[1] for candidate in candidates]
+    decs = [candidate[2] for candidate in candidates]
+    cones = survey.find_cones(ras, decs, radius)
+    jobs = [(names[i:i + chunk_size], ras[i:i + chunk_size], decs[i:i + chunk_size], cones[i:i + chunk_size],
+             colors, use_cache) for i in range(0, len(candidates), chunk_size)]
+
+    if processes > 1 and len(jobs) > 1:
+        # forked processes start with the survey already there, so it isn't copied or sent to them
+        pool = multiprocessing.Pool(processes, initializer=_use_survey, initargs=(survey,))
+        try:
+            entries = [entry for chunk in pool.imap(_fit_chunk, jobs) for entry in chunk]
+            pool.close()
+        except:
+            # don't leave the workers running if a chunk failed
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        _use_survey(survey)
+        entries = [entry for job in jobs for entry in _fit_chunk(job)]
+    return [checkpoints._cluster_from_metadata(entry, []) for entry in entries]
+
+
+def _use_survey(survey):
+    global _survey
+    _survey = survey
+
+
+def _fit_chunk(job):
+    """Make the clusters of a chunk of candidates out of the survey, and fit them.
+
+    :return: list of the index entries of the fitted clusters, like checkpoints._cluster_metadata makes.
+    """
+    names, ras, decs, cones, colors, use_cache = job
+    clusters = [_survey.make_cluster(names[i], ras[i], decs[i], cones[i]) for i in range(len(names))]
+    for color in colors:
+        batch_fitting.fit_clusters(clusters, color, use_cache)
+    return [checkpoints._cluster_metadata(cluster) for cluster in clusters]
+
+
+def _unit_vectors(ras, decs):
+    """Turn positions on the sky, in degrees, into points on the unit sphere, so distances don't depend on dec."""
+    ras, decs = np.radians(ras), np.radians(decs)
+    return np.column_stack([np.cos(decs) * np.cos(ras), np.cos(decs) * np.sin(ras), np.sin(decs)])
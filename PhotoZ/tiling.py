@@ -0,0 +1,167 @@
+import os
+import collections
+import multiprocessing
+import numpy as np
+from astropy.io import fits
+
+
+class Tile(object):
+    """One piece of an image, for processing images that are too big to load all at once.
+
+    The core regions of all the tiles cover the image exactly once, with no overlap. Each tile is read with a margin
+    around its core, so things near the edge of the core are seen completely. Anything found in the margin belongs
+    to a neighboring tile, and is thrown out by in_core, so sources in the overlaps are only counted once.
+
+    All the regions are (y_start, y_stop, x_start, x_stop), in pixels of the whole image.
+    """
+
+    def __init__(self, core, read):
+        self.core = core
+        self.read = read
+
+    def __repr__(self):
+        return "Tile(core=" + str(self.core) + ", read=" + str(self.read) + ")"
+
+    @property
+    def shape(self):
+        return self.read[1] - self.read[0], self.read[3] - self.read[2]
+
+    def touches_image_edge(self, image_shape):
+        """Which sides of the read region are on the edge of the whole image.
+
+        :return: tuple of booleans: (top, bottom, left, right), where top is y=0.
+        """
+        return self.read[0] == 0, self.read[1] == image_shape[0], self.read[2] == 0, self.read[3] == image_shape[1]
+
+    def get_data(self, image, dtype=np.float32):
+        """Read this tile's pixels (core and margin) from the image. Only this part of a memory mapped image is read.
+
+        NaNs are set to zero, since they would spread through any filtering.
+        """
+        return np.nan_to_num(np.asarray(image[self.read[0]:self.read[1], self.read[2]:self.read[3]], dtype=dtype))
+
+    def to_image_coordinates(self, ys, xs):
+        """Convert positions within the tile to positions in the whole image."""
+        return ys + self.read[0], xs + self.read[2]
+
+    def in_core(self, ys, xs):
+        """Which of the positions (in whole image coordinates) belong to this tile.
+
+        Pixel centers are at integer positions, so pixel i covers i - 0.5 to i + 0.5.
+
+        :return: boolean array
+        """
+        return ((ys >= self.core[0] - 0.5) & (ys < self.core[1] - 0.5) &
+                (xs >= self.core[2] - 0.5) & (xs < self.core[3] - 0.5))
+
+
+def make_tiles(shape, tile_size, margin):
+    """Split an image into square tiles.
+
+    :param shape: shape of the image, (n_rows, n_columns)
+    :param tile_size: width of the core of each tile, in pixels
+    :param margin: how many extra pixels are read on each side of the core
+    :return: list of Tile objects, in order from the top left, going across each row.
+    """
+    tiles = []
+    for y_start in range(0, shape[0], tile_size):
+        for x_start in range(0, shape[1], tile_size):
+            core = (y_start, min(y_start + tile_size, shape[0]), x_start, min(x_start + tile_size, shape[1]))
+            read = (max(core[0] - margin, 0), min(core[1] + margin, shape[0]),
+                    max(core[2] - margin, 0), min(core[3] + margin, shape[1]))
+            tiles.append(Tile(core, read))
+    return tiles
+
+
+def map_tiles(image_path, function, tile_size, margin, args=(), processes=1):
+    """Run a function on every tile of a memory mapped image, and combine the sources it finds.
+
+    The function is called as function(data, tile, image_shape, *args), where data is the tile's pixels. It has to
+    return a dictionary of equal length arrays (one entry per source), which must include "y" and "x" in whole image
+    coordinates. Sources that aren't in the core of the tile are removed here, so the function doesn't need to
+    worry about the overlaps.
+
+    Only one tile per process is in memory at a time, so memory use depends on the tile size, not the image size.
+    When run in parallel, each worker opens the image itself, so no pixels are sent between processes. The function
+    has to be defined at the top level of a module so it can be sent to the workers.
+
+    :param image_path: path to the .fits image
+    :param function: what to run on each tile
+    :param tile_size: width of the tiles, in pixels
+    :param margin: how many pixels of overlap there are around each tile. Should be bigger than the sources.
+    :param args: extra arguments passed to the function. They are sent to every worker, so keep them small.
+    :param processes: how many processes to use. 1 does everything in this process.
+    :return: dictionary of arrays, holding the sources from all the tiles combined, in the order of the tiles.
+    """
+    shape = fits.getheader(image_path, 0)
+    shape = (shape["NAXIS2"], shape["NAXIS1"])
+    jobs = [(image_path, function, tile, shape, args) for tile in make_tiles(shape, tile_size, margin)]
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_run_on_tile, jobs)
+            pool.close()
+        except:
+            # don't leave the workers running if one of them failed
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        try:
+            results = [_run_on_tile(job) for job in jobs]
+        finally:
+            close_images()
+
+    # put the results from all the tiles together
+    results = [result for result in results if result is not None and len(result["y"]) > 0]
+    if len(results) == 0:
+        return dict()
+    return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+
+
+# Each process keeps the last few images it has opened, so it doesn't have to reopen them for every tile. Detection
+# goes back and forth between a detection and a measurement image, so it keeps two.
+max_open_images = 2
+# keys are image paths, and values are (modification time, HDUList), with the most recently used last.
+_open_images = collections.OrderedDict()
+
+
+def open_image(image_path):
+    """Memory map the data of an image, reusing it if this process already opened it (and it hasn't changed).
+
+    The file is closed when the image falls out of the few that are kept open, or by close_images. Arrays from it
+    can still be used after that, since the memory map stays around as long as they do.
+    """
+    mtime = os.path.getmtime(image_path)
+    if image_path in _open_images:
+        opened_mtime, hdu_list = _open_images.pop(image_path)
+        if opened_mtime == mtime:
+            _open_images[image_path] = (opened_mtime, hdu_list)
+            return hdu_list[0].data
+        # the file changed since it was opened
+        hdu_list.close()
+
+    while len(_open_images) >= max_open_images:
+        _open_images.popitem(last=False)[1][1].close()
+    hdu_list = fits.open(image_path, memmap=True)
+    _open_images[image_path] = (mtime, hdu_list)
+    return hdu_list[0].data
+
+
+def close_images():
+    """Close all the images this process has open."""
+    while _open_images:
+        _open_images.popitem()[1][1].close()
+
+
+def _run_on_tile(job):
+    """Does the work for one tile in map_tiles. Takes one tuple so it works with Pool.map."""
+    image_path, function, tile, shape, args = job
+    data = tile.get_data(open_image(image_path))
+    result = function(data, tile, shape, *args)
+    if result is None or len(result["y"]) == 0:
+        return None
+    keep = tile.in_core(result["y"], result["x"])
+    return {key: values[keep] for key, values in result.items()}
@@ -0,0 +1,159 @@
+"""Redshift errors that include the noise in which galaxies are on the red sequence, and in their photometry.
+
+The errors fit_z gives come from where the chi-squared goes up by one, which assumes the red sequence members are
+exactly right and that their errors are the only noise. bootstrap_redshift fits the red sequence members again many
+times:
+    - each time with a bootstrap resample of them (drawn with replacement), which shows how much the answer depends on
+      which galaxies happened to be picked
+    - and, optionally, with their magnitudes and colors moved by random amounts drawn from their errors
+Every resample is the same sources, with different weights (how many times each was drawn) and different
+photometry, so they are fit all at once. The resamples are a [resamples, sources] matrix of weights, and ones of
+magnitudes and colors. The chi-squared of a line against weighted sources is a quadratic in the line's zeropoint and
+slope, so each resample only needs six sums over its sources, and the chi-squared of every resample at every
+redshift comes from those, without ever making a [resamples, redshifts, sources] array.
+
+By default the sample is the one fit_z fit in its last round, and the errors are percentiles of the best redshifts of
+the resamples, measured from the redshift fit_z found. A sample that is passed in is measured from its own best
+redshift instead. The random numbers are seeded from the seed and the name of the cluster, so the same cluster always
+gets the same errors, no matter which other clusters are run with it.
+"""
+import zlib
+import numpy as np
+from PhotoZ import Cluster
+from PhotoZ import batch_fitting
+
+# The percentiles the errors go out to, which are one sigma for a Gaussian.
+error_percentiles = (15.87, 84.13)
+
+
+def bootstrap_redshift(cluster, color, n_resamples=1000, perturb=True, seed=0, sample=None):
+    """Find the errors on a cluster's redshift by fitting bootstrap resamples of its red sequence.
+
+    :param cluster: Cluster object
+    :param color: color to fit, like "sloan_r-sloan_z"
+    :param n_resamples: how many resamples to fit
+    :param perturb: whether to also move the magnitudes and colors of each resample by random amounts drawn from
+                    their errors.
+    :param seed: seed for the random numbers. It's combined with the name of the cluster.
+    :param sample: list of sources to resample. Defaults to the sample fit_z fit in its last round (see
+                   Cluster.fit_sample), so run fit_z first.
+    :return: best redshift (fit_z's, for the default sample), lower error, upper error, and the array of the best
+             redshifts of every resample. None if there aren't enough sources to fit.
+    """
+    fit_z_sample = sample is None
+    if fit_z_sample:
+        sample = cluster.fit_sample(color)
+    if len(sample) < 3:
+        return None
+
+    in_sample = cluster._source_mask(sample)
+    mags = cluster.get_mags(color.split("-")[1])[in_sample]
+    colors = cluster.get_colors(color)[in_sample]
+    random = np.random.RandomState([seed, zlib.crc32(cluster.name) & 0xffffffff])
+
+    weights = _resample_weights(random, n_resamples, len(mags))
+    mag_values, color_values = mags.values, colors.values
+    if perturb:
+        mag_values, color_values = _perturb(random, n_resamples, mags, colors)
+
+    lines = Cluster.Cluster._get_model_lines(color)
+    redshifts = Cluster.Cluster.redshift_axis.redshifts
+    if fit_z_sample:
+        best_z = float(cluster.rs_z[color])
+    else:
+        # the sample itself is one more "resample", with every source once and no changes
+        best_z = batch_fitting.stats_from_chi(redshifts, weighted_chi_square(lines, mags.values, colors.values,
+                                                                             colors.errors,
+                                                                             np.ones((1, len(mags)))))[0][0]
+    resampled_z = batch_fitting.stats_from_chi(redshifts, weighted_chi_square(lines, mag_values, color_values,
+                                                                              colors.errors, weights))[0]
+
+    lower, upper = np.percentile(resampled_z, error_percentiles)
+    return float(best_z), float(best_z - lower), float(upper - best_z), resampled_z
+
+
+def bootstrap_clusters(cluster_list, color, n_resamples=1000, perturb=True, seed=0):
+    """Run bootstrap_redshift on many clusters.
+
+    :param cluster_list: list of Cluster objects, already fit
+    :param color: color to fit
+    :param n_resamples: how many resamples to fit for each cluster
+    :param perturb: whether to move the photometry too. See bootstrap_redshift.
+    :param seed: seed for the random numbers
+    :return: dictionary with keys=cluster names, values=(best redshift, lower error, upper error). Clusters that
+             weren't fit, or without enough sources to resample, are left out.
+    """
+    results = dict()
+    for cluster in cluster_list:
+        result = bootstrap_redshift(cluster, color, n_resamples, perturb, seed)
+        if result is not None:
+            results[cluster.name] = result[:3]
+    return results
+
+
+def weighted_chi_square(lines, mags, colors, color_errors, weights):
+    """Does predictions.chi_square_grid for many weighted resamples of the same sources at once.
+
+    :param lines: color zeropoints, slopes, and pivot magnitudes of the model lines at each redshift, like
+                  Cluster._get_model_lines gives.
+    :param mags: magnitudes of the sources in the redder band. Either one array for every resample, or an array with
+                 dimensions of [resamples, sources].
+    :param colors: colors of the sources, with the same shape as mags
+    :param color_errors: array of the errors on the colors, which are the same for every resample
+    :param weights: array of how many times each source counts in each resample, with dimensions of
+                    [resamples, sources]. Each row should add up to the number of sources.
+    :return: array of reduced chi-squared values, with dimensions of [resamples, redshifts]
+    """
+    zeropoints, slopes, pivot_mags = lines
+    mags, colors = np.atleast_2d(mags), np.atleast_2d(colors)
+    # Everything is relative to the average magnitude and color, so the sums stay small and don't lose precision
+    # when they are subtracted from each other.
+    mean_mag, mean_color = np.mean(mags), np.mean(colors)
+    # The residual of a source from the line, over its error, is a * x + slope * y - w, where a only depends on the
+    # redshift and x, y, w only depend on the source.
+    a = zeropoints - slopes * (pivot_mags - mean_mag) - mean_color
+    x = 1.0 / color_errors
+    y = (mags - mean_mag) * x
+    w = (colors - mean_color) * x
+
+    sum_xx = np.dot(weights, x * x)
+    sum_yy = np.sum(weights * y * y, axis=1)
+    sum_ww = np.sum(weights * w * w, axis=1)
+    sum_xy = np.sum(weights * x * y, axis=1)
+    sum_xw = np.sum(weights * x * w, axis=1)
+    sum_yw = np.sum(weights * y * w, axis=1)
+    chi_sq = (a**2 * sum_xx[:, np.newaxis] + slopes**2 * sum_yy[:, np.newaxis] + sum_ww[:, np.newaxis] +
+              2 * a * slopes * sum_xy[:, np.newaxis] - 2 * a * sum_xw[:, np.newaxis] -
+              2 * slopes * sum_yw[:, np.newaxis])
+    # it can't really be negative, but can come out a tiny bit below 0 when the fit is nearly perfect
+    return np.maximum(chi_sq, 0) / (len(color_errors) - 1 - 1)
+
+
+def _resample_weights(random, n_resamples, n_sources):
+    """Draw bootstrap resamples, as how many times each source was drawn in each one.
+
+    :return: array of counts, with dimensions of [resamples, sources]
+    """
+    draws = random.randint(0, n_sources, size=(n_resamples, n_sources))
+    # count each row's draws separately, by giving each row its own range of bins
+    bins = draws + n_sources * np.arange(n_resamples)[:, np.newaxis]
+    return np.bincount(bins.ravel(), minlength=n_resamples * n_sources).reshape(n_resamples, n_sources)
+
+
+def _perturb(random, n_resamples, mags, colors):
+    """Move the magnitudes and colors by random amounts drawn from their errors, once for each resample.
+
+    The color is the bluer magnitude minus the redder one, so moving the redder magnitude moves the color the other
+    way by the same amount. The rest of the error on the color is from the bluer magnitude, and is drawn separately.
+    Colors from catalogs that have a smaller error than the magnitude are moved independently instead.
+
+    :param mags: MeasurementArray of the magnitudes in the redder band
+    :param colors: MeasurementArray of the colors
+    :return: arrays of the magnitudes and colors, with dimensions of [resamples, sources]
+    """
+    mag_errors = np.nan_to_num(mags.errors)
+    correlated = mag_errors <= colors.errors
+    redder_noise = random.normal(size=(n_resamples, len(mags))) * mag_errors
+    other_errors = np.where(correlated, np.sqrt(np.maximum(colors.errors**2 - mag_errors**2, 0)), colors.errors)
+    other_noise = random.normal(size=(n_resamples, len(mags))) * other_errors
+    return mags.values + redder_noise, colors.values + other_noise - np.where(correlated, redder_noise, 0)